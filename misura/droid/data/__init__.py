@@ -3,7 +3,8 @@
 from conf import Conf
 from circularbuffer import CircularBuffer
 from database import Database
-from filebuffer import FileBuffer
+from filebuffer import FileBuffer, copy_meta
 from dirshelf import DirShelf
+from arena import ArenaShelf
 from refupdater import ReferenceUpdater
 from outfile import OutputFile, sign
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""Single-file storage of many options, as an alternative DirShelf backend."""
+import os
+import struct
+import zlib
+import numpy as np
+from cPickle import dumps, loads
+import exceptions
+
+import filebuffer
+from filebuffer import FileBuffer, exclusive, shared, LOCK_EX, LOCK_NBEX
+from dirshelf import DirShelf
+from .. import utils
+
+
+def key_hash(key):
+    """Positive hash of `key`, stable across processes"""
+    return (zlib.crc32(key) & 0xffffffff) + 1
+
+
+class Arena(FileBuffer):
+
+    """Single mmap'd file holding metadata and current value of many keys,
+    found through an open-addressing hash index.
+    Records are rewritten in place while they fit their capacity,
+    otherwise they move to the end of the file.
+    Locking, mappings cache, lock-free reading and durability are the FileBuffer ones."""
+    magic = 'FBAR'
+    version = 1
+    info_struct = struct.Struct('<4sIqqqq')  # magic, version, index slots, keys count, data end, wasted bytes
+    slot_struct = struct.Struct('<qqq')  # key hash, record start, record capacity
+    slot_len = slot_struct.size
+    record_struct = struct.Struct('<IIId')  # key, meta and value lengths, time
+    tombstone = -1
+    """Key hash of deleted entries"""
+    slots = 1024
+    """Initial number of index slots. The index is doubled as soon as it is half full."""
+    info = 0, 0, 0, 0
+    """Uninitialized info tuple (index slots, keys count, data end, wasted bytes)"""
+
+    def init(self, path):
+        """Initialize an empty arena file"""
+        d = os.path.dirname(path)
+        if not os.path.exists(d):
+            os.makedirs(d)
+        fo = open(path, 'wb')
+        fo.write(self.pack_info(self.slots, 0, self.data_position(self.slots), 0))
+        fo.write('\x00' * (self.slots * self.slot_len))
+        fo.close()
+        # The locker might be replaced by restore_locker in child processes
+        filebuffer.locker.new(path)
+
+    def pack_info(self, *vals):
+        """Encode the info header"""
+        info = self.info_struct.pack(self.magic, self.version, *vals)
+        return info + '\x00' * (self.info_len - len(info))
+
+    def data_position(self, slots):
+        """Records start byte, after an index of `slots` entries"""
+        return self.info_len + slots * self.slot_len
+
+    def check_layout(self, lock):
+        """Unknown layouts are refused"""
+        self.legacy = False
+        magic, version = self.info_struct.unpack_from(self.mm)[:2]
+        if magic != self.magic or version != self.version:
+            raise exceptions.IOError('Unsupported Arena layout {} {} {}'.format(magic,
+                                                                                version,
+                                                                                self.path))
+        return False
+
+    def mapped(self, lock):
+        """Read the header of the newly mapped arena.
+        Start a write generation if `lock` is exclusive."""
+        self.check_layout(lock)
+        self.info = self._get_info()
+        if lock in (LOCK_EX, LOCK_NBEX):
+            self.writing = True
+            self._bump_generation()
+
+    def _get_info(self):
+        return self.info_struct.unpack_from(self.mm)[2:]
+
+    def _layout_size(self):
+        """Minimum file size for the current header: the end of the last record"""
+        return self._get_info()[2]
+
+    def set_info(self, *vals):
+        self.mm[:self.info_struct.size] = self.info_struct.pack(self.magic,
+                                                                self.version,
+                                                                *vals)
+        self.info = vals
+
+    def _get_codec(self):
+        return 'p'
+
+    def _slot(self, i):
+        return self.slot_struct.unpack_from(self.mm, self.info_len + i * self.slot_len)
+
+    def _set_slot(self, i, h, start, capacity):
+        self.slot_struct.pack_into(self.mm, self.info_len + i * self.slot_len, h, start, capacity)
+
+    def _starts(self):
+        """Record start of all keys, in index order"""
+        slots = self.info[0]
+        index = np.frombuffer(self.mm, '<i8', slots * 3, self.info_len).reshape(slots, 3)
+        return index[index[:, 0] > 0][:, 1].tolist()
+
+    def _record(self, start):
+        """Decode the record at `start` into key, meta and value pickles and time"""
+        kl, ml, vl, t = self.record_struct.unpack_from(self.mm, start)
+        p = start + self.record_struct.size
+        rec = self.mm[p:p + kl + ml + vl]
+        return rec[:kl], rec[kl:kl + ml], rec[kl + ml:], t
+
+    def _record_key(self, start):
+        kl = self.record_struct.unpack_from(self.mm, start)[0]
+        p = start + self.record_struct.size
+        return self.mm[p:p + kl]
+
+    def _find(self, key):
+        """Return the index slot of `key` and its record start,
+        or the slot where `key` would be inserted and -1 if it is missing."""
+        key = str(key)
+        slots = self.info[0]
+        h = key_hash(key)
+        i = h % slots
+        free = -1
+        for n in xrange(slots):
+            kh, start, capacity = self._slot(i)
+            if kh == 0:
+                break
+            if kh == self.tombstone:
+                if free < 0:
+                    free = i
+            elif kh == h and self._record_key(start) == key:
+                return i, start
+            i = (i + 1) % slots
+        if free >= 0:
+            return free, -1
+        return i, -1
+
+    def _reserve(self, size):
+        """Grow the file to at least `size` bytes, doubling it to spare future resizes"""
+        if len(self.mm) < size:
+            self.mm.resize(max(size, 2 * len(self.mm)))
+            self.mm.seek(0)
+
+    def _put(self, key, val, t, meta=None):
+        """Write `key` record, with encoded value `val` and metadata `meta`.
+        If `meta` is None, keep the current one."""
+        key = str(key)
+        slot, start = self._find(key)
+        if start < 0 and meta is None:
+            raise exceptions.KeyError('Arena: missing key {} {}'.format(key, self.path))
+        slots, count, end, wasted = self.info
+        if start >= 0:
+            capacity = self._slot(slot)[2]
+            # Unchanged metadata is not rewritten
+            if meta is not None and meta == self._record(start)[1]:
+                meta = None
+            # Only the value changes
+            if meta is None:
+                kl, ml, vl, t0 = self.record_struct.unpack_from(self.mm, start)
+                size = self.record_struct.size + kl + ml + len(val)
+                if size <= capacity:
+                    self.record_struct.pack_into(self.mm, start, kl, ml, len(val), t)
+                    self.mm[start + size - len(val):start + size] = val
+                    return True
+                meta = self._record(start)[1]
+            rec = self.record_struct.pack(len(key), len(meta), len(val), t) + key + meta + val
+            if len(rec) <= capacity:
+                self.mm[start:start + len(rec)] = rec
+                return True
+            wasted += capacity
+        else:
+            rec = self.record_struct.pack(len(key), len(meta), len(val), t) + key + meta + val
+            count += 1
+        # Move to the end, leaving room for bigger values
+        capacity = len(rec) + len(rec) // 2
+        self._reserve(end + capacity)
+        self.mm[end:end + len(rec)] = rec
+        self._set_slot(slot, key_hash(key), end, capacity)
+        self.set_info(slots, count, end + capacity, wasted)
+        # Keep the index at most half full and the file mostly live
+        if count * 2 > slots:
+            self._rebuild(slots * 2)
+        elif wasted * 2 > end:
+            self._rebuild(slots)
+        return True
+
+    def _rebuild(self, slots):
+        """Rewrite all records compactly after a new index of `slots` entries"""
+        records = [self._record(start) for start in self._starts()]
+        end = self.data_position(slots)
+        self._reserve(end)
+        # Records were copied: the old index and data can be overwritten
+        self.mm[self.info_len:end] = '\x00' * (end - self.info_len)
+        self.set_info(slots, 0, end, 0)
+        for key, meta, val, t in records:
+            self._put(key, val, t, meta)
+        print('Arena.rebuild', self.path, slots, len(records))
+        return len(records)
+
+    def _item(self, key, meta=False):
+        """Return [time, value] of `key`, or [time, metadata] with the value set as current"""
+        slot, start = self._find(key)
+        if start < 0:
+            raise exceptions.KeyError('Arena: missing key {} {}'.format(key, self.path))
+        return self._decode_record(start, meta)[1:]
+
+    def _decode_record(self, start, meta=False):
+        """Return key, time and value of the record at `start`, 
+        or metadata with the value set as current"""
+        k, m, v, t = self._record(start)
+        val = loads(v)
+        if not meta:
+            return [k, t, val]
+        m = loads(m)
+        m['current'] = val
+        return [k, t, m]
+
+    @shared
+    def item(self, key, meta=False):
+        return self._item(key, meta)
+
+    def _key_time(self, key):
+        """Return the time of `key`, without decoding its value"""
+        slot, start = self._find(key)
+        if start < 0:
+            raise exceptions.KeyError('Arena: missing key {} {}'.format(key, self.path))
+        return self.record_struct.unpack_from(self.mm, start)[3]
+
+    @shared
+    def key_time(self, key):
+        return self._key_time(key)
+
+    @shared
+    def items(self, meta=True):
+        """All (key, value or metadata) pairs, decoded in a single pass"""
+        out = []
+        for start in self._starts():
+            k, t, val = self._decode_record(start, meta)
+            out.append((k, val))
+        return out
+
+    @shared
+    def contains(self, key):
+        return self._find(key)[1] >= 0
+
+    @shared
+    def list_keys(self):
+        return [self._record_key(start) for start in self._starts()]
+
+    @exclusive
+    def write_key(self, key, val, t=-1, meta=None):
+        """Set `key` to `val` at time `t`, with new metadata `meta` if defined"""
+        if t < 0:
+            t = utils.time()
+        if meta is not None:
+            meta = dumps(meta, self.protocol)
+        r = self._put(key, dumps(val, self.protocol), t, meta)
+        filebuffer.notifier.publish(filebuffer.locker.cache[self.path], t)
+        return r
+
+    @exclusive
+    def remove_key(self, key):
+        slot, start = self._find(key)
+        if start < 0:
+            return False
+        slots, count, end, wasted = self.info
+        capacity = self._slot(slot)[2]
+        self._set_slot(slot, self.tombstone, -1, -1)
+        self.set_info(slots, count - 1, end, wasted + capacity)
+        filebuffer.notifier.publish(filebuffer.locker.cache[self.path], utils.time())
+        return True
+
+
+class ArenaShelf(DirShelf):
+
+    """DirShelf keeping all options in a single Arena file.
+    History options still get their own FileBuffer, where ReferenceUpdater looks for them."""
+    arena_name = '.arena'
+    """Arena file name in the shelf directory"""
+
+    def __init__(self, basedir, viewdir=False, desc=False, private_cache=False, **k):
+        self.arena = Arena(private_cache=private_cache)
+        self.routes = {}
+        """Keys known to be stored in the arena (True) or in their own FileBuffer (False)"""
+        DirShelf.__init__(self, basedir, viewdir=viewdir, private_cache=private_cache, **k)
+        self.arena.durability = self.durability
+        self.arena.lockfree = self.lockfree
+        # Create the arena file
+        self.arena.fopen(self.arena_path)
+        self.arena.fclose()
+        if desc:
+            self.update(desc)
+
+    @property
+    def arena_path(self):
+        return os.path.join(self.dir, self.arena_name)
+
+    def in_arena(self, key):
+        """Check if `key` is stored in the arena"""
+        r = self.routes.get(key, None)
+        if r is not None:
+            return r
+        r = self.arena.contains(self.arena_path, key)
+        # Keys missing from both might be created later by another process
+        if r or os.path.exists(self.fp(key)):
+            self.routes[key] = r
+        return r
+
+    def set(self, key, val, t=-1, newmeta=True):
+        if not newmeta:
+            if self.in_arena(key):
+                return self.arena.write_key(self.arena_path, key, val, t)
+            return DirShelf.set(self, key, val, t, newmeta=False)
+        arena = 'History' not in val.get('attr', [])
+        # Move between storages if History attribute changed
+        if arena and os.path.exists(self.fp(key)):
+            DirShelf.__delitem__(self, key)
+        elif not arena and self.in_arena(key):
+            self.arena.remove_key(self.arena_path, key)
+        self.routes[key] = arena
+        if not arena:
+            return DirShelf.set(self, key, val, t, newmeta=True)
+        meta, cur = self.split(key, val)
+        return self.arena.write_key(self.arena_path, key, cur, t, meta)
+
+    __setitem__ = set
+
+    def get(self, key, *a, **k):
+        meta = k.get('meta', True)
+        if self.in_arena(key):
+            return self.arena.item(self.arena_path, key, meta)[1]
+        return DirShelf.get(self, key, meta=meta)
+
+    def has_key(self, key):
+        return self.in_arena(key) or DirShelf.has_key(self, key)
+
+    def __delitem__(self, key):
+        if self.in_arena(key):
+            self.routes.pop(key)
+            return self.arena.remove_key(self.arena_path, key)
+        return DirShelf.__delitem__(self, key)
+
+    def file_keys(self):
+        """Keys stored in their own FileBuffer"""
+        return [k for k in DirShelf.keys(self) if not k.startswith(self.arena_name)]
+
+    def keys(self, key=''):
+        if key:
+            return DirShelf.keys(self, key)
+        return self.arena.list_keys(self.arena_path) + self.file_keys()
+
+    def items(self, key='', meta=True):
+        if key:
+            return DirShelf.items(self, key, meta)
+        return self.arena.items(self.arena_path, meta) + self.file_items(self.file_keys(), meta)
+
+    # Arena keys only keep their current value
+    def h_get(self, key, startIdx=0, endIdx=-1):
+        if not self.in_arena(key):
+            return DirShelf.h_get(self, key, startIdx, endIdx)
+        r = self.arena.item(self.arena_path, key)
+        if startIdx == endIdx:
+            return r
+        return [r]
+
+    def h_time_at(self, key, idx=-1):
+        if not self.in_arena(key):
+            return DirShelf.h_time_at(self, key, idx)
+        return self.arena.key_time(self.arena_path, key)
+
+    def h_get_time(self, key, t):
+        if not self.in_arena(key):
+            return DirShelf.h_get_time(self, key, t)
+        return -1 if t > self.h_time_at(key) else 0
+
+    def h_get_history(self, key, t0=-2, t1=0):
+        if not self.in_arena(key):
+            return DirShelf.h_get_history(self, key, t0, t1)
+        return False
+
+    def h_clear(self, key=''):
+        if not self.in_arena(key):
+            return DirShelf.h_clear(self, key)
+        return True
@@ -2,7 +2,6 @@
 """Circular buffer implementation"""
 from copy import deepcopy
 from .. import parameters as params
-from misura.canon import csutil
 import numpy
 
 
@@ -16,24 +15,36 @@ def isTime(v):
 
 class CircularBuffer(object):
 
-    """Circular buffer implementation for storing History options."""
+    """Circular buffer implementation for storing History options.
+    Rows are kept in a list of slots, their times in a parallel array."""
 
     def __init__(self, length=params.buffer_length, lst=False):
-        self.idx = -1
+        self._idx = -1
         # FIXME: trovare un paragone più elegante
         if type(lst) != type(False):
             self.list = lst
-            self.idx = len(self.list)
+            self._idx = len(self.list)
             if len(lst) > 0:
                 self.times = numpy.array([float(l[0]) for l in lst])
-                self.idx = len(self.times)
+                self._idx = len(self.times)
         else:
             self.list = [[]] * length
-            self.times = numpy.array([0.] * len(self.list))
+            self.times = numpy.zeros(len(self.list))
         # deve essere di tipo lista, altrimenti la concatenazione ha problemi!
         self.list = list(self.list)
         self.empty = self.list[0]
         self.len = len(self.list)
+        self.ordered = bool(numpy.all(numpy.diff(self.times[self.order()]) >= 0))
+        """Times are not decreasing from the oldest to the newest row, allowing binary searches"""
+
+    def get_idx(self):
+        return self._idx
+
+    def set_idx(self, idx):
+        """Move the current buffer position. Times might lose their order."""
+        self._idx = idx
+        self.ordered = False
+    idx = property(get_idx, set_idx)
 
     # L'oggetto deve rimanere picklable.
     def __repr__(self):
@@ -48,6 +59,8 @@ class CircularBuffer(object):
     def expand(self, n):
         self.list.append([] * n)
         self.len = len(self.list)
+        self.times = numpy.append(self.times, 0.)
+        self.ordered = False
 
     def __len__(self):
         return len(self.list)
@@ -57,29 +70,33 @@ class CircularBuffer(object):
         # se la richiesta è troppo antica, restituisco il più vecchio
         if abs(i) > self.len:
             return self.shift(0)
-        i = (i + self.idx + 1) % self.len
+        i = (i + self._idx + 1) % self.len
         return i
 
     def deshift(self, a):
         """Translate absolute list index `a` into relative to the actual buffer position idx"""
-        a = a - self.idx - 1
+        a = a - self._idx - 1
         return a
 
     def pos(self):
-        return self.idx
+        return self._idx
 
     def length(self):
         return self.len
 
+    def order(self):
+        """Absolute indexes of all rows, from the oldest to the newest"""
+        return (numpy.arange(self.len) + self._idx + 1) % self.len
+
     def __getitem__(self, i):
         """Get slice `i` from the current buffer position"""
-        if self.idx < 0:
+        if self._idx < 0:
             # Not initialized
             return []
         if getattr(i, 'indices', None) == None:
             i = self.shift(i)
             return self.list[i]
-        a = self.idx			# newest
+        a = self._idx			# newest
         b = self.shift(0)		# oldest
 
         # Return the entire vector
@@ -100,32 +117,60 @@ class CircularBuffer(object):
         s = slice(a, b, i.step)
         return self.list[s]
 
-    def __setitem__(self, i, v):
-        i = self.shift(i)
+    def _set(self, i, v):
+        """Set row `v` at absolute index `i`"""
         self.list[i] = v
-        if isTime(v):
+        try:
             self.times[i] = v[0]
+        except (TypeError, ValueError, IndexError):
+            pass
+
+    def __setitem__(self, i, v):
+        i = self.shift(i)
+        self._set(i, v)
+        self.ordered = False
 
     def remove(self, val):
         # FIXME: distrugge l'integrità del buffer!
         self.list.remove(val)
 
     def append(self, v):
-        self.idx += 1
-        self.idx = self.idx % self.len
-        self.list[self.idx] = v
-        if isTime(v):
-            self.times[self.idx] = float(v[0])
+        last = self.times[self._idx % self.len]
+        self._idx += 1
+        self._idx = self._idx % self.len
+        self._set(self._idx, v)
+        if self.times[self._idx] < last:
+            self.ordered = False
     commit = append
 
+    def _segments(self):
+        """Absolute (start, stop) ranges of the oldest and newest rows.
+        Their times are views of the times array."""
+        b = self._idx % self.len + 1
+        return (b, self.len), (0, b)
+
     def get_time(self, t):
         """Search the row index nearest to the requested `t` time"""
-        idx = csutil.find_nearest_brute(self.times, t)
-        return self.deshift(idx)
+        if not self.ordered:
+            idx = numpy.abs(self.times - t).argmin()
+            return self.deshift(idx)
+        # Binary search on both segments
+        best = -1
+        for a, b in self._segments():
+            times = self.times[a:b]
+            if not len(times):
+                continue
+            i = min(times.searchsorted(t), len(times) - 1)
+            if i > 0 and abs(times[i - 1] - t) <= abs(times[i] - t):
+                i -= 1
+            if best < 0 or abs(times[i] - t) < abs(self.times[best] - t):
+                best = a + i
+        return self.deshift(best)
 
     def clear(self):
         for i, foo in enumerate(self.list):
             self.list[i] = deepcopy(self.empty)
         self.len = len(self.list)
-        self.times = numpy.array([0.] * self.len)
-        self.idx = -1
+        self.times = numpy.zeros(self.len)
+        self._idx = -1
+        self.ordered = True
@@ -6,6 +6,8 @@ from .. import utils
 from misura.canon import option
 from misura.canon import logger
 import dirshelf
+import arena
+import logring
 from cPickle import HIGHEST_PROTOCOL
 hp = HIGHEST_PROTOCOL
 
@@ -15,16 +17,20 @@ class Conf(PersistentConf):
     """Share-able configuration class for misura objects."""
 
     def __init__(self, desc={}, conf_dir='',
-                 buffer_length=params.buffer_length, empty=False):
+                 buffer_length=params.buffer_length, empty=False, shelf_arena=None):
+        """`shelf_arena`: store options in a single arena file. Defaults to params.shelf_arena."""
         PersistentConf.__init__(self, conf_dir=conf_dir)
         option.Conf.__init__(self, desc=desc, empty=empty)
         self.buffer_length = buffer_length
         from misura.droid import share
 #       print 'initializing data.Conf',len(desc)
-        self.desc = dirshelf.DirShelf(basedir=share.dbpath, desc=desc)
+        if shelf_arena is None:
+            shelf_arena = params.shelf_arena
+        Shelf = arena.ArenaShelf if shelf_arena else dirshelf.DirShelf
+        self.desc = Shelf(basedir=share.dbpath, desc=desc)
         self.kid_base = str(id(self))
         self.log = logger.SubLogger(self)
-        self.db = share.database
+        self.db = logring.log_ring
     
     def h_get(self, *a, **k):
         return self.desc.h_get(*a,**k)
@@ -90,7 +96,7 @@ class Conf(PersistentConf):
         elif isinstance(excl, list) or isinstance(excl, tuple):
             excl = excl[0]
         excl = set(excl)
-        for k, e in self.desc.iteritems():
+        for k, e in self.desc.items():
             try:
                 par = set(e['attr'] + [e['type']])
             except:
@@ -98,7 +104,7 @@ class Conf(PersistentConf):
                 raise
             entry = e.entry
             # Update to current values
-            if self.desc[k]['current'] is None:
+            if e['current'] is None:
                 print('Found None value', k)
                 entry['current'] = 'None'
             # Replace with factory default if type/attr is not requested
@@ -3,37 +3,46 @@
 import os
 import logging
 import logging.handlers
+import threading
+from time import sleep
 import conf
 from .. import parameters as params
-from misura.canon import logger
 from circularbuffer import CircularBuffer
-from .. import utils
 from dirshelf import DirShelf
+import logring
+import logfile
 
 
 class Database(object):
     out = False
     """Buffering object for data output"""
+    log_flush_interval = 0.5
+    """Seconds between log file writes"""
     def __init__(self, dbpath, log_format='%(levelname)s:%(asctime)s%(message)s', log_filename=False):
         # Clean the path before setting it
         self.dbpath = dbpath
 #       self._lock=Lock()
         self._lock = False
-        # TODO: make these shared!
+        # TODO: make this shared!
         kid_list = [[0., '']] * params.buffer_length
         self.kid_buf = CircularBuffer(lst=kid_list)
         """Latest modified KIDs"""
         self.nkid = 0
         """Current kid index"""
-        log_list = [[0, 0, '', '']] * params.buffer_length
-        self.log_buf = CircularBuffer(lst=log_list)
-        """Latest log lines"""
-        self.nlog = 0
-        """Current log index"""
+        self.nlog = logring.log_ring.seq.value
+        """Log ring sequence number of the next line to be written to the log file"""
         self.main_logger = False
+        self.file_logger = False
+        self.log_file = False
+        """Binary log file"""
+        self._sink = False
         self.log_filename = False
         self.log_format = log_format
         self.set_logger(log_format, log_filename=log_filename)
+        # Log lines from all processes are emitted from the log ring
+        self._sink = threading.Thread(target=self._sink_log)
+        self._sink.daemon = True
+        self._sink.start()
 
     def set_logger(self, log_format='%(levelname)s:%(asctime)s%(message)s', log_filename=False):
         self.log_format = log_format
@@ -49,21 +58,32 @@ class Database(object):
         if not log_filename:
             return
         self.log_filename = log_filename
+        self.file_logger = logging.getLogger('misura.file')
+        self.file_logger.setLevel(logging.DEBUG)
+        self.file_logger.propagate = False
         self.addFileHandler(log_filename,
                             params.log_file_dimension,
                             params.log_backup_count)
+        if params.log_binary and not self.log_file:
+            self.log_file = logfile.LogFile(log_filename + '.bin',
+                                            params.log_file_dimension,
+                                            params.log_backup_count)
 
     def __getstate__(self):
         d = self.__dict__.copy()
-        for k in ['main_logger', 'formatter']:
+        for k in ['main_logger', 'file_logger', 'log_file', 'formatter', '_sink']:
             if d.has_key(k):
                 del d[k]
         return d
 
     def __setstate__(self, state):
         map(lambda a: setattr(self, *a), state.items())
-        if 'log_filename' in state and 'log_format' in state:
-            self.set_logger(state['log_format'], state['log_filename'])
+        self.file_logger = False
+        self.log_file = False
+        self._sink = False
+        # The log file is written by the original instance only
+        if 'log_format' in state:
+            self.set_logger(state['log_format'])
 
     def addFileHandler(self, filename, max_dim=2 * 10**6, backups=10):
         """Adds logrotate logging"""
@@ -72,48 +92,47 @@ class Database(object):
                                                        maxBytes=max_dim,
                                                        backupCount=backups)
         handler.setFormatter(self.formatter)
-        self.main_logger.addHandler(handler)
+        self.file_logger.addHandler(handler)
 
     def close(self):
-        pass
+        sink = self._sink
+        self._sink = False
+        if sink:
+            sink.join()
+            self.flush_log()
+        if self.log_file:
+            self.log_file.close()
+            self.log_file = False
 
     # LOGGING FUNCTIONS
 
     def get_log(self, fromt=False, priority=0, owner=False, tot=False, maxn=None):
-        """Search in the log buffer. Require priority equal
+        """Search in the log ring. Require priority equal
         or bigger than `priority` and emitted by `owner`.
         Maximum time `tot`, maximum number of entries `maxn`."""
-        t, obuf = utils.get_history(self.log_buf, fromt)
-        buf = []
-        if type(obuf[0]) == type(1.):
-            obuf = [obuf]
-        if tot is False:
-            tot = obuf[-1][0] + 1
-        for b in obuf:
-            if b[0] > fromt and b[0] < tot:
-                buf.append(b)
-        if not owner and priority == 0:
-            return t, buf[:maxn]
-        r = []
-        # time, prio, owner, msg
-        for l in buf:
-            if len(l) < 3:
-                break
-            if priority > 0:
-                if l[1] < priority:
-                    continue
-            if owner:
-                if l[2] != owner:
-                    continue
-            if l is None:
-                l = 'None'
-            r.append(l)
-        return t, r[:maxn]
+        return logring.log_ring.search(fromt, priority, owner, tot=tot, maxn=maxn)
 
-    def put_log(self, *msg, **po):
-        """General, short-memory logging"""
-        t, st, p, o, msg, pmsg = logger.formatMsg(*msg, **po)
-        self.log_buf.append([t, p, o, pmsg])
-        self.nlog += 1
-        self.main_logger.log(p, pmsg)
-        return p, msg
+    def tail_log(self, cursor=0, priority=0, owner=False, maxn=None):
+        """Continue reading the log ring from `cursor`, as returned by the previous call.
+        Returns the next cursor and the log lines."""
+        return logring.log_ring.tail(cursor, priority, owner, maxn=maxn)
+
+    def flush_log(self):
+        """Emit new log ring lines on the main logger and write them to the log files"""
+        self.nlog, lines = logring.log_ring.tail(self.nlog)
+        # Skip text overwritten before being flushed
+        lines = [l for l in lines if l[3]]
+        if self.log_file:
+            self.log_file.write(lines)
+        for t, p, o, msg in lines:
+            record = self.main_logger.makeRecord(self.main_logger.name, p, '', 0, msg, (), None)
+            record.created = t
+            record.msecs = (t % 1) * 1000
+            self.main_logger.handle(record)
+            if self.file_logger:
+                self.file_logger.handle(record)
+
+    def _sink_log(self):
+        while self._sink:
+            self.flush_log()
+            sleep(self.log_flush_interval)
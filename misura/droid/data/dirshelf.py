@@ -3,9 +3,10 @@
 import os
 import shutil
 from cPickle import HIGHEST_PROTOCOL
-from copy import deepcopy
-from filebuffer import FileBuffer
+from filebuffer import FileBuffer, default_durability, copy_meta
+from discovery import get_registry
 from .. import utils
+from .. import parameters as params
 
 
 def new_name(base):
@@ -24,10 +25,17 @@ class DirShelf(FileBuffer):
     Each key is saved/red to/from a file in a directory (possibly in the shared memory space /dev/shm.
     Keys must be valid file names. Values are automatically pickled/unpickled. """
     dir = False
-
-    def __init__(self, basedir, viewdir=False, desc=False, protocol=HIGHEST_PROTOCOL, private_cache=False, **k):
-        """`basedir`: RAM directory for sharing object pickles and current values"""
-        super(DirShelf, self).__init__(private_cache=private_cache)
+    lockfree = True
+    type_codecs = {'Float': 'd', 'Integer': 'q', 'Boolean': '?'}
+    """FileBuffer storage codecs for scalar option types. Other types are pickled."""
+
+    def __init__(self, basedir, viewdir=False, desc=False, protocol=HIGHEST_PROTOCOL, private_cache=False, 
+                 durability=False, **k):
+        """`basedir`: RAM directory for sharing object pickles and current values
+        `durability`: FileBuffer durability level. Defaults to params.shelf_durability, 
+        or to the one suitable for the filesystem of `basedir`."""
+        durability = durability or params.shelf_durability or default_durability(basedir)
+        super(DirShelf, self).__init__(private_cache=private_cache, durability=durability)
         self.idx_entries = 100
         if not basedir.endswith(sep):
             basedir += sep
@@ -48,6 +56,7 @@ class DirShelf(FileBuffer):
 
     def close(self):
         FileBuffer.close(self, self.dir, hard=True)
+        get_registry(self.basedir).forget(self.dir)
         if not os.path.exists(self.dir):
             return True
         shutil.rmtree(self.dir, ignore_errors=True)
@@ -69,19 +78,29 @@ class DirShelf(FileBuffer):
             return os.path.join(self.dir, 'self')
         return os.path.join(self.dir, str(key), 'self')
 
+    def split(self, key, val):
+        """Separate option `val` into its metadata and current value"""
+        val = copy_meta(val)
+        cur = val.pop('current')
+        #if val['type']=='Empty':
+        #    val.pop('factory_default')
+        if val['handle'] != key:
+            print('Handle mismatch: {} {} {}'.format(key, val['handle'], self.dir))
+            val['handle'] = key
+        return val, cur
+
     def set(self, key, val, t=-1, newmeta=True):
+        codec = None
         if newmeta:
-            val = deepcopy(val)
-            cur = val.pop('current')
-            #if val['type']=='Empty':
-            #    val.pop('factory_default')
-            if val['handle'] != key:
-                print('Handle mismatch: {} {} {}'.format(key, val['handle'], self.dir))
-                val['handle'] = key
-            newmeta = val
+            newmeta, cur = self.split(key, val)
+            codec = self.type_codecs.get(newmeta['type'], 'p')
         else:
             cur = val
-        self.write(self.fp(key), cur, t=t, newmeta=newmeta)
+        path = self.fp(key)
+        self.write(path, cur, t=t, newmeta=newmeta, codec=codec)
+        # Announce options to be recorded to ReferenceUpdater
+        if newmeta and ('History' in newmeta.get('attr', []) or newmeta['type'] == 'RoleIO'):
+            get_registry(self.basedir).add(path)
         
     __setitem__ = set
 
@@ -106,6 +125,7 @@ class DirShelf(FileBuffer):
     def __delitem__(self, key):
         path = self.dir + key
         super(DirShelf,self).close(path)
+        get_registry(self.basedir).forget(path)
         shutil.rmtree(path)
 
     def update(self, desc):
@@ -120,8 +140,15 @@ class DirShelf(FileBuffer):
             k.remove('self')
         return k
 
-    def items(self, key=''):
-        return [(k, self.get(k)) for k in self.keys(key)]
+    def items(self, key='', meta=True):
+        """Snapshot of all (key, option) pairs, read in a single sweep. 
+        If not `meta`, only current values are returned."""
+        return self.file_items(self.keys(key), meta)
+
+    def file_items(self, keys, meta=True):
+        """Read all `keys` from their FileBuffer, skipping missing ones"""
+        items = self.latest_items([self.fp(k) for k in keys], meta)
+        return [(k, r[1]) for k, r in zip(keys, items) if r is not False]
     # Not real iterators, to save I/O
 
     def iteritems(self, key=''):
@@ -143,12 +170,9 @@ class DirShelf(FileBuffer):
     def values(self, key=''):
         return [it[1] for it in self.items(key)]
             
-    def copy(self, key=''):
+    def copy(self, key='', meta=True):
         """Returns a dictionary containing all items, mimicking dict.copy"""
-        res = {}
-        for k, v in self.items(key):
-            res[k] = v
-        return res
+        return dict(self.items(key, meta))
 
     def h_get(self, key, startIdx=0, endIdx=-1):
         """Returns key sequence from startIdx to endIdx"""
@@ -159,6 +183,11 @@ class DirShelf(FileBuffer):
 
     def h_time_at(self, key, idx=-1):
         """Returns the time of the last recorded point"""
+        # The latest time is notified by writers, without opening the buffer
+        if idx == -1:
+            t = self.latest_time(self.fp(key))
+            if t >= 0:
+                return t
         return self.time(self.fp(key), idx)
 
     def h_get_time(self, key, t):
@@ -174,10 +203,8 @@ class DirShelf(FileBuffer):
             t1 += t
         if t0 <= 0:
             t0 += t
-        # Get the index corresponding to oldest point
-        idx0 = self.h_get_time(key, t0)
-        # Get the index corresponding to newest point
-        idx1 = self.h_get_time(key, t1)
+        # Get the indexes corresponding to oldest and newest points
+        idx0, idx1 = self.get_time_range(self.fp(key), t0, t1)
 #       print 'h_get_history',t0,t1,idx0,idx1,self.time(self.fp(key),idx0),self.time(self.fp(key),idx1),self.fp(key)
 #       assert idx1>=idx0, 'invalid history {}!>={} for {}'.format(idx1, idx0, self.fp(key))
         v = self.h_get(key, idx0, idx1)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""Discovery of option paths to be recorded"""
+import os
+import struct
+import ctypes
+import ctypes.util
+
+
+class PathRegistry(object):
+    """Append-only list of option paths, in a file of `base` directory.
+    Any process can add paths, while readers follow the file incrementally."""
+    filename = 'recorded.reg'
+
+    def __init__(self, base):
+        self.path = os.path.join(base, self.filename)
+        self.added = set()
+        """Paths added by this instance"""
+        self.ino = None
+        """Inode of the registry file, which is removed with its directory"""
+        self.offset = 0
+        """Bytes of the registry file already read"""
+
+    def _check(self):
+        """Forget what was added or read if the registry file was replaced"""
+        try:
+            ino = os.stat(self.path).st_ino
+        except OSError:
+            ino = None
+        if ino != self.ino:
+            self.added = set()
+            self.offset = 0
+            self.ino = ino
+        return ino
+
+    def add(self, path):
+        """Register `path`, if not already added"""
+        self._check()
+        if path in self.added:
+            return False
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            # Appends of a single line are atomic
+            os.write(fd, path + '\n')
+            self.ino = os.fstat(fd).st_ino
+        finally:
+            os.close(fd)
+        self.added.add(path)
+        return True
+
+    def forget(self, prefix):
+        """Allow paths starting with `prefix` to be added again, after they were removed"""
+        self.added = set(p for p in self.added if not p.startswith(prefix))
+
+    def read(self):
+        """Paths registered since the last call, by any process"""
+        if self._check() is None:
+            return []
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        # Leave out a line being written
+        end = data.rfind('\n') + 1
+        self.offset += end
+        return data[:end].splitlines()
+
+
+registries = {}
+"""Registry of each base directory"""
+
+
+def get_registry(base):
+    reg = registries.get(base, None)
+    if reg is None:
+        reg = PathRegistry(base)
+        registries[base] = reg
+    return reg
+
+
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 04000
+event_struct = struct.Struct('iIII')  # watch descriptor, mask, cookie, name length
+
+libc = None
+if os.name != 'nt':
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        libc = None
+
+
+class DirWatch(object):
+    """Inotify watch of files named `name` in new subdirectories of watched directories.
+    Only the directories passed to add() are watched, with the subdirectories created later:
+    existing trees are never walked.
+    Where inotify is not available, no file is ever reported."""
+    mask = IN_CREATE | IN_MOVED_TO
+
+    def __init__(self, name='self'):
+        self.name = name
+        self.fd = -1
+        self.dirs = {}
+        """Watched directories by watch descriptor"""
+        self.watched = set()
+        self.failed = 0
+        """Number of directories which could not be watched"""
+        self.overflow = False
+        """Events were lost"""
+        if libc is None:
+            return
+        self.fd = libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            print('DirWatch: inotify not available', os.strerror(ctypes.get_errno()))
+
+    def add(self, d):
+        """Watch directory `d`. Returns False if it cannot be watched."""
+        if self.fd < 0:
+            return False
+        if d in self.watched:
+            return True
+        wd = libc.inotify_add_watch(self.fd, d, self.mask)
+        if wd < 0:
+            # Eg. ENOSPC if max_user_watches was exceeded
+            self.failed += 1
+            print('DirWatch: cannot watch', d, os.strerror(ctypes.get_errno()))
+            return False
+        self.dirs[wd] = d
+        self.watched.add(d)
+        return True
+
+    def add_new(self, d):
+        """Watch directory `d`, just created, and its subdirectories.
+        Returns the `name` files already found there."""
+        found = []
+        if not self.add(d):
+            return found
+        try:
+            names = os.listdir(d)
+        except OSError:
+            return found
+        for n in names:
+            sub = os.path.join(d, n)
+            if n == self.name:
+                found.append(sub)
+            elif os.path.isdir(sub):
+                found += self.add_new(sub)
+        return found
+
+    def rescan(self):
+        """Returns the `name` files in subdirectories of watched directories, after lost events"""
+        found = []
+        for d in list(self.watched):
+            try:
+                names = os.listdir(d)
+            except OSError:
+                continue
+            for n in names:
+                path = os.path.join(d, n, self.name)
+                if os.path.exists(path):
+                    found.append(path)
+        return found
+
+    def read(self):
+        """Returns `name` files created since the last call"""
+        found = []
+        while self.fd >= 0:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError:
+                # No more events
+                break
+            i = 0
+            while i < len(data):
+                wd, mask, cookie, n = event_struct.unpack_from(data, i)
+                name = data[i + event_struct.size:i + event_struct.size + n].rstrip('\0')
+                i += event_struct.size + n
+                if mask & IN_Q_OVERFLOW:
+                    self.overflow = True
+                    continue
+                if mask & IN_IGNORED:
+                    self.watched.discard(self.dirs.pop(wd, None))
+                    continue
+                d = self.dirs.get(wd, None)
+                if d is None:
+                    continue
+                path = os.path.join(d, name)
+                if mask & IN_ISDIR:
+                    # Files might be created before the new directory is watched
+                    found += self.add_new(path)
+                elif name == self.name:
+                    found.append(path)
+        if self.overflow:
+            self.overflow = False
+            print('DirWatch: lost events, listing watched directories', len(self.watched))
+            found += self.rescan()
+        # A file might be both listed and notified
+        return sorted(set(found))
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+        self.fd = -1
+        self.dirs = {}
+        self.watched = set()
@@ -2,20 +2,25 @@
 """Filesystem-level CircularBuffer implementation"""
 import os
 import mmap
+import struct
+import numbers
 import collections
 import numpy as np
-from cStringIO import StringIO
 import functools
+from zlib import crc32
 from traceback import print_exc
-from cPickle import dump, dumps, loads, HIGHEST_PROTOCOL
+from cPickle import dump, dumps, loads, HIGHEST_PROTOCOL, UnpicklingError
 import exceptions
 import multiprocessing
+import threading
 from time import time, sleep
-from random import random
+from random import random, randint
+from copy import copy
 
 from misura.canon import csutil
 
 from misura.droid import utils
+from notifier import ChangeNotifier
 from __builtin__ import False
 from misura.canon.csutil import sharedProcessResources
 
@@ -31,21 +36,124 @@ LOCK_NBSH = 4
 LOCK_NBEX = 6
 
 flags = os.O_RDWR
-if not isWindows:
-    flags |= os.O_SYNC
+sync_flags = flags | getattr(os, 'O_SYNC', 0)
+"""Open flags for `strict` durability"""
+
+DURABILITY_NONE = 'none'
+"""Never sync: data cannot survive a reboot anyway (tmpfs)"""
+DURABILITY_PERIODIC = 'periodic'
+"""Sync written buffers every few seconds, from a background thread"""
+DURABILITY_STRICT = 'strict'
+"""Synchronous writes, flushed at the end of each write"""
+durability_levels = (DURABILITY_NONE, DURABILITY_PERIODIC, DURABILITY_STRICT)
+
+volatile_fs = ('tmpfs', 'ramfs')
+_mounts = []
+
+
+def mounts():
+    """Return (mount point, filesystem type) pairs, longest mount points first"""
+    if _mounts or isWindows:
+        return _mounts
+    try:
+        for line in open('/proc/mounts'):
+            dev, mount, fstype = line.split()[:3]
+            # Spaces in mount points are octal-escaped
+            _mounts.append((mount.decode('string_escape'), fstype))
+    except:
+        print_exc()
+    _mounts.sort(key=lambda m: -len(m[0]))
+    return _mounts
+
+
+def on_tmpfs(path):
+    """Check if `path` resides on a RAM filesystem"""
+    path = os.path.realpath(path)
+    for mount, fstype in mounts():
+        if path == mount or path.startswith(mount.rstrip('/') + '/'):
+            return fstype in volatile_fs
+    return False
+
+
+def default_durability(path):
+    """No syncing for RAM filesystems, strict otherwise"""
+    if on_tmpfs(path):
+        return DURABILITY_NONE
+    return DURABILITY_STRICT
+
+
+class PeriodicSync(object):
+    """Background thread syncing written buffers to disk every `interval` seconds"""
+    interval = 2.
+
+    def __init__(self):
+        self.pid = -1
+
+    def reset(self):
+        """(Re)start in the current process. Locks and threads are not inherited by children."""
+        self.pid = os.getpid()
+        self.paths = set()
+        self.mutex = threading.Lock()
+        self.thread = threading.Thread(target=self.loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, path):
+        """Schedule `path` for syncing"""
+        if self.pid != os.getpid():
+            self.reset()
+        self.mutex.acquire()
+        self.paths.add(path)
+        self.mutex.release()
+
+    def sync(self):
+        """Sync all scheduled paths. Returns their number."""
+        if self.pid != os.getpid():
+            return 0
+        self.mutex.acquire()
+        paths, self.paths = self.paths, set()
+        self.mutex.release()
+        for path in paths:
+            try:
+                fd = os.open(path, flags)
+            except OSError:
+                # Removed meanwhile
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        return len(paths)
+
+    def loop(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.sync()
+            except:
+                print_exc()
+
+periodic_sync = PeriodicSync()
 
 
 class SharedMemoryLock(object):
     """In-memory registry for file locking statuses.
-    Makes file-locking fast and fully cross-platform."""
+    Makes file-locking fast and fully cross-platform.
+    Statuses and owner pids are kept in two shared arrays, 
+    guarded by a small pool of striped mutexes."""
     timeout = 5
+    stripes = 64
+    """Number of mutexes guarding the status array"""
     
     def __init__(self, N=LOCKS_CACHE):
         self.name = '{}-{}'.format(multiprocessing.current_process().pid, random())
         self.cache = {}
         self.free = set(range(N))
-        # 0=free address, 1=unlocked, 2=locked
-        self.locks = [multiprocessing.Value('i') for i in self.free]
+        # 0=free address, 1=unlocked, 2=shared, 3=exclusive
+        self.locks = multiprocessing.RawArray('i', N)
+        # Pid of the latest process locking each address
+        self.owners = multiprocessing.RawArray('i', N)
+        self.mutexes = [multiprocessing.Lock() for i in range(self.stripes)]
 
     def _read(self, path):
         try:
@@ -65,10 +173,38 @@ class SharedMemoryLock(object):
         assert idx>=0, 'Cannot find path lock '+path
         return idx
 
+    def address(self, path):
+        """Locking address of `path`, or -1 if it was never initialized"""
+        idx = self.cache.get(path, -1)
+        if idx < 0 and os.path.exists(path + '.lk'):
+            idx = self._read(path)
+        return idx
+
+    def _mutex(self, idx):
+        return self.mutexes[idx % len(self.mutexes)]
+
+    def cas(self, idx, old, new):
+        """Set address `idx` to `new` status only if it was `old`.
+        Returns True on success."""
+        mutex = self._mutex(idx)
+        mutex.acquire()
+        try:
+            if self.locks[idx] != old:
+                return False
+            self.locks[idx] = new
+            self.owners[idx] = os.getpid() if new > LOCK_UN else 0
+            return True
+        finally:
+            mutex.release()
+
     def unlock(self, path):
         """Set `path` to unlocked"""
         idx = self._idx(path)
-        self.locks[idx].value = LOCK_UN 
+        mutex = self._mutex(idx)
+        mutex.acquire()
+        self.locks[idx] = LOCK_UN
+        self.owners[idx] = 0
+        mutex.release()
         return True
 
     def lock(self, path, value=LOCK_EX, timeout=-1):
@@ -80,112 +216,72 @@ class SharedMemoryLock(object):
             return self.clear(path)
 
         idx = self._idx(path)
-        lk = self.locks[idx]
-        self._lock(path, value, idx, lk, timeout=timeout)
-        lk.value = value
-        try:
-            lk.get_lock().release()
-        except:
-            pass 
-        return True
-        
-    def _lock(self, path, value, idx, lk, timeout=-1):
-        # On successful result, lock should remain acquired
-        lk.get_lock().acquire()
-        old = lk.value
-        if old == LOCK_FR:
-            lk.get_lock().release()
-            raise exceptions.MemoryError('FileBuffer lock address is unassigned {} {} {} {}'.format(idx,
-                                                                                                 path,
-                                                                                                 old,
-                                                                                                 value))
-
-        # If unlocked, apply right away
-        if old == LOCK_UN:
-            return True
-
-        if timeout < 0:
-            timeout = self.timeout
-
         # Check if operation is non-blocking
         nonblock = value > 3
         if nonblock:
             value /= 2
-
-        # Can overlock with shared
-        if old == value == LOCK_SH:
-            return True
-
-        # Wait for exclusive lock to go away
-        # Or a shared lock if we are trying to get an exclusive lock
+        if timeout < 0:
+            timeout = self.timeout
+        mutex = self._mutex(idx)
         t0 = -1
-        while (not nonblock) and (lk.value == LOCK_EX or (value == LOCK_EX and lk.value == LOCK_SH)):
-            lk.get_lock().release()
+        while True:
+            mutex.acquire()
+            old = self.locks[idx]
+            owner = self.owners[idx]
+            # If unlocked, apply right away. Can overlock with shared.
+            if old == LOCK_UN or (old == value == LOCK_SH):
+                self.locks[idx] = value
+                self.owners[idx] = os.getpid()
+                mutex.release()
+                if t0 > 0:
+                    print('SharedMemoryLock.lock WAITED', time() - t0, path, value)
+                return True
+            mutex.release()
+            if old == LOCK_FR:
+                raise exceptions.MemoryError('FileBuffer lock address is unassigned {} {} {} {}'.format(idx,
+                                                                                                     path,
+                                                                                                     old,
+                                                                                                     value))
+            # Reclaim locks left by dead processes
+            if owner > 0 and not utils.check_pid(owner):
+                print('SharedMemoryLock.lock: reclaiming lock of dead process', owner, path, old)
+                self.cas(idx, old, LOCK_UN)
+                continue
+            if nonblock:
+                return False
             if t0 < 0:
                 t0 = time()
             elif time() - t0 > timeout:
                 break
             sleep(random() * 0.002)
-            # Recover lock
-            lk.get_lock().acquire()
-            if lk.value == LOCK_UN or (value==LOCK_SH==lk.value):
-                if t0 > 0:
-                    print('SharedMemoryLock.lock WAITED', time() - t0, path, value)
-                return True
-        
-        old = lk.value
+
         print('SharedMemoryLock.lock TIMEOUT', time() - t0, path, value, old)
-        
-        try: 
-            lk.get_lock().release()
-        except:
-            print_exc()
-            
         # Cannot lock anyway with exclusive
         if old == LOCK_EX:
-            if nonblock:
-                return False
             raise exceptions.MemoryError(
                 'FileBuffer is ex-locked {} {} {}'.format(idx, 
                                                           path, 
                                                           value))
-        if value == LOCK_EX and old == LOCK_SH:
-            if nonblock:
-                return False
-            raise exceptions.MemoryError(
-                'FileBuffer is sh-locked, cannot ex-lock {} {}'.format(idx, 
-                                                                          path))
-        if nonblock:
-            return False
-        raise exceptions.MemoryError('Undetermined error while locking {} {} {} {}'.format(idx, 
-                                                                                           path, 
-                                                                                           value, 
-                                                                                           old))
+        raise exceptions.MemoryError(
+            'FileBuffer is sh-locked, cannot ex-lock {} {}'.format(idx, 
+                                                                   path))
 
     def refresh(self):
         """Refresh free addresses set"""
-        self.free = set()
-        for i, lock in enumerate(self.locks):
-            if lock.value == LOCK_FR:
-                self.free.add(i)
+        states = np.frombuffer(self.locks, dtype=np.int32)
+        self.free = set(np.flatnonzero(states == LOCK_FR).tolist())
         assert len(self.free) > 0, 'OUT OF FREE LOCK ADDRESSES!'
 
     def new(self, path):
         """Init a new lock on `path`"""
-        idx = -1
-        
-        while len(self.free):
-            idx0 = self.free.pop()
-            # Should stop immediately unless parallel process reserved
-            # some other addresses
-            if self.locks[idx].value == LOCK_FR:
-                idx = idx0
+        while True:
+            if not self.free:
+                self.refresh()
+            idx = self.free.pop()
+            # Should succeed immediately unless parallel process reserved
+            # the same address
+            if self.cas(idx, LOCK_FR, LOCK_UN):
                 break
-        if idx < 0:
-            self.refresh()
-            # Repeat
-            return self.new(path)
-        self.locks[idx].value = LOCK_UN
         self.cache[path] = idx
         fo = open(path + '.lk', 'wb')
         fo.write(str(idx))
@@ -194,7 +290,11 @@ class SharedMemoryLock(object):
     def clear(self, path):
         """Free the path's locking address."""
         idx = self._idx(path)
-        self.locks[idx].value = LOCK_FR
+        mutex = self._mutex(idx)
+        mutex.acquire()
+        self.locks[idx] = LOCK_FR
+        self.owners[idx] = 0
+        mutex.release()
         if path in self.cache:
             self.cache.pop(path)
         #if os.path.exists(path + '.lk'):
@@ -202,8 +302,8 @@ class SharedMemoryLock(object):
         
     def unlock_all(self):
         """Reset the locker. Use only for unit testing"""
-        for lk in self.locks:
-            lk.value = LOCK_FR
+        np.frombuffer(self.locks, dtype=np.int32)[:] = LOCK_FR
+        np.frombuffer(self.owners, dtype=np.int32)[:] = 0
         for path in self.cache:
             if os.path.exists(path+'.lk'):
                 os.remove(path+'.lk')
@@ -223,6 +323,33 @@ def restore_locker(lk):
 
 csutil.sharedProcessResources.register(restore_locker, locker)
 
+notifier = ChangeNotifier(LOCKS_CACHE)
+"""Change events of all FileBuffer writes, by locking address"""
+
+def restore_notifier(nt):
+    global notifier
+    notifier = nt
+    
+csutil.sharedProcessResources.register(restore_notifier, notifier)
+
+
+torn_read_errors = (IndexError, ValueError, TypeError, KeyError, AttributeError, ImportError, 
+                    EOFError, struct.error, UnpicklingError)
+"""Errors raised by decoding data while it is being overwritten"""
+
+
+def copy_meta(meta):
+    """Copy metadata `meta`, a dict or an option object, down to its container values.
+    Unlike copy(), option objects do not share their entry."""
+    if isinstance(meta, dict):
+        return {k: copy(v) if isinstance(v, (list, dict)) else v for k, v in meta.iteritems()}
+    if not hasattr(meta, '__dict__'):
+        return copy(meta)
+    r = meta.__class__.__new__(meta.__class__)
+    for k, v in meta.__dict__.iteritems():
+        r.__dict__[k] = copy_meta(v) if isinstance(v, dict) else v
+    return r
+
 
 def exclusive(func, lock=LOCK_EX):
     """Decorator for FileBuffer fopen/fclose management"""
@@ -243,16 +370,24 @@ def exclusive(func, lock=LOCK_EX):
 
 
 def shared(func):
-    """fopen with shared locking"""
-    return exclusive(func, lock=LOCK_SH)
+    """fopen with shared locking, or lock-free reading if the FileBuffer is `lockfree`"""
+    locked = exclusive(func, lock=LOCK_SH)
+
+    @functools.wraps(func)
+    def shared_wrapper(self, path, *a, **k):
+        if self.lockfree:
+            return self.optimistic(locked, func, path, *a, **k)
+        return locked(self, path, *a, **k)
+    return shared_wrapper
 
 
 def clean_cache(obj):
-    """Shrink cache to its maximum length by closing oldest files."""
+    """Shrink cache to its maximum length by closing least recently used files."""
     i = 0
     for i in range(0, len(obj.cache) - obj.cache_len):
-        # remove and close the first inserted item
-        oldp, oldfd = obj.cache.popitem(False)
+        # remove and close the first inserted item.
+        # The mapping is released as soon as it is not referenced anymore.
+        oldp, (oldfd, oldmm, oldino) = obj.cache.popitem(False)
         os.close(oldfd)
     #locker.refresh()
     return i
@@ -264,20 +399,68 @@ class FileBuffer(object):
     protocol = HIGHEST_PROTOCOL
     separator = '\n#$#$#$#\n'
     sep_len = len(separator)
-    idx_fmt = '{:<20f}\t{:<11}\t{:<11}\n'  # time, start byte, end byte
-    info_fmt = '{:<3}\t{:<22}\t{:<17f}\n'  # latest idx, total, last mod. time
+    magic = 'FBIX'
+    """Binary layout signature, at the very beginning of the file"""
+    version = 3
+    """Binary layout version. Text-indexed buffers are version 1."""
+    info_struct = struct.Struct('<4sIqqd')  # magic, version, latest idx, total, last mod. time
+    info_len = 64
+    """Header length"""
+    codec_offset = info_struct.size
+    """Header byte holding the storage codec"""
+    codec_dtypes = {'d': np.dtype('<f8'), 'q': np.dtype('<i8'), '?': np.dtype('?')}
+    """Typed codecs, storing fixed-size binary records instead of pickles.
+    Values are converted when stored: 'd' reads back integers and booleans as floats,
+    'q' reads back booleans as integers."""
+    codec = 'p'
+    """Storage codec of the currently opened buffer: 'p' for pickle, or one of codec_dtypes"""
+    gen_struct = struct.Struct('<Q')
+    gen_offset = 40
+    """Header position of the write generation counter. It is odd while a write is in progress."""
+    meta_gen_struct = struct.Struct('<I')
+    meta_gen_offset = 36
+    """Header position of the metadata generation counter, bumped by each set_meta.
+    It starts from a random value, so a re-created file does not match cached metadata."""
+    meta_cache = {}
+    """Decoded metadata of each path, with its generation. Per PROCESS (class attribute!)"""
+    codec_failures = {}
+    """Codec and write count of the latest failed codec switch of each path. Per PROCESS (class attribute!)"""
+    ring_struct = struct.Struct('<qq')  # data ring capacity, absolute end of newest record
+    ring_offset = 48
+    """Header position of the data ring. Index entries hold absolute, ever-increasing
+    byte offsets: an entry is overwritten once the ring end moved a capacity past its start."""
+    lockfree = False
+    """Read without locking, retrying if a write happened meanwhile (seqlock)"""
+    durability = False
+    """One of durability_levels, or False to choose by filesystem type of each path"""
+    timeout = 5
+    """Maximum time a lock-free reader waits for a write to end"""
+    writing = False
+    """Currently opened buffer is being written"""
+    read_gen = None
+    """Write generation of the optimistic read in progress"""
+    idx_struct = struct.Struct('<dqq')  # time, start byte, end byte
+    idx_dtype = np.dtype([('t', '<f8'), ('start', '<i8'), ('end', '<i8')])
+    idx_len = idx_struct.size
     meta_len = 5120  # 5k of reserved metadata space (scripts!!!)
-    idx_len = len(idx_fmt.format(0., 0, 0))
-    assert idx_len == len(info_fmt.format(0, 0, 0))
     idx_entries = 100
     """Maximum number of entries to keep in history. Set this *before* any use of FileBuffer."""
-    invalid = '#'
-    empty_entry = invalid + ' ' * (idx_len - 2) + '\n'
+    empty_entry = idx_struct.pack(-1, -1, -1)
+    # Version 1 text layout, still readable and migrated on first exclusive open
+    legacy_idx_fmt = '{:<20f}\t{:<11}\t{:<11}\n'
+    legacy_info_fmt = '{:<3}\t{:<22}\t{:<17f}\n'
+    legacy_idx_len = len(legacy_idx_fmt.format(0., 0, 0))
+    legacy_invalid = '#'
+    legacy_start_meta_position = legacy_idx_len * (idx_entries + 1)
+    legacy_start_position = legacy_start_meta_position + meta_len
+    legacy = False
+    """Currently opened buffer uses the text layout"""
     max_size = 2 * 10**6
-    cache = collections.OrderedDict()  # {path: (mmap,(fileno, lock_fileno))}
-    # maximum number of opened file descriptors, per PROCESS (class attribute!)
+    """Maximum data ring capacity preallocated for pickled records"""
+    cache = collections.OrderedDict()  # {path: (fileno, mmap, inode)}, least recently used first
+    # maximum number of opened file descriptors and mappings, per PROCESS (class attribute!)
     cache_len = 500
-    start_meta_position = idx_len * (idx_entries + 1)
+    start_meta_position = info_len + idx_len * idx_entries
     """Metadata block start byte"""
     start_position = start_meta_position + meta_len
     """Queue start byte"""
@@ -289,12 +472,17 @@ class FileBuffer(object):
     fd = -1
     mm = False
 
-    def __init__(self, private_cache=False):
+    def __init__(self, private_cache=False, durability=False):
         """private_cache: use global FileBuffer.cache and _lock class attributes if False, 
-        otherwise instantiated a new private cache and lock"""
+        otherwise instantiated a new private cache and lock.
+        durability: one of durability_levels, or False for automatic choice."""
+        if durability and durability not in durability_levels:
+            raise exceptions.ValueError('Unknown FileBuffer durability: {}'.format(durability))
+        self.durability = durability
+        self._durabilities = {}
         if private_cache:
             self._lock = multiprocessing.Lock()
-            self.cache = {}
+            self.cache = collections.OrderedDict()
         else:
             sharedProcessResources.register(self.restore_lock, self._lock)
         
@@ -305,52 +493,225 @@ class FileBuffer(object):
         result = self.__dict__.copy()
         if '_lock' in result:
             result.pop('_lock')
+        # File descriptors and mappings are meaningful only in this process
+        if 'cache' in result:
+            result['cache'] = collections.OrderedDict()
         return result
     
+    def get_durability(self, path):
+        """Durability level applying to `path`"""
+        if self.durability:
+            return self.durability
+        d = os.path.dirname(path)
+        r = self._durabilities.get(d, False)
+        if not r:
+            r = default_durability(d)
+            self._durabilities[d] = r
+        return r
+
+    def open_flags(self, path):
+        if self.get_durability(path) == DURABILITY_STRICT:
+            return sync_flags
+        return flags
+
     def init(self, path):
         """Initialize a storage file"""
         d = os.path.dirname(path)
         if not os.path.exists(d):
             os.makedirs(d)
         fo = open(path, 'wb')
-        # Write info line, init at -1
+        # Write info header, init at -1
         # so it will restart next append
-        fo.write(self.info_fmt.format(-1, 0, -1.0))
-        fo.write(self.empty_entry * self.idx_entries)
+        fo.write(self.pack_info(-1, 0, -1.0))
+        slots = (self.start_meta_position - self.info_len) // self.idx_len
+        fo.write(self.empty_entry * slots)
         fo.write(' ' * self.meta_len)
         fo.close()
         locker.new(path)
-
-    def remap(self, fd, path, lock):
-        if fd < 0:
-            return False
-        # Lock must precede mmap
+        notifier.forget(locker.cache[path], crc32(path))
+
+    def pack_info(self, high, count, mtime):
+        """Encode the info header"""
+        info = self.info_struct.pack(self.magic, self.version, high, count, mtime)
+        info += '\x00' * (self.meta_gen_offset - len(info))
+        info += self.meta_gen_struct.pack(randint(0, 2**32 - 1))
+        return info + '\x00' * (self.info_len - len(info))
+
+    def check_layout(self, lock):
+        """Detect text-indexed (version 1) buffers. 
+        They are migrated to the binary layout if `lock` is exclusive, 
+        otherwise they are read in legacy mode.
+        Unknown binary layout versions are refused."""
+        self.legacy = self.mm[:len(self.magic)] != self.magic
+        if not self.legacy:
+            version = self.info_struct.unpack_from(self.mm)[1]
+            if version != self.version:
+                raise exceptions.IOError('Unsupported FileBuffer layout version {} {}'.format(version,
+                                                                                             self.path))
+        elif lock in (LOCK_EX, LOCK_NBEX):
+            self.migrate()
+        return self.legacy
+
+    def _get_codec(self):
+        """Read the storage codec from the header"""
+        if self.legacy:
+            return 'p'
+        c = self.mm[self.codec_offset]
+        return c if c in self.codec_dtypes else 'p'
+
+    def _set_codec(self, codec):
+        self.mm[self.codec_offset] = codec
+        self.codec = codec
+
+    def _encode(self, val, codec=None):
+        """Encode `val` as a record with `codec`, or the current codec.
+        Returns None if `val` does not fit a typed codec."""
+        codec = codec or self.codec
+        if codec == 'p':
+            return self.separator + dumps(val, self.protocol)
+        integral = isinstance(val, (numbers.Integral, np.integer, np.bool_))
+        if codec == 'd':
+            if not (integral or isinstance(val, (numbers.Real, np.floating))):
+                return None
+            val = float(val)
+        elif not integral:
+            return None
+        elif codec == 'q':
+            val = int(val)
+        elif val not in (0, 1):
+            return None
         try:
-            locker.lock(path, lock)
-        except:
-            raise
-
-        try:
-            # Must re-map each time
-            self.mm = mmap.mmap(fd, length=0)
-        except:
-            locker.unlock(path)
+            return struct.pack('<' + codec, val)
+        except struct.error:
+            return None
+
+    def _decode(self, dat):
+        if self.codec == 'p':
+            return loads(dat)
+        return struct.unpack('<' + self.codec, dat)[0]
+
+    def _repack(self, codec, n=0):
+        """Rewrite all entries with storage `codec`, in a data ring fitting records of `n` bytes.
+        Returns False, leaving the buffer untouched, if any entry does not fit `codec`."""
+        times, objs = self._sequence_range(0, columns=True)
+        if isinstance(objs, np.ndarray):
+            objs = objs.tolist()
+        records = [self._encode(obj, codec) for obj in objs]
+        if None in records:
             return False
+        self._set_codec(codec)
+        self._reset_ring(self._ring_capacity(max([n] + [len(g) for g in records])))
+        for t, g in zip(times.tolist(), records):
+            self._append(g, t)
+        return True
 
-        self.fd = fd
+    def _layout_size(self):
+        """Minimum file size for the current header: the end of the data ring"""
+        return self.start_position + self._get_ring()[0]
+
+    def _get_ring(self):
+        """Return data ring capacity and absolute end of the newest record"""
+        return self.ring_struct.unpack_from(self.mm, self.ring_offset)
+
+    def _set_ring(self, capacity, head):
+        self.ring_struct.pack_into(self.mm, self.ring_offset, capacity, head)
+
+    def _ring_capacity(self, n):
+        """Data ring capacity suitable for records up to `n` bytes long"""
+        if self.codec != 'p':
+            # One fixed-size slot per index entry
+            return self.codec_dtypes[self.codec].itemsize * self.idx_entries
+        if n <= 0:
+            return 0
+        capacity = min(2 * n * self.idx_entries, self.max_size)
+        return max(capacity, 2 * n, mmap.PAGESIZE)
+
+    def _reset_ring(self, capacity):
+        """Empty the index and preallocate a data ring of `capacity` bytes"""
+        self.set_info(-1, 0, self.info[2])
+        self._set_ring(capacity, 0)
+        # The file is never shrinked, as lock-free readers might still map its tail.
+        size = self.start_position + capacity
+        if len(self.mm) < size:
+            self.mm.resize(size)
+            self.mm.seek(0)
+
+    def migrate(self):
+        """Rewrite the opened text-indexed buffer with the binary layout.
+        Valid records are appended as they are, from oldest to newest, to a new data ring."""
+        mm = self.mm
         self.info = self._get_info()
-        self.mm.seek(0)
-        self.path = path
+        records = [(t, mm[s - self.sep_len:e]) for t, s, e in self._idx_view().tolist() if s >= 0]
+        meta = mm[self.legacy_start_meta_position:self.legacy_start_position]
+        meta = meta.ljust(self.meta_len)
+        slots = (self.start_meta_position - self.info_len) // self.idx_len
+        mm[:self.start_position] = self.pack_info(-1, 0, self.info[2]) + self.empty_entry * slots + meta
+        self.legacy = False
+        self.codec = 'p'
+        self.info = self._get_info()
+        self._reset_ring(self._ring_capacity(max([0] + [len(g) for t, g in records])))
+        for t, g in records:
+            self._append(g, t)
+        print('FileBuffer.migrate: converted text index', self.path, len(records))
         return True
 
+    def mapped(self, lock):
+        """Read the header of the newly mapped buffer. 
+        Start a write generation if `lock` is exclusive."""
+        self.check_layout(lock)
+        self.info = self._get_info()
+        self.codec = self._get_codec()
+        if lock in (LOCK_EX, LOCK_NBEX):
+            self.writing = True
+            self._bump_generation()
+
+    def _get_generation(self):
+        return self.gen_struct.unpack_from(self.mm, self.gen_offset)[0]
+
+    def _bump_generation(self):
+        self.gen_struct.pack_into(self.mm, self.gen_offset, self._get_generation() + 1)
+
+    def _map(self, path):
+        """Return a live (fd, mmap) pair for `path`. 
+        The cached mapping is reused unless the file was replaced (eg: by clear()) 
+        or resized by another process."""
+        st = os.stat(path)
+        entry = self.cache.get(path, False)
+        if entry:
+            fd, mm, ino = entry
+            if ino == st.st_ino and len(mm) == st.st_size:
+                # Mark as most recently used
+                self.cache[path] = self.cache.pop(path)
+                return fd, mm
+            self.uncache(path)
+        fd = os.open(path, self.open_flags(path))
+        mm = mmap.mmap(fd, length=0)
+        # Manage caching
+        if self.cache_len > 0:
+            self.cache[path] = (fd, mm, os.fstat(fd).st_ino)
+            clean_cache(self)
+        return fd, mm
+
+    def uncache(self, path):
+        """Forget the cached mapping of `path`, closing its file descriptor"""
+        entry = self.cache.pop(path, False)
+        if entry:
+            os.close(entry[0])
+        return bool(entry)
+
+    def empty_cache(self):
+        """Close all cached files"""
+        self._lock.acquire()
+        try:
+            for path in self.cache.keys():
+                self.uncache(path)
+        finally:
+            self._lock.release()
+
     def fopen(self, path, lock=LOCK_EX):
         """Open a file in path, handling the locking"""
         self._lock.acquire()
 
-        fd = self.cache.get(path, -1)
-        if self.remap(fd, path, lock):
-            return self.mm, self.fd
-
         # Initialize the indexed file, if exclusive lock was required
         # (writing)
         ex = os.path.exists(path) and os.path.exists(path + '.lk')
@@ -369,20 +730,92 @@ class FileBuffer(object):
             self._lock.release()
             raise
 
+        try:
+            self.fd, self.mm = self._map(path)
+        except:
+            locker.unlock(path)
+            self._lock.release()
+            raise
         self.path = path
-        # Open the file descriptor
-        self.fd = os.open(path, flags)
-        # Create the memory map
-        self.mm = mmap.mmap(self.fd, length=0)
-
-        # Manage caching
-        if self.cache_len > 0:
-            clean_cache(self)
-            self.cache[path] = self.fd
 
-        self.info = self._get_info()
+        try:
+            self.mapped(lock)
+        except:
+            # Release both locks
+            self.fclose()
+            raise
+        self.mm.seek(0)
         return self.mm, self.fd
 
+    def optimistic(self, locked, func, path, *a, **k):
+        """Call `func` on `path` without locking, as a seqlock reader.
+        Retry with increasing sleeps while a write is in progress or ended meanwhile,
+        up to `timeout` seconds. Text-indexed buffers, lacking a generation counter, 
+        are read through the `locked` call."""
+        if not os.path.exists(path):
+            raise exceptions.KeyError('Non-existent FileBuffer for reading: ' + path)
+        self._lock.acquire()
+        try:
+            done, r = self._optimistic_path(func, path, *a, **k)
+        finally:
+            self._lock.release()
+        if done:
+            return r
+        print('FileBuffer.optimistic: locking text-indexed buffer', path)
+        return locked(self, path, *a, **k)
+
+    def _optimistic_path(self, func, path, *a, **k):
+        """Lock-free call of `func` on `path`, while holding the process lock.
+        Returns a (done, result) pair. Text-indexed buffers are not read (done=False)."""
+        try:
+            self.fd, self.mm = self._map(path)
+            self.path = path
+            if self.mm[:len(self.magic)] != self.magic:
+                return False, None
+            return True, self._optimistic(func, *a, **k)
+        finally:
+            self.mm = False
+            self.path = False
+            if self.cache_len <= 0 and self.fd >= 0:
+                os.close(self.fd)
+                self.fd = -1
+
+    def _optimistic(self, func, *a, **k):
+        t0 = time()
+        delay = 1e-5
+        while True:
+            gen = self._get_generation()
+            # Even generation: no write in progress.
+            # The writer might have grown the file after it was mapped.
+            if gen % 2 == 0 and self._layout_size() <= len(self.mm):
+                self.legacy = False
+                self.read_gen = gen
+                try:
+                    self.info = self._get_info()
+                    self.codec = self._get_codec()
+                    r = func(self, *a, **k)
+                except torn_read_errors:
+                    # Not caused by a concurrent write
+                    if self._get_generation() == gen:
+                        raise
+                    print('FileBuffer.optimistic: retrying torn read', self.path, gen)
+                else:
+                    if self._get_generation() == gen:
+                        return r
+                finally:
+                    self.read_gen = None
+            if time() - t0 > self.timeout:
+                print('FileBuffer.optimistic TIMEOUT', time() - t0, self.path, gen)
+                raise exceptions.MemoryError('FileBuffer write did not end {} {}'.format(self.path, 
+                                                                                        gen))
+            sleep(delay)
+            delay = min(2 * delay, 0.002)
+            # The writer might have grown or replaced the file
+            if self.cache_len <= 0:
+                os.close(self.fd)
+                self.fd = -1
+            self.fd, self.mm = self._map(self.path)
+
     @classmethod
     def empty_global_cache(cls):
         """Close all opened files."""
@@ -399,6 +832,9 @@ class FileBuffer(object):
             #    locker.clear(p)
             #fd = self.cache.pop(p)
             #os.close(fd)
+        if hard:
+            for p in [p for p in self.meta_cache if p.startswith(basepath)]:
+                self.meta_cache.pop(p, None)
         try:
             self._lock.release()
         except:
@@ -409,8 +845,15 @@ class FileBuffer(object):
         self.close()
 
     def fclose(self):
+        if self.writing and self.mm:
+            self._bump_generation()
+            durability = self.get_durability(self.path)
+            if durability == DURABILITY_STRICT:
+                self.mm.flush()  # needed to actually sync
+            elif durability == DURABILITY_PERIODIC:
+                periodic_sync.add(self.path)
+        self.writing = False
         if self.mm:
-            self.mm.flush()  # needed to actually sync
             self.mm = False
         if self.path:
             locker.unlock(self.path)
@@ -437,18 +880,23 @@ class FileBuffer(object):
         return self.info[2]
 
     def _get_info(self):
-        """Get the index info line"""
-        s = self.mm[:self.idx_len]
-        high, count, mtime = s.split('\t')
-        return int(high), int(count), float(mtime)
+        """Get the index info header"""
+        if self.legacy:
+            s = self.mm[:self.legacy_idx_len]
+            high, count, mtime = s.split('\t')
+            return int(high), int(count), float(mtime)
+        m, v, high, count, mtime = self.info_struct.unpack_from(self.mm)
+        return high, count, mtime
 
     @shared
     def get_info(self):
         return self._get_info()
 
     def set_info(self, *vals):
-        """Set the index info line"""
-        self.mm[:self.idx_len] = self.info_fmt.format(*vals)
+        """Set the index info header"""
+        self.mm[:self.info_struct.size] = self.info_struct.pack(self.magic, 
+                                                                self.version, 
+                                                                *vals)
         self.info = vals
 
     def __len__(self):
@@ -483,14 +931,30 @@ class FileBuffer(object):
         if idx < 0:
             print('Invalid index request', self.path, self.info, idx0, idx)
             return -1, -1, -1
-        # Always exclude the info line
-        start = (idx + 1) * self.idx_len
-        if self.mm[start] == self.invalid:  # invalid entry detected
-            #           print('Invalid index entry',self.path, idx0,idx)
+        if self.legacy:
+            return self._legacy_idx(idx)
+        # Always exclude the info header
+        t, s, e = self.idx_struct.unpack_from(self.mm, 
+                                              self.info_len + idx * self.idx_len)
+        capacity, head = self._get_ring()
+        # Invalid or overwritten entry detected
+        rec = s - self._record_offset()
+        if s < 0 or capacity <= 0 or rec < head - capacity:
+            return -1, -1, -1
+        # Absolute offsets to file positions
+        pos = self.start_position + rec % capacity - rec
+        return t, s + pos, e + pos
+
+    def _record_offset(self):
+        """Bytes preceding the data in each record: pickles are preceded by the separator"""
+        return self.sep_len if self.codec == 'p' else 0
+
+    def _legacy_idx(self, idx):
+        """Decode the text index line at absolute position `idx`"""
+        start = (idx + 1) * self.legacy_idx_len
+        if self.mm[start] == self.legacy_invalid:  # invalid entry detected
             return -1, -1, -1
-        end = start + self.idx_len
-        s = self.mm[start:end]
-        # Decode the index line
+        s = self.mm[start:start + self.legacy_idx_len]
         t, s, e = s.split('\t')
         return float(t), int(s), int(e)
 
@@ -501,24 +965,40 @@ class FileBuffer(object):
             print('Invalid index')
         return r
 
+    def _idx_view(self):
+        """Return the index as a structured array of `idx_dtype`, from oldest to newest, 
+        with start and end file positions.
+        Invalid and overwritten entries have negative time and start."""
+        N = len(self)
+        if self.legacy:
+            r = np.array([self._legacy_idx(i) for i in range(N)], dtype=self.idx_dtype)
+            return self._unwrap(r)
+        r = self._unwrap(np.frombuffer(self.mm, self.idx_dtype, N, self.info_len))
+        capacity, head = self._get_ring()
+        rec = r['start'] - self._record_offset()
+        invalid = (r['start'] < 0) | (rec < head - capacity)
+        pos = self.start_position + rec % max(capacity, 1) - rec
+        out = np.empty(N, dtype=self.idx_dtype)
+        out['t'] = np.where(invalid, -1, r['t'])
+        out['start'] = np.where(invalid, -1, r['start'] + pos)
+        out['end'] = np.where(invalid, -1, r['end'] + pos)
+        return out
+
+    def _unwrap(self, r):
+        """Reorder array `r`, following ring positions, from oldest to newest"""
+        high, count, mtime = self.info
+        # Oldest values come after high
+        if count > len(r):
+            r = np.concatenate((r[high + 1:], r[:high + 1]))
+        return r
+
     @shared
     def full_idx(self):
-        """Parse the full index into a numpy array"""
-        high, count, mtime = self.info
-        e = self.start_meta_position
-        if count <= high + 1:
-            e = count * self.idx_len
-        fidx = self.mm[self.idx_len:e]
-        # Invalid values are set to False in the output array
-        r = np.loadtxt(
-            StringIO(fidx), dtype=None, delimiter='\t', comments=self.invalid)
-        if count <= high + 1:
-            return r
-        # Newest values
-        r1 = r[:high]
-        # Oldest values
-        r0 = r[high:]
-        return np.concatenate((r0, r1))
+        """Decode the full index into a numpy array, from oldest to newest"""
+        r = self._idx_view()
+        r = np.array([r['t'], r['start'], r['end']]).transpose()
+        # Invalid entries are discarded from the output array
+        return r[r[:, 1] >= 0]
 
     def _time(self, idx):
         return self._get_idx(idx)[0]
@@ -527,20 +1007,51 @@ class FileBuffer(object):
     def time(self, idx):
         return self._time(idx)
 
-    def _get_time_idx(self, t):
+    def _get_time_idxs(self, *t):
+        """Find nearest indexes corresponding to each time in `t`, with a single search.
+        Times bigger than the last entry get -1 index."""
+        times = self._idx_view()['t']
+        t = np.array(t, dtype=float)
+        N = len(times)
+        if N < 2:
+            r = np.zeros(len(t), dtype=int)
+        else:
+            # Choose between the insertion point and its predecessor
+            r = times.searchsorted(t).clip(1, N - 1)
+            r -= (t - times[r - 1]) <= (times[r] - t)
         # If requested time is bigger than last entry, return -1 index
-        if t > self.info[2]:
-            #           print('Bigger time', self.info)
-            return -1
-        # bisect search using self._time handler
-        i = csutil.find_nearest_val(self, t, get=self._time)
-        return i
+        r[t > self.info[2]] = -1
+        return [int(i) for i in r]
+
+    def _get_time_idx(self, t):
+        return self._get_time_idxs(t)[0]
 
     @shared
     def get_time_idx(self, t):
         """Find nearest index corresponding to time `t`"""
         return self._get_time_idx(t)
 
+    @shared
+    def get_time_range(self, t0, t1):
+        """Find nearest indexes corresponding to times `t0` and `t1`"""
+        return self._get_time_idxs(t0, t1)
+
+    @shared
+    def newer(self, t):
+        """Return last modification time and the sequence of entries newer than `t`"""
+        i = self._get_newer_idx(t)
+        if i < 0:
+            return self.mtime, []
+        return self.mtime, self._sequence(i)
+
+    def _get_newer_idx(self, t):
+        """Return the index of the first entry newer than `t`, or -1."""
+        times = self._idx_view()['t']
+        i = times.searchsorted(t, 'right')
+        if i >= len(times):
+            return -1
+        return int(i)
+
     def require_idx(self, idx0):
         """Return the first valid index starting from idx"""
         h, c, mt = self.info
@@ -560,65 +1071,109 @@ class FileBuffer(object):
         return idx, nt, ns, ne
 
     def set_idx(self, idx, t, start_byte, end_byte):
-        """Set index info at `idx`"""
+        """Set index info at `idx`, with absolute data ring offsets.
+        Overwritten entries need no invalidation, as readers compare them with the ring end."""
         idx = self.idx(idx)
         assert idx >= 0
-        idx_start = (idx + 1) * (self.idx_len)
+        idx_start = self.info_len + idx * self.idx_len
         # Intercept invalidation requests
         if start_byte < 0:
-            self.mm[idx_start] = self.invalid
+            self.mm[idx_start:idx_start + self.idx_len] = self.empty_entry
             return False
-        idx_end = idx_start + self.idx_len
-        # Invalidate old entries written after the current one, if they were
-        # overwritten
-        high, count, mtime = self.info
-        if high + 1 < count:
-            after = self.idx_entries - idx
-            nidx = 0  # start from oldest
-            # up to the remaining to the end of the stack
-            while nidx < after - 1:
-                nt, ns, ne = self._get_idx(nidx)
-                # Already invalid
-                if ns < 0:
-                    # Detect first run
-                    if high + 1 == count:
-                        break
-                    # Continue until next valid entry or end
-                    nidx += 1
-                    continue
-                # if the current entry ends after the next, invalidate the next
-                if end_byte >= ns:
-                    # print('invalidating',self.path,idx,nidx,end_byte,ns)
-                    self.set_idx(nidx, -1, -1, -1)
-                else:
-                    break
-                nidx += 1
-        # Eventually write the index
-        self.mm[idx_start:idx_end] = '{:<20f}\t{:<11}\t{:<11}\n'.format(
-            t, start_byte, end_byte)
+        self.mm[idx_start:idx_start + self.idx_len] = self.idx_struct.pack(t, start_byte, end_byte)
         return True
 
+    def latest_time(self, path):
+        """Time of the latest write to `path`, as notified by the writer, without opening it.
+        -1 if unknown."""
+        h = crc32(path)
+        idx = locker.address(path)
+        if idx >= 0 and notifier.owners[idx] != h:
+            # The address was reassigned since it was cached
+            locker.cache.pop(path, None)
+            idx = locker.address(path)
+        if idx < 0 or notifier.owners[idx] != h:
+            return -1
+        return notifier.latest[idx]
+
+    def _get_meta_generation(self):
+        return self.meta_gen_struct.unpack_from(self.mm, self.meta_gen_offset)[0]
+
     def _set_meta(self, meta):
         self.mm.seek(self.start_meta_position)
         dump(meta, self.mm, self.protocol)
         self.mm.seek(0)
+        # Invalidate cached metadata, after it was written
+        gen = (self._get_meta_generation() + 1) % 2**32
+        self.meta_gen_struct.pack_into(self.mm, self.meta_gen_offset, gen)
+
+    def _meta_changed(self, meta):
+        """Check if `meta` differs from the stored metadata, 
+        so that unchanged options only touch the value ring."""
+        # Never written
+        if self.mm[self.start_meta_position] == ' ':
+            return True
+        try:
+            return self._get_meta() != meta
+        except torn_read_errors:
+            return True
 
     @exclusive
     def set_meta(self, meta):
         return self._set_meta(meta)
 
     @exclusive
-    def write(self, val, t=-1, newmeta=False):
-        """Append value to path."""
+    def write(self, val, t=-1, newmeta=False, codec=None):
+        """Append value to path. 
+        `codec` selects the storage format, if different from the current one.
+        Values stored by a typed codec are read back converted (see codec_dtypes)."""
+        # Keep the current codec if the new value or the history do not fit
+        if codec and codec != self.codec and self._encode(val, codec) is not None:
+            self._switch_codec(codec)
+        g = self._encode(val)
+        # Value does not fit the typed codec: fall back to pickle
+        if g is None:
+            self._repack('p')
+            g = self._encode(val)
+        self._append(g, t)
+        if newmeta and self._meta_changed(newmeta):
+            self._set_meta(newmeta)
+        notifier.publish(locker.cache[self.path], self.info[2])
+        return True
+
+    def _switch_codec(self, codec):
+        """Repack with `codec`, unless it failed since the last rotation of the whole history"""
+        count = self.info[1]
+        failed = self.codec_failures.get(self.path, False)
+        # Entries which did not fit might still be in history
+        if failed and failed[0] == codec and 0 <= count - failed[1] < self.idx_entries:
+            return False
+        if self._repack(codec):
+            self.codec_failures.pop(self.path, None)
+            return True
+        self.codec_failures[self.path] = (codec, count)
+        return False
+
+    def _append(self, g, t=-1):
+        """Append encoded record `g` at time `t`, after the newest record in the data ring"""
+        n = len(g)
+        capacity, head = self._get_ring()
+        # Only records longer than the whole ring require to enlarge it
+        if n > capacity:
+            self._repack(self.codec, n)
+            capacity, head = self._get_ring()
+        # Records never straddle the end of the ring: restart from its beginning
+        start_byte0 = head
+        if head % capacity + n > capacity:
+            start_byte0 += capacity - head % capacity
+        end_byte = start_byte0 + n
+        pos = self.start_position + start_byte0 % capacity
+        self.mm[pos:pos + n] = g
         high, count, mtime = self.info
         # Start rewriting from 0
         if high >= self.idx_entries - 1 or high < 0:
-            start_byte0 = self.start_position
             high = 0
-        # End byte of the last entry as reference
         else:
-            t0, s, start_byte0 = self._get_idx(-1)
-            assert s > 0, 'FileProxy.write: corrupted entry during'
             high += 1
         count += 1
         # If time was not defined, get its value
@@ -626,20 +1181,8 @@ class FileBuffer(object):
             t = utils.time()
         # Write the info
         self.set_info(high, count, t)
-        start_byte = start_byte0 + self.sep_len
-        g = dumps(val, self.protocol)
-        lg = len(g)
-        end_byte = start_byte + lg
-        sz = len(self.mm)
-        res = end_byte - sz + 1
-        if res > 0:
-            self.mm.resize(sz + res)
-            self.mm.seek(0, os.SEEK_SET)
-#           print('Resizing',start_byte,sz,end_byte,res,len(fo),len(g))
-        self.mm[start_byte0:end_byte] = self.separator + g
-        self.set_idx(-1, t, start_byte, end_byte)
-        if newmeta:
-            self._set_meta(newmeta)
+        self.set_idx(-1, t, start_byte0 + self._record_offset(), end_byte)
+        self._set_ring(capacity, end_byte)
         return True
 
     def clear(self, path):
@@ -651,15 +1194,14 @@ class FileBuffer(object):
         # Collect latest metadata and value
         meta = self._get_meta()
         t, val = self._get_item(-1)
+        codec = self.codec
         self.fclose()
         # Remove from cache and FS
-        if self.cache_len > 0:
-            fd = self.cache.pop(path)
+        if self.uncache(path):
             locker.unlock(path)
-            os.close(fd)
         os.remove(path)
         # This will re-init a blank file with the latest values.
-        self.write(path, val, t, newmeta=meta)
+        self.write(path, val, t, newmeta=meta, codec=codec)
         return True
 
     def _get_item(self, idx):
@@ -670,7 +1212,7 @@ class FileBuffer(object):
             return False
         dat = self.mm[s:e]
         try:
-            obj = loads(dat)
+            obj = self._decode(dat)
         except:
             print('_get_item', self.path, t, s, e, dat)
             print_exc()
@@ -678,13 +1220,26 @@ class FileBuffer(object):
         return [t, obj]
 
     def _get_meta(self):
+        """Return a copy of the metadata, decoded only if changed since last call.
+        Values nested deeper than lists or dicts are shared with the cache."""
+        start = self.start_meta_position
+        if self.legacy:
+            start = self.legacy_start_meta_position
+            gen = -1
+        else:
+            gen = self._get_meta_generation()
+            cached = self.meta_cache.get(self.path, False)
+            if cached and cached[0] == gen:
+                return copy_meta(cached[1])
         try:
-            meta = loads(
-                self.mm[self.start_meta_position:self.start_meta_position + self.meta_len])
+            meta = loads(self.mm[start:start + self.meta_len])
         except:
             print('_get_meta')
             print_exc()
             raise
+        if gen >= 0:
+            self.meta_cache[self.path] = (gen, meta)
+            meta = copy_meta(meta)
         return meta
 
     @shared
@@ -703,6 +1258,41 @@ class FileBuffer(object):
             r[1] = m
         return r
 
+    def _latest(self, meta=True):
+        """Latest item, optionally with metadata (see get_item)"""
+        r = self._get_item(-1)
+        if r is not False and meta:
+            m = self._get_meta()
+            m['current'] = r[1]
+            r[1] = m
+        return r
+
+    def latest_items(self, paths, meta=True):
+        """Get latest items of all `paths` in a single sweep, 
+        holding the process lock once if `lockfree`.
+        Returns a list of [time, value] items (see get_item), False for missing paths."""
+        if not self.lockfree:
+            return [self.get_item(path, -1, meta) if os.path.exists(path) else False for path in paths]
+        out = []
+        locked = []
+        self._lock.acquire()
+        try:
+            for path in paths:
+                try:
+                    done, r = self._optimistic_path(FileBuffer._latest, path, meta)
+                except OSError:
+                    # Removed meanwhile
+                    done, r = True, False
+                if not done:
+                    locked.append(len(out))
+                out.append(r)
+        finally:
+            self._lock.release()
+        # Text-indexed buffers
+        for i in locked:
+            out[i] = self.get_item(paths[i], -1, meta)
+        return out
+
     def read(self, path, meta=True):
         """Get latest item"""
         r = self.get_item(path, -1, meta)
@@ -725,16 +1315,74 @@ class FileBuffer(object):
 #       print('SEQUENCING',s,e)
         if s == e:
             return [self._get_item(s)]
-        out = []
-        for i in range(s, e):
-            try:
-                out.append(self._get_item(i))
-            except:
-                print('trying to unpickle', self.path, i)
-                print_exc()
-#       print('Returning sequence',startIdx,endIdx,s,e,len(out),self.info)
-        return out
+        return self._sequence_range(s, e)
 
     @shared
     def sequence(self, *a, **k):
         return self._sequence(*a, **k)
+
+    def _sequence_range(self, start=0, end=None, columns=False):
+        """Decode all entries from `start` to `end` (excluded) in one pass, 
+        reading their whole data span with a single mmap slice.
+        Returns a list of [time, object] items, with False for invalid entries.
+        If `columns`, returns a (times array, objects list) pair of valid entries."""
+        N = len(self)
+        if start < 0:
+            start += N
+        if end is None:
+            end = N
+        elif end < 0:
+            end += N
+        idx = self._idx_view()[max(start, 0):max(end, 0)]
+        valid = idx['start'] >= 0
+        times = idx['t'][valid]
+        if self.codec != 'p':
+            # Typed records fill one fixed-size ring slot per index entry
+            vals = self._unwrap(np.frombuffer(self.mm, self.codec_dtypes[self.codec],
+                                              N, self.start_position))
+            # Copy out of the mmap, so the result outlives fclose()
+            vals = np.array(vals[max(start, 0):max(end, 0)][valid])
+            if columns:
+                return times, vals
+            return [[t, v] for t, v in zip(times.tolist(), vals.tolist())]
+        starts = idx['start'][valid]
+        ends = idx['end'][valid]
+        objs = []
+        decoded = np.ones(len(starts), dtype=bool)
+        # Entries are contiguous except where writing restarted from the beginning of the ring:
+        # read each contiguous run with a single slice
+        breaks = (np.nonzero(starts[1:] < ends[:-1])[0] + 1).tolist()
+        i = 0
+        for b0, b1 in zip([0] + breaks, breaks + [len(starts)]):
+            if b0 == b1:
+                continue
+            first = int(starts[b0])
+            span = self.mm[first:int(ends[b1 - 1])]
+            for s, e in zip((starts[b0:b1] - first).tolist(), (ends[b0:b1] - first).tolist()):
+                try:
+                    objs.append(self._decode(span[s:e]))
+                except:
+                    # Overwritten during an optimistic read: let it retry
+                    if self.read_gen is not None and self._get_generation() != self.read_gen:
+                        raise
+                    print('trying to unpickle', self.path, start + i)
+                    print_exc()
+                    objs.append(None)
+                    decoded[i] = False
+                i += 1
+        if columns:
+            return times[decoded], [o for o, d in zip(objs, decoded) if d]
+        out = []
+        i = 0
+        for t, v in zip(idx['t'].tolist(), valid.tolist()):
+            if not v:
+                out.append(False)
+                continue
+            if decoded[i]:
+                out.append([t, objs[i]])
+            i += 1
+        return out
+
+    @shared
+    def sequence_range(self, *a, **k):
+        return self._sequence_range(*a, **k)
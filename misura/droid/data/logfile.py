@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""Binary structured log files"""
+import os
+import struct
+import logging
+
+import numpy as np
+
+from .. import parameters as params
+
+magic = 'MLOG'
+version = 1
+header_struct = struct.Struct('<4sI')  # magic, version
+record_struct = struct.Struct('<IdiI')  # text length, time, priority, owner length
+index_dtype = np.dtype([('t', '<f8'), ('off', '<i8')])
+"""Sparse time index entry: time and file offset of a record"""
+
+
+def encode(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return str(s)
+
+
+def segments(path, backups=params.log_backup_count):
+    """Existing segment paths of log `path`, from the oldest to the newest"""
+    r = ['{}.{}'.format(path, i) for i in range(backups, 0, -1)] + [path]
+    return [p for p in r if os.path.exists(p)]
+
+
+class LogFile(object):
+    """Append-only binary log sink.
+    Records are length-prefixed: time, priority, owner and message.
+    Each segment has a sparse time index, in a sidecar `.idx` file.
+    Segments are rotated like logging.handlers.RotatingFileHandler:
+    `path`, `path.1`, ... `path.<backups>`."""
+    index_step = 64 * 1024
+    """Minimum bytes between time index entries"""
+
+    def __init__(self, path, max_size=params.log_file_dimension, backups=params.log_backup_count):
+        self.path = path
+        self.max_size = max_size
+        self.backups = backups
+        self.fd = False
+        self.idx = False
+        self.indexed = 0
+        """File offset of the latest index entry"""
+        self.latest = -np.inf
+        """Latest time written, keeping index times not decreasing"""
+        self.open()
+
+    def open(self):
+        d = os.path.dirname(self.path)
+        if d and not os.path.exists(d):
+            os.makedirs(d)
+        self.fd = open(self.path, 'ab')
+        self.idx = open(self.path + '.idx', 'ab')
+        if not self.fd.tell():
+            self.fd.write(header_struct.pack(magic, version))
+            self.fd.flush()
+        self.indexed = -self.index_step
+
+    def close(self):
+        if not self.fd:
+            return
+        self.fd.close()
+        self.idx.close()
+        self.fd = False
+        self.idx = False
+
+    def rotate(self):
+        """Start a new segment, shifting backups"""
+        self.close()
+        for i in range(self.backups - 1, 0, -1):
+            for ext in ('', '.idx'):
+                src = '{}.{}{}'.format(self.path, i, ext)
+                if os.path.exists(src):
+                    os.rename(src, '{}.{}{}'.format(self.path, i + 1, ext))
+        if self.backups:
+            os.rename(self.path, self.path + '.1')
+            os.rename(self.path + '.idx', self.path + '.1.idx')
+        else:
+            os.remove(self.path)
+            os.remove(self.path + '.idx')
+        self.open()
+
+    def write(self, lines):
+        """Append `lines` of [time, priority, owner, message]"""
+        for t, p, o, msg in lines:
+            o = encode(o)
+            text = o + encode(msg)
+            off = self.fd.tell()
+            if off + record_struct.size + len(text) > self.max_size and off > header_struct.size:
+                self.rotate()
+                off = self.fd.tell()
+            if off - self.indexed >= self.index_step:
+                # Records before `off` are not newer than the indexed time
+                self.idx.write(np.array([(max(t, self.latest), off)], dtype=index_dtype).tostring())
+                self.indexed = off
+            self.fd.write(record_struct.pack(len(text), t, p, len(o)) + text)
+            self.latest = max(t, self.latest)
+        self.fd.flush()
+        self.idx.flush()
+
+
+class LogReader(object):
+    """Reader of binary log files written by LogFile.
+    Records are decoded and formatted only when read."""
+
+    def __init__(self, path, backups=params.log_backup_count):
+        self.path = path
+        self.backups = backups
+
+    def index(self, segment):
+        """Sparse time index of `segment` path"""
+        idx = segment + '.idx'
+        if not os.path.exists(idx):
+            return np.array([], dtype=index_dtype)
+        with open(idx, 'rb') as fd:
+            data = fd.read()
+        # Ignore a partially written last entry
+        n = len(data) // index_dtype.itemsize * index_dtype.itemsize
+        return np.frombuffer(data[:n], dtype=index_dtype)
+
+    def _scan(self, segment, off, fromt, tot, priority, owner):
+        with open(segment, 'rb') as fd:
+            if off:
+                fd.seek(off)
+            elif fd.read(header_struct.size)[:4] != magic:
+                return
+            while True:
+                head = fd.read(record_struct.size)
+                if len(head) < record_struct.size:
+                    # Truncated last record
+                    return
+                n, t, p, olen = record_struct.unpack(head)
+                if tot is not None and t >= tot:
+                    # Stop the whole read
+                    yield None
+                    return
+                if t <= fromt or p < priority:
+                    fd.seek(n, 1)
+                    continue
+                if owner is not None:
+                    o = fd.read(olen)
+                    if o != owner:
+                        fd.seek(n - olen, 1)
+                        continue
+                    text = o + fd.read(n - olen)
+                else:
+                    text = fd.read(n)
+                if len(text) < n:
+                    return
+                yield [t, p, text[:olen].decode('utf-8', 'replace'),
+                       text[olen:].decode('utf-8', 'replace')]
+
+    def read(self, fromt=None, tot=None, priority=0, owner=None):
+        """Iterate over [time, priority, owner, message] records with time
+        greater than `fromt` and lower than `tot`, priority equal or bigger
+        than `priority` and emitted by `owner`, from the oldest."""
+        fromt = -np.inf if fromt is None else fromt
+        if owner is not None:
+            owner = encode(owner)
+        segs = segments(self.path, self.backups)
+        indexes = [self.index(s) for s in segs]
+        for i, seg in enumerate(segs):
+            # The next segment starts before `fromt`: skip this one
+            if i + 1 < len(segs) and len(indexes[i + 1]) and indexes[i + 1]['t'][0] <= fromt:
+                continue
+            idx = indexes[i]
+            off = 0
+            j = idx['t'].searchsorted(fromt, 'right') - 1
+            if j >= 0:
+                off = int(idx['off'][j])
+            for rec in self._scan(seg, off, fromt, tot, priority, owner):
+                if rec is None:
+                    return
+                yield rec
+
+    def format(self, fromt=None, tot=None, priority=0, owner=None, log_format=params.log_format):
+        """Iterate over text log lines formatted with `log_format`"""
+        formatter = logging.Formatter(log_format)
+        for t, p, o, msg in self.read(fromt, tot, priority, owner):
+            record = logging.LogRecord('misura', p, '', 0, msg, (), None)
+            record.created = t
+            record.msecs = (t % 1) * 1000
+            yield formatter.format(record)
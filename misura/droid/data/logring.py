@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""Shared-memory ring of the latest log lines"""
+import multiprocessing
+from time import time
+
+import numpy as np
+
+from .. import parameters as params
+from misura.canon import csutil, logger
+
+line_dtype = np.dtype([('t', np.float64),     # time
+                       ('k', np.float64),     # search key: time, raised to not decrease
+                       ('p', np.int32),       # priority
+                       ('o', np.int32),       # owner id
+                       ('off', np.int64),     # absolute text offset
+                       ('len', np.int32),     # text length
+                       ('olen', np.int32)])   # owner length, at the start of the text
+"""Structured layout of each indexed log line"""
+
+
+def encode(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return str(s)
+
+
+class LogRing(object):
+    """Append-only ring of log lines in shared memory.
+    Any process can append or search directly, without calls to the Database process.
+    Line fields are kept in a structured array, owners and messages in a separate text ring.
+    Lines are indexed on append by time, priority level bitmaps and interned owner ids.
+    Lines keep their own time, while searches use a key raised to the time of the previous line."""
+    levels = 6
+    """Number of priority levels (NOTSET to CRITICAL), each with its own bitmap"""
+    owners = 1024
+    """Size of the owners intern table"""
+    owner_size = 128
+    """Bytes of each owner name in the intern table"""
+    chunk = 1024
+    """Lines scanned at once by searches"""
+
+    def __init__(self, length=params.log_ring_length, text_size=params.log_ring_text):
+        # Bitmaps are made of whole bytes
+        self.length = (length + 7) // 8 * 8
+        self.text_size = text_size
+        self._lines = multiprocessing.RawArray('c', self.length * line_dtype.itemsize)
+        self._text = multiprocessing.RawArray('c', text_size)
+        self._bitmaps = multiprocessing.RawArray('c', self.levels * self.length // 8)
+        self._owner_names = multiprocessing.RawArray('c', self.owners * self.owner_size)
+        self.owner_count = multiprocessing.RawValue('i', 0)
+        # Local cache of interned owner ids, which never change
+        self._owner_ids = {}
+        # Total number of appended lines
+        self.seq = multiprocessing.RawValue('l', 0)
+        # Total number of written text bytes
+        self.end = multiprocessing.RawValue('l', 0)
+        self.lock = multiprocessing.Lock()
+
+    def __reduce__(self):
+        """Shared memory cannot be pickled: unpickled rings refer to the global one"""
+        return get_log_ring, ()
+
+    @property
+    def lines(self):
+        return np.frombuffer(self._lines, dtype=line_dtype)
+
+    @property
+    def text(self):
+        return np.frombuffer(self._text, dtype=np.uint8)
+
+    @property
+    def bitmaps(self):
+        """One bit per ring position for each priority level"""
+        return np.frombuffer(self._bitmaps, dtype=np.uint8).reshape(self.levels, -1)
+
+    def level(self, p):
+        """Bitmap index of priority `p`"""
+        return min(max(int(p) // 10, 0), self.levels - 1)
+
+    def _lookup(self, o):
+        """Id of encoded owner `o` in the intern table, -1 if missing"""
+        oid = self._owner_ids.get(o, -1)
+        if oid >= 0:
+            return oid
+        names = np.frombuffer(self._owner_names, dtype='S%i' % self.owner_size)
+        found = np.flatnonzero(names[:self.owner_count.value] == o[:self.owner_size])
+        if not len(found):
+            return -1
+        oid = int(found[0])
+        self._owner_ids[o] = oid
+        return oid
+
+    def _intern(self, o):
+        """Id of encoded owner `o`, added to the intern table if missing.
+        Returns -1 if the table is full. Must be called with the lock held."""
+        oid = self._lookup(o)
+        if oid >= 0:
+            return oid
+        oid = self.owner_count.value
+        if oid == self.owners:
+            return -1
+        a = oid * self.owner_size
+        name = o[:self.owner_size]
+        self._owner_names[a:a + len(name)] = name
+        self.owner_count.value = oid + 1
+        self._owner_ids[o] = oid
+        return oid
+
+    def append(self, t, p, o, msg):
+        """Append message `msg` emitted at time `t` with priority `p` by owner `o`.
+        Returns the line sequence number."""
+        o = encode(o)
+        data = np.frombuffer(o + encode(msg), dtype=np.uint8)
+        # Each line can take at most a quarter of the text ring
+        data = data[:self.text_size // 4]
+        n = len(data)
+        self.lock.acquire()
+        try:
+            seq = self.seq.value
+            off = self.end.value
+            a = off % self.text_size
+            b = min(a + n, self.text_size)
+            text = self.text
+            text[a:b] = data[:b - a]
+            text[:n - (b - a)] = data[b - a:]
+            lines = self.lines
+            pos = seq % self.length
+            k = t
+            if seq:
+                k = max(t, lines['k'][(seq - 1) % self.length])
+            lines[pos] = (t, k, p, self._intern(o), off, n, len(o))
+            bitmaps = self.bitmaps
+            bit = np.uint8(1 << (pos & 7))
+            bitmaps[:, pos >> 3] &= ~bit
+            bitmaps[self.level(p), pos >> 3] |= bit
+            self.end.value = off + n
+            self.seq.value = seq + 1
+        finally:
+            self.lock.release()
+        return seq
+
+    def put_log(self, *msg, **po):
+        """Format and append a log line.
+        Lines are emitted on the console and log files by the Database process."""
+        t, st, p, o, msg, pmsg = logger.formatMsg(*msg, **po)
+        self.append(t, p, o, pmsg)
+        return p, msg
+
+    def _rows(self, lines):
+        """Decode `lines` into [time, priority, owner, message] rows.
+        Lines whose text was overwritten get an empty owner and message."""
+        text = self.text
+        end = self.end.value
+        r = []
+        for t, k, p, oid, off, n, olen in lines:
+            if end - off > self.text_size:
+                r.append([float(t), int(p), '', ''])
+                continue
+            a = off % self.text_size
+            s = text[a:a + n].tostring()
+            if a + n > self.text_size:
+                s += text[:a + n - self.text_size].tostring()
+            r.append([float(t), int(p), s[:olen].decode('utf-8', 'replace'),
+                      s[olen:].decode('utf-8', 'replace')])
+        return r
+
+    def _find(self, t, lo, hi, side):
+        """Binary search of time `t` on the search keys between sequence numbers `lo` and `hi`.
+        Returns the first sequence number with key greater (`side`='right')
+        or not lower (`side`='left') than `t`."""
+        times = self.lines['k']
+        a = lo % self.length
+        b = min(a + hi - lo, self.length)
+        i = times[a:b].searchsorted(t, side)
+        if i < b - a:
+            return lo + i
+        return lo + i + times[:hi - lo - (b - a)].searchsorted(t, side)
+
+    def _select(self, lo, hi, priority=0, owner=False, maxn=None):
+        """Sequence numbers of lines between `lo` and `hi` with priority equal
+        or bigger than `priority` and emitted by `owner`.
+        Stops after `maxn` lines are found."""
+        lines = self.lines
+        found = []
+        if owner:
+            owner = encode(owner)
+            oid = self._lookup(owner)
+            # Owners missing from a table which is not full never logged
+            if oid < 0 and self.owner_count.value < self.owners:
+                return np.array([], dtype=np.int64)
+            # Ids shared by truncated or overflowing owners are checked on the text
+            exact = oid < 0 or len(owner) >= self.owner_size
+            owner = owner.decode('utf-8', 'replace')
+        n = 0
+        for a in xrange(lo, hi, self.chunk):
+            seq = np.arange(a, min(a + self.chunk, hi))
+            if priority > 0:
+                pos = seq % self.length
+                bits = np.bitwise_or.reduce(self.bitmaps[self.level(priority):, pos >> 3], axis=0)
+                seq = seq[(bits >> (pos & 7)) & 1 > 0]
+                seq = seq[lines['p'][seq % self.length] >= priority]
+            if owner:
+                seq = seq[lines['o'][seq % self.length] == oid]
+                if exact:
+                    rows = self._rows(lines[seq % self.length])
+                    seq = seq[np.array([r[2] == owner for r in rows], dtype=bool)]
+            found.append(seq)
+            n += len(seq)
+            if maxn and n >= maxn:
+                break
+        if not found:
+            return np.array([], dtype=np.int64)
+        return np.concatenate(found)[:maxn]
+
+    def search(self, fromt=False, priority=0, owner=False, tot=False, maxn=None):
+        """Search lines newer than `fromt` and older than `tot`,
+        with priority equal or bigger than `priority` and emitted by `owner`.
+        Without `fromt`, only the latest 10 lines are searched.
+        Returns the search key of the latest line, to be used as the next `fromt`,
+        and at most `maxn` matching rows."""
+        self.lock.acquire()
+        try:
+            cur = self.seq.value
+            if not cur:
+                return time(), []
+            lo = max(cur - self.length, 0)
+            if fromt:
+                lo = self._find(fromt, lo, cur, 'right')
+            else:
+                lo = max(lo, cur - 10)
+            hi = cur
+            if tot:
+                hi = self._find(tot, lo, cur, 'left')
+            seq = self._select(lo, hi, priority, owner, maxn)
+            rows = self._rows(self.lines[seq % self.length])
+            t = float(self.lines['k'][(cur - 1) % self.length])
+        finally:
+            self.lock.release()
+        return t, rows
+
+    def tail(self, cursor=0, priority=0, owner=False, maxn=None):
+        """Search lines appended from the `cursor` sequence number,
+        with priority equal or bigger than `priority` and emitted by `owner`.
+        Returns the cursor for the next call and at most `maxn` matching rows.
+        Only the latest `length` lines are retained."""
+        self.lock.acquire()
+        try:
+            cur = self.seq.value
+            lo = max(cursor, cur - self.length, 0)
+            seq = self._select(lo, cur, priority, owner, maxn)
+            if maxn and len(seq) == maxn:
+                cur = int(seq[-1]) + 1
+            return cur, self._rows(self.lines[seq % self.length])
+        finally:
+            self.lock.release()
+
+
+log_ring = LogRing()
+"""Log ring shared by all processes"""
+
+
+def get_log_ring():
+    return log_ring
+
+
+def restore_log_ring(lr):
+    global log_ring
+    log_ring = lr
+
+csutil.sharedProcessResources.register(restore_log_ring, log_ring)
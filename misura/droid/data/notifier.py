@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""Change notification channel for FileBuffer writers and readers"""
+import multiprocessing
+from time import time, sleep
+
+import numpy as np
+
+
+class ChangeNotifier(object):
+    """Shared ring of change events, published by FileBuffer writers.
+    Each event is the lock address of the written buffer (see SharedMemoryLock),
+    which identifies its path across processes.
+    Addresses are reused: readers check the path hash of the current owner.
+    Readers poll the shared event counter instead of modification times:
+    writers never wait for readers, which might be stopped or killed while waiting.
+    The time of the latest write to each address is also kept."""
+    capacity = 4096
+    """Number of events retained in the ring"""
+    poll_interval = 0.01
+    """Seconds between checks of the event counter by waiting readers"""
+
+    def __init__(self, N, capacity=0):
+        """`N`: number of lock addresses"""
+        if capacity:
+            self.capacity = capacity
+        self.events = multiprocessing.RawArray('i', self.capacity)
+        # Total number of published events
+        self.seq = multiprocessing.RawValue('l', 0)
+        # Time of the latest write for each address, -1 if unknown
+        self.latest = multiprocessing.RawArray('d', N)
+        np.frombuffer(self.latest, dtype=np.float64)[:] = -1
+        # Hash of the path currently assigned to each address
+        self.owners = multiprocessing.RawArray('i', N)
+        # Number of wake requests
+        self.wakes = multiprocessing.RawValue('l', 0)
+        # Only held by writers, while appending an event
+        self.lock = multiprocessing.Lock()
+
+    def publish(self, address, t):
+        """Notify a write at time `t` to the buffer locked at `address`"""
+        self.latest[address] = t
+        self.lock.acquire()
+        try:
+            seq = self.seq.value
+            self.events[seq % self.capacity] = address
+            self.seq.value = seq + 1
+        finally:
+            self.lock.release()
+
+    def forget(self, address, owner):
+        """Reset `address`, when it is assigned to a new path with hash `owner`"""
+        self.latest[address] = -1
+        self.owners[address] = owner
+
+    def changes(self, seq):
+        """Returns the current sequence number and the addresses changed since `seq`.
+        Addresses are None if the ring was overwritten meanwhile, and any address might have changed."""
+        cur = self.seq.value
+        if cur == seq:
+            return cur, []
+        if cur - seq > self.capacity:
+            return cur, None
+        pos = np.arange(seq, cur) % self.capacity
+        r = np.frombuffer(self.events, dtype=np.int32)[pos]
+        # Writers might have overwritten the oldest events while copying
+        if self.seq.value - seq > self.capacity:
+            return cur, None
+        return cur, np.unique(r).tolist()
+
+    def wait(self, seq, timeout):
+        """Wait up to `timeout` seconds for events newer than `seq`.
+        Returns the current sequence number."""
+        deadline = time() + timeout
+        wakes = self.wakes.value
+        while self.seq.value == seq and self.wakes.value == wakes:
+            left = deadline - time()
+            if left <= 0:
+                break
+            sleep(min(left, self.poll_interval))
+        return self.seq.value
+
+    def wake(self):
+        """Wake up all waiting readers, eg. to let them exit"""
+        self.wakes.value += 1
+
+    def watch(self, addresses=None):
+        return Watch(self, addresses)
+
+
+class Watch(object):
+    """Reader cursor on a ChangeNotifier, starting from its current event"""
+
+    def __init__(self, notifier, addresses=None):
+        """`addresses`: only report changes to these lock addresses. All if None."""
+        self.notifier = notifier
+        self.addresses = None if addresses is None else set(addresses)
+        self.seq = notifier.seq.value
+
+    def changes(self):
+        """Addresses changed since the last call, or None if unknown"""
+        self.seq, changed = self.notifier.changes(self.seq)
+        if changed and self.addresses is not None:
+            changed = [a for a in changed if a in self.addresses]
+        return changed
+
+    def wait(self, timeout):
+        """Wait up to `timeout` seconds for changes.
+        Returns the changed addresses, an empty list on timeout or wake,
+        None if too many changes happened since the last call."""
+        deadline = time() + timeout
+        while True:
+            changed = self.changes()
+            if changed is None or changed:
+                return changed
+            left = deadline - time()
+            if left <= 0:
+                return changed
+            # Timeout or wake
+            if self.notifier.wait(self.seq, left) == self.seq:
+                return []
@@ -1,11 +1,77 @@
 # -*- coding: utf-8 -*-
 """Data management and formats"""
 import os
+import collections
+import threading
 from traceback import format_exc
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
 from .. import parameters as params
 from .. import utils
 from misura.canon import option
 
+
+class PresetCache(object):
+
+    """Least recently used cache of preset files, kept as pickles of their parsed desc.
+    Entries are invalidated when the file modification time or size changes."""
+    cache_len = 50
+    """Maximum number of cached presets"""
+
+    def __init__(self):
+        self.cache = collections.OrderedDict()  # {path: ((mtime, size), pickle)}
+        self._lock = threading.Lock()
+
+    def key(self, path):
+        st = os.stat(path)
+        return st.st_mtime, st.st_size
+
+    def store(self, path, key, dat):
+        self._lock.acquire()
+        self.cache.pop(path, None)
+        self.cache[path] = (key, dat)
+        while len(self.cache) > self.cache_len:
+            self.cache.popitem(False)
+        self._lock.release()
+
+    def get(self, path):
+        """Returns a new copy of the desc read from preset file `path`, or False if missing"""
+        try:
+            key = self.key(path)
+        except OSError:
+            self.discard(path)
+            return False
+        entry = self.cache.get(path, None)
+        if entry and entry[0] == key:
+            desc = loads(entry[1])
+            dat = entry[1]
+        else:
+            desc = option.CsvStore(path).desc
+            dat = dumps(desc, HIGHEST_PROTOCOL)
+        self.store(path, key, dat)
+        return desc
+
+    def put(self, path, desc):
+        """Cache `desc`, just written to `path`"""
+        self.store(path, self.key(path), dumps(desc, HIGHEST_PROTOCOL))
+
+    def discard(self, path):
+        self._lock.acquire()
+        self.cache.pop(path, None)
+        self._lock.release()
+
+preset_cache = PresetCache()
+"""Presets read by all configuration objects. Per PROCESS."""
+
+
+def unchanged(opt, old):
+    """Check if option `opt` has the same entry as `old`"""
+    try:
+        return bool(opt.entry == old.entry)
+    except:
+        # Not comparable, eg. arrays
+        return False
+
+
 def rename(new_name, old_name, overwrite,
            conf_obj, conf_dir, log, ext=params.conf_ext):
     if not new_name:
@@ -43,7 +109,6 @@ class PersistentConf(option.Conf):
             conf_dir += '/'
         self._conf_dir = conf_dir
         """Destination folder for this object"""
-        self.preset_cache = {}
 
     def setKeep_names(self, kn, append=True):
         """Sets the keep names list. Option names which should not be overwritten upon load/merge/update."""
@@ -131,7 +196,7 @@ class PersistentConf(option.Conf):
         self.current_preset = name
         self._conf_obj = obj
         self.listPresets()
-        self.preset_cache[name] = self.desc.copy()
+        preset_cache.discard(obj)
         return 'Configuration saved: ' + name
 
     def remove(self, name=False):
@@ -148,6 +213,7 @@ class PersistentConf(option.Conf):
             self.log.error(msg)
             return msg
         os.remove(obj)
+        preset_cache.discard(obj)
         self.log.info('Deleted configuration:', name, 'in:', obj)
         self.listPresets()
         return 'Configuration deleted: ', name
@@ -166,9 +232,11 @@ class PersistentConf(option.Conf):
         
 
     def merge_desc(self, desc):
-        """Apply desc avoiding overwriting of type attributes and keepnames values"""
+        """Apply desc avoiding overwriting of type attributes and keepnames values.
+        Only changed options are written."""
         if not desc:
             return False
+        changed = 0
         for handle, opt in desc.iteritems():
             if not self.desc.has_key(handle):
                 # Discard any new option which is not user-defined (only Script
@@ -185,9 +253,13 @@ class PersistentConf(option.Conf):
             # Migrate option (avoid changing type, etc)
             elif old:
                 opt.migrate_from(old)
+            if old and unchanged(opt, old):
+                continue
             # Overwrite
             self.desc[handle] = opt
-        self.validate()
+            changed += 1
+        if changed:
+            self.validate()
         return True
 
     def load(self, name=False, path=False):
@@ -230,9 +302,9 @@ class PersistentConf(option.Conf):
             return False
         try:
             # get actual file
-            store = option.CsvStore(obj)
+            desc = preset_cache.get(obj)
             # merge description
-            self.merge_desc(store.desc)
+            self.merge_desc(desc)
             self.current_preset = current_preset
             self.listPresets()
             c = self.desc['preset']
@@ -240,7 +312,6 @@ class PersistentConf(option.Conf):
             self.desc['preset'] = c
             self.conf_obj = obj
             restore()
-            self.preset_cache[current_preset] = self.desc.copy()
             print('Loaded configuration from', obj)
             return obj
         except:
@@ -252,14 +323,9 @@ class PersistentConf(option.Conf):
             return False
         
     def read_preset(self, preset):
-        if preset in self.preset_cache:
-            return self.preset_cache[preset]
+        """Returns the desc saved in `preset`, or False if missing"""
         preset_path = os.path.join(self.conf_dir, preset + params.conf_ext)
-        if not os.path.exists(preset_path):
-            return False
-        store = option.CsvStore(preset_path)
-        self.preset_cache[preset] = store.desc
-        return store.desc
+        return preset_cache.get(preset_path)
         
     def get_from_preset(self, opt, preset, extended=False):
         """Read value of option `opt` saved in `preset`"""
@@ -283,8 +349,8 @@ class PersistentConf(option.Conf):
             self.log.error('Option does not exist in preset:', opt, preset_path)
             return False
         store.desc[opt][attr] = val
-        self.preset_cache[preset] = store.desc
         store.write_file()
+        preset_cache.put(preset_path, store.desc)
         return True
         
     
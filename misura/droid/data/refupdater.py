@@ -1,35 +1,142 @@
 # -*- coding: utf-8 -*-
 """Recursive Reference updater from DirShelf"""
 import os
-from time import sleep
+from time import sleep, time
 from traceback import print_exc
 import threading
+import multiprocessing
+from collections import deque
+from zlib import crc32
 
 import numpy as np
 
 from misura.canon import reference
 from misura.canon.csutil import lockme, sharedProcessResources
-from filebuffer import FileBuffer, LOCK_SH
-
-# TODO: Evaluate inotifyx for more efficient scan!
+from .. import parameters as params
+import filebuffer
+from filebuffer import FileBuffer
+from discovery import PathRegistry, DirWatch
 
 log_marker = '/log/self'
 if os.name=='nt':
     log_marker = '\\log\\self'
+
+
+
+def encode_points(ref, points, mtime, zerotime, path=''):
+    """Encode `points` newer than `mtime` for `ref` Reference, with times relative to `zerotime`.
+    Returns the encoded points and the time of the newest one."""
+    out = []
+    for e in points:
+        if e is False:
+            continue
+        if e[0] <= mtime:  # OK, e[0] has real timestamps as mtime
+            continue
+        enc = None
+        ntime = e[0]  # newer time
+        # Scale zerotime
+        e[0] -= zerotime
+        try:
+            enc = ref.encode(e)
+        except:
+            print_exc()
+        if enc is None:
+            print('Encoding error', path, e)
+            continue
+        out.append(enc)
+        # Remember newer time
+        mtime = ntime
+    return out, mtime
+
+
+def stack(points):
+    """Stack encoded `points` into a 2D numeric block, or None if they are not numeric"""
+    try:
+        block = np.array(points)
+    except ValueError:
+        # Ragged points
+        return None
+    if block.ndim != 2 or block.dtype.kind not in 'biuf':
+        return None
+    return block
+
+
+worker_buffer = False
+"""FileBuffer of worker processes"""
+worker_slots = []
+"""Shared memory blocks, one for each scan thread"""
+worker_refs = {}
+"""Output-less References of worker processes, for encoding"""
+
+
+def init_worker(slots, cache_len):
+    global worker_buffer, worker_slots
+    worker_slots = slots
+    worker_buffer = FileBuffer(private_cache=True)
+    worker_buffer.cache_len = cache_len
+    worker_buffer.lockfree = True
+
+
+def collect_points(path, mtime, zerotime, slot):
+    """Worker process: read, decode and encode points of `path` newer than `mtime`.
+    Returns the time of the newest point, then either the encoded points and None,
+    or None and the dtype and shape of the numeric block written in shared memory `slot`."""
+    ref = worker_refs.get(path, None)
+    if ref is None:
+        opt = worker_buffer.get_meta(path)
+        ref = reference.get_reference(opt)(False, opt=opt)
+        worker_refs[path] = ref
+    mt, points = worker_buffer.newer(path, mtime)
+    out, mtime = encode_points(ref, points, mtime, zerotime, path)
+    block = stack(out)
+    buf = worker_slots[slot]
+    if block is None or block.nbytes > len(buf):
+        return mtime, out, None
+    block = np.ascontiguousarray(block)
+    np.frombuffer(buf, dtype=np.uint8, count=block.nbytes)[:] = block.view(np.uint8).ravel()
+    return mtime, None, (block.dtype.str, block.shape)
+
     
 class ReferenceUpdater(object):
     outfile = False
     zerotime = 0
-    nthreads = 3 
+    nthreads = params.refupdater_threads
+    """Number of scan threads"""
+    processes = params.refupdater_processes
+    """Number of worker processes collecting points, 0 to collect in scan threads"""
+    workers = False
+    block_size = 4 * 2**20
+    """Bytes of shared memory for the points collected by a worker for each scan thread"""
     scanning = 0
     paths = None
+    buffers = []
+    main_buffer = False
+    mapping_budget = 300
+    """Maximum number of FileBuffer mappings kept open, shared by all buffers"""
+    scan_interval = 0.2
+    """Minimum time between scans, collecting changes in batches"""
+    rescan_interval = 2.
+    """Maximum time between scans, if no change is notified"""
+    full_scan_interval = 10.
+    """Maximum time between scans of all monitored paths, in case a change notification was missed"""
+    only_logs = False
+    rate_decay = 0.8
+    """Weight of the previous data rate of a path, when updated after a collection"""
+    discover_retries = 10
+    """Syncs waiting for the metadata of a discovered path to be written"""
+    dirwatch = False
     
-    def __init__(self, base, outfile=False, zerotime=0):
+    def __init__(self, base, outfile=False, zerotime=0, nthreads=None, processes=None):
         self.base = base
         self._lock = threading.Lock()
         sharedProcessResources.register(self.restore_lock, self._lock)
         self.pool = []
         self.callback_result = []
+        self.reset_stats()
+        if nthreads is not None:
+            self.nthreads = nthreads
+        if processes is not None:
+            self.processes = processes
         if not self.nthreads:
             self.nthreads = 1
         # Direct initialization
@@ -43,21 +150,45 @@ class ReferenceUpdater(object):
     def __getstate__(self):
         r = self.__dict__.copy()
         r.pop('_lock')
+        r.pop('workers', None)
+        r.pop('slots', None)
+        r.pop('dirwatch', None)
         return r
     
     def __setstate__(self, s):
         map(lambda a: setattr(self, *a), s.items())
         self._lock = threading.Lock()
+        self.dirwatch = DirWatch()
+        for path in self.paths or []:
+            self.watch_parent(path)
 
     def close(self):
         """Stop threaded operations and commit latest results"""
         self.running = False
+        # Wake up scan threads waiting for changes
+        filebuffer.notifier.wake()
         for t in self.pool:
             t.join(0.5)
+        self.close_workers()
+        self.close_buffers()
+        if self.dirwatch:
+            self.dirwatch.close()
         n = self.commit_results(self.callback_result)
         print('ReferenceUpdater.close: committed results', n)
         return True
 
+    def close_workers(self):
+        if self.workers:
+            self.workers.terminate()
+            self.workers.join()
+        self.workers = False
+
+    def close_buffers(self):
+        """Close all files mapped by scanning buffers"""
+        for fb in self.buffers + [self.main_buffer]:
+            if fb:
+                fb.empty_cache()
+
     def __del__(self):
         self.close()
 
@@ -74,14 +205,45 @@ class ReferenceUpdater(object):
         self.cache = {}  # path: Reference
         self.linked = set([])
         self.exclude = set()
+        self.reset_stats()
+        # Changed paths, from FileBuffer write notifications
+        self.watch = filebuffer.notifier.watch()
+        self.dirty = set()
+        self.addresses = {}  # lock address: monitored path
+        self.ignored = {}  # lock address: owner hash of non-monitored paths
+        self.full_scan_time = time()
+        # Paths to be recorded are registered by DirShelf or found as new files
+        self.registry = PathRegistry(self.base)
+        if self.dirwatch:
+            self.dirwatch.close()
+        self.dirwatch = DirWatch()
+        self.pending = {}  # discovered path: metadata read attempts
+        if not os.path.exists(self.registry.path):
+            # Files were not written by DirShelf: check all of them once
+            for d, dirs, files in os.walk(self.base):
+                if 'self' in files:
+                    self.pending[os.path.join(d, 'self')] = 0
+        # Work queue of dirty paths, pulled by scan threads
+        self.queue = deque()
+        self.active = set()  # paths being collected
+        self.rates = {}  # path: recent points per collection
         # Initialize file buffers
+        self.close_buffers()
         self.buffers = []
+        cache_len = self.mapping_budget // (self.nthreads + 1)
         for i in range(self.nthreads):
             fb = FileBuffer(private_cache=True)
-            fb.cache_len = 0
+            fb.cache_len = cache_len
+            fb.lockfree = True
             self.buffers.append(fb)
         self.main_buffer = FileBuffer(private_cache=True)
-        self.main_buffer.cache_len = 0
+        self.main_buffer.cache_len = cache_len
+        self.main_buffer.lockfree = True
+        self.close_workers()
+        self.local_paths = set()  # paths collected in scan threads, because workers failed
+        if self.processes:
+            self.slots = [multiprocessing.RawArray('c', self.block_size) for i in range(self.nthreads)]
+            self.workers = multiprocessing.Pool(self.processes, init_worker, (self.slots, cache_len))
         print('Refupdater.reset DONE')
 
     def recursive_link(self, data_source, ref):
@@ -122,20 +284,16 @@ class ReferenceUpdater(object):
         self.outfile.flush()
         return ref
 
-    def add_path(self, f, dirname, names):
+    def add_path(self, path):
         """Check if `path` should be added to self.path for monitoring.
-        Only objects with 'History' attr are considered."""
-        if not 'self' in names:
-            return False
-        path = os.path.join(dirname, 'self')
-        # if History is not specified, exclude this path from further sync
+        Only objects with 'History' attr are considered.
+        Returns None if its metadata cannot be read yet."""
         try:
             opt = self.main_buffer.get_meta(path)
         except:
-            print_exc()
-            self.exclude.add(path)
-            return False
+            return None
         attr = opt.get('attr', [])
+        # if History is not specified, exclude this path from further sync
         if opt['type'] == 'RoleIO':
             lk = opt['options']
             if lk[0] in (None, 'None'):
@@ -146,6 +304,10 @@ class ReferenceUpdater(object):
             if not self.link.has_key(kid):
                 self.link[kid] = []
             self.link[kid].append(opt['kid'])
+            # Link already recorded References
+            for p, ref in self.cache.items():
+                if self.paths.get(p, False) == kid or (kid, ref.path) in self.linked:
+                    self.recursive_link(kid, ref)
             # TODO: Should record anyway if defines History attr
             # but referred one does not...?
             self.exclude.add(path)
@@ -154,7 +316,124 @@ class ReferenceUpdater(object):
             self.exclude.add(path)
             return False
         # Monitor the path
-        self.paths[path] = opt['kid']
+        self.monitor(path, opt['kid'])
+        return True
+
+    def discover(self):
+        """Add paths registered by DirShelf or created since the last call.
+        Returns the number of new monitored paths."""
+        for path in self.registry.read():
+            # Registered paths might have been excluded before getting History
+            self.exclude.discard(path)
+            self.pending[path] = 0
+        for path in self.dirwatch.read():
+            self.pending.setdefault(path, 0)
+        n = 0
+        for path, tries in self.pending.items():
+            if path in self.paths or path in self.exclude or not os.path.exists(path):
+                del self.pending[path]
+                continue
+            r = self.add_path(path)
+            if r is None:
+                # Metadata might still be written
+                if tries < self.discover_retries:
+                    self.pending[path] = tries + 1
+                    continue
+                print('ReferenceUpdater.discover: cannot read metadata', path)
+                self.exclude.add(path)
+            elif r:
+                self.watch_parent(path)
+                n += 1
+            del self.pending[path]
+        return n
+
+    def watch_parent(self, path):
+        """Watch for new options in the object owning option `path`"""
+        self.dirwatch.add(os.path.dirname(os.path.dirname(path)))
+
+    def monitor(self, path, kid):
+        """Start collecting data from `path`, with output Reference `kid`"""
+        self.paths[path] = kid
+        self.dirty.add(path)
+        idx = filebuffer.locker.address(path)
+        if idx >= 0:
+            self.addresses[idx] = path
+
+    def map_addresses(self):
+        """Resolve lock addresses of all monitored paths, after some was reassigned"""
+        locker = filebuffer.locker
+        owners = filebuffer.notifier.owners
+        self.addresses = {}
+        for path in self.paths:
+            idx = locker.address(path)
+            if idx >= 0 and owners[idx] != crc32(path):
+                # Stale cached address
+                locker.cache.pop(path, None)
+                idx = locker.address(path)
+            if idx >= 0:
+                self.addresses[idx] = path
+
+    def update_dirty(self):
+        """Mark monitored paths changed since the last call as dirty"""
+        changed = self.watch.changes()
+        if changed is None or time() - self.full_scan_time > self.full_scan_interval:
+            # Notifications were lost or might have been missed
+            self.dirty.update(self.paths)
+            self.full_scan_time = time()
+            return
+        owners = filebuffer.notifier.owners
+        unknown = []
+        for idx in changed:
+            path = self.addresses.get(idx)
+            if path is not None and owners[idx] == crc32(path):
+                self.dirty.add(path)
+            elif self.ignored.get(idx, None) != owners[idx]:
+                unknown.append(idx)
+        if not unknown:
+            return
+        # Addresses were assigned to new paths
+        self.map_addresses()
+        for idx in unknown:
+            path = self.addresses.get(idx)
+            if path is None:
+                self.ignored[idx] = owners[idx]
+            else:
+                self.dirty.add(path)
+
+    @lockme()
+    def fill_queue(self):
+        """Queue dirty paths, if the queue is empty.
+        Paths with higher recent data rate come first.
+        Paths being collected stay dirty until the next fill."""
+        if self.queue:
+            return 0
+        self.update_dirty()
+        paths = []
+        for path in self.dirty:
+            if self.only_logs and not path.endswith(log_marker):
+                continue
+            if path in self.active:
+                continue
+            paths.append(path)
+        self.dirty.difference_update(paths)
+        paths.sort(key=lambda p: self.rates.get(p, 0), reverse=True)
+        self.queue.extend(paths)
+        return len(paths)
+
+    @lockme()
+    def next_path(self):
+        """Returns the next queued path, marking it as active, or None"""
+        if not self.queue:
+            return None
+        path = self.queue.popleft()
+        self.active.add(path)
+        return path
+
+    @lockme()
+    def done(self, path, n):
+        """Release `path` after `n` points were collected, updating its data rate"""
+        self.active.discard(path)
+        self.rates[path] = self.rate_decay * self.rates.get(path, 0) + (1 - self.rate_decay) * n
 
     @lockme()
     def sync(self, zerotime=-1, only_logs=False):
@@ -165,24 +444,17 @@ class ReferenceUpdater(object):
             print('ReferenceUpdater.sync: no paths defined.', self.paths)
             self.paths = {}
             return False, 0
+        n = self.discover()
+        if n:
+            print('ReferenceUpdater.sync: discovered', n)
         N = len(self.paths)
-
-        # if no path is being monitored, scan the entire memory
         if N == 0:
-            print('Walking')
-            os.path.walk(self.base, self.add_path, 0)
-            N = len(self.paths)
-            print('Walked', N)
-            print('Linked', self.link)
-            if N == 0:
-                print('No path found')
-                return False, 0
+            print('No path found')
+            return False, 0
 
         if zerotime >= 0:
             self.zerotime = zerotime
 
-        # Call the scan function in 5 different threads
-        self.batch_length = N / self.nthreads
         if self.nthreads==1:
             self.single_threaded_scan()
         else:
@@ -218,6 +490,8 @@ class ReferenceUpdater(object):
             if elems is False:
                 # Just create an empty ref
                 ref = self.get_cache(path, self.main_buffer)
+                # Collect its points on next scan
+                self.dirty.add(path)
                 continue
             # Waiting for new points
             if len(elems) == 0:
@@ -232,14 +506,21 @@ class ReferenceUpdater(object):
         return c
 
     def commit(self, ref, elems):
-        """Commits `elems` data to `ref` Reference object in thread-safe mode."""
+        """Commits `elems` data to `ref` Reference object in thread-safe mode.
+        Numeric elements are stacked and appended at once."""
         N = len(elems)
         if N == 0:
             return False
+        t0 = time()
+        block = stack(elems)
         e = False
         try:
-            for e in elems:
-                ref.append(np.array(e))
+            if block is not None:
+                e = block
+                ref.append(block)
+            else:
+                for e in elems:
+                    ref.append(np.array(e))
         except:
             print('ReferenceUpdater.commit', ref.folder, e)
             raise
@@ -249,8 +530,28 @@ class ReferenceUpdater(object):
         except:
             print('ReferenceUpdater.commit/interpolate', ref.folder, elems)
             raise
+        t = time() - t0
+        self.stats['commits'] += 1
+        self.stats['points'] += N
+        self.stats['max_points'] = max(self.stats['max_points'], N)
+        self.stats['latency'] += t
+        self.stats['max_latency'] = max(self.stats['max_latency'], t)
         return N
 
+    def reset_stats(self):
+        self.stats = dict.fromkeys(('commits', 'points', 'max_points', 'latency', 'max_latency'), 0)
+
+    def commit_stats(self):
+        """Returns the number of commits, mean and maximum points per commit,
+        mean and maximum commit latency in seconds since the last reset"""
+        s = self.stats
+        n = max(s['commits'], 1)
+        return {'commits': s['commits'],
+                'points_per_commit': 1. * s['points'] / n,
+                'max_points': s['max_points'],
+                'latency': s['latency'] / n,
+                'max_latency': s['max_latency']}
+
     @lockme()
     def from_cache(self, key):
         return self.cache.get(key, False)
@@ -265,13 +566,27 @@ class ReferenceUpdater(object):
 
     ###############
     # THREAD POOL OPERATIONS
-    # TODO: move to a separate SharedMemoryMonitor object to test inotifyx
     # Grouping methods which are called in separate threads during sync.
     # None of these methods should interact with outfile
     ###############
-    def collect(self, path, fbuffer):
-        """Collects new data points from `path` using file buffer `fbuffer`.
-        Returns a list of elements to be added, or False if the output Reference was not created."""
+    def collect_remote(self, path, ref, slot):
+        """Collects new data points from `path` in a worker process,
+        receiving numeric blocks in shared memory `slot`"""
+        mtime, out, block = self.workers.apply(collect_points,
+                                               (path, ref.mtime, self.zerotime, slot))
+        if block is not None:
+            dtype, shape = block
+            dtype = np.dtype(dtype)
+            n = int(np.prod(shape)) * dtype.itemsize
+            # The slot is reused by the next collection
+            out = np.frombuffer(self.slots[slot], dtype=np.uint8, count=n).view(dtype).reshape(shape).copy()
+        ref.mtime = mtime
+        return out
+
+    def collect(self, path, fbuffer, slot=0):
+        """Collects new data points from `path` using file buffer `fbuffer`,
+        or a worker process using shared memory `slot`.
+        Returns a list or block of elements to be added, or False if the output Reference was not created."""
 #       self._lock.acquire()
         if path in self.exclude:
             return False
@@ -282,19 +597,28 @@ class ReferenceUpdater(object):
         else:
             lastt = ref.mtime
         elems = []
+        if ref is not False and self.workers and path not in self.local_paths:
+            try:
+                elems = self.collect_remote(path, ref, slot)
+                self.set_cache(path, ref)
+                return elems
+            except:
+                print('ReferenceUpdater.collect: worker error, collecting locally', path)
+                print_exc()
+                self.local_paths.add(path)
         try:
-            # Lock the file with low-level fopen()
-            fbuffer.fopen(path, LOCK_SH)
-            mt = fbuffer.mtime  # real last mod
+            # Read without blocking the writer
+            if ref is False:
+                mt = fbuffer.get_info(path)[2]  # real last mod
+            else:
+                mt, elems0 = fbuffer.newer(path, ref.mtime)  # these have real timestamps
         except:
             print('ReferenceUpdater.collect: error ', path)
             print_exc()
-            fbuffer.fclose()
             return False
 
         # Reference missing
         if ref is False:
-            fbuffer.fclose()
             # Avoid creating reference without a recent change
             if mt < lastt:
                 # Return empty list = do not create ref
@@ -304,68 +628,24 @@ class ReferenceUpdater(object):
             # print 'Force ref creation', path
             return False
 
-        if mt < lastt and mt >= 0:
-            fbuffer.fclose()
-#           print 'No newer modification {:f}<{:f}'.format(mt,lastt)
-            return elems
-        # Get nearest time
-        i = fbuffer._get_time_idx(ref.mtime - self.zerotime)
-        # No newer points
-        if i < 0:
-            fbuffer.fclose()
-            return elems
-        i += 1
-        if i >= fbuffer.idx_entries:
-            fbuffer.fclose()
-            return elems
-        # Get sequence from the real index up to the end of the buffer
-        elems0 = fbuffer._sequence(i)  # these have real timestamps
-        # Unlock the file with low-level fclose()
-        fbuffer.fclose()
-        for i, e in enumerate(elems0):
-            if e is False:
-                #               print 'Erroneous result',path,i
-                continue
-            if e[0] <= ref.mtime:  # OK, e[0] has real timestamps as ref.mtime
-                # print 'Skipping point',path,i,e[0],ref.mtime
-                continue
-            out = None
-            ntime = e[0]  # newer time
-            # Scale zerotime
-            e[0] -= self.zerotime
-            try:
-                out = ref.encode(e)
-            except:
-                print_exc()
-            if out is None:
-                print('Encoding error', path, e)
-                continue
-            elems.append(out)
-            # Remember newer time
-            ref.mtime = ntime
+        elems, ref.mtime = encode_points(ref, elems0, ref.mtime, self.zerotime, path)
 
         # Be sure to update reference with new mtime
         self.set_cache(path, ref)
         return elems
 
     def scan(self, thread_index=0):
-        """Scan the whole self.paths list of eligible paths and collects data to be committed"""
+        """Pull changed paths from the work queue and collect data to be committed"""
         # Use a dedicated FileBuffer
         buff = self.buffers[thread_index]
         c = []
-        start = self.batch_length * thread_index
-        end = len(self.paths)
-        if thread_index < self.nthreads - 1:
-            end = self.batch_length * (thread_index + 1)
-        for p in range(start, end):
-            # End of scan
-            if p >= len(self.paths):
+        self.fill_queue()
+        while True:
+            p = self.next_path()
+            if p is None:
                 break
-            p = self.paths.keys()[p]
-            # Skip non-log entries
-            if self.only_logs and not p.endswith(log_marker):
-                continue
-            elems = self.collect(p, buff)
+            elems = self.collect(p, buff, thread_index)
+            self.done(p, 0 if elems is False else len(elems))
             if elems is False:
                 c.append((p, False))
                 continue
@@ -376,8 +656,13 @@ class ReferenceUpdater(object):
         return c
     
     def scan_loop(self, *a, **k):
+        watch = filebuffer.notifier.watch()
         while self.running:
+            t0 = time()
             self.scan(*a, **k)
-            sleep(0.2)
+            sleep(max(0, self.scan_interval - (time() - t0)))
+            # Sleep until something is written
+            if self.running:
+                watch.wait(self.rescan_interval)
         print('ReferenceUpdater.scan_loop: exiting', a, k)
         
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import shutil
+from time import time
+from cPickle import dumps
+
+from misura.droid.data import arena, filebuffer
+
+dpath = '/dev/shm/misura_test/arena/'
+p = dpath + 'test'
+
+props = {'a': {'handle': 'a', 'type': 'Object', 'attr': [], 'current': [1, 2]},
+         'h': {'handle': 'h', 'type': 'Float', 'attr': ['History'], 'current': 1.5}}
+
+
+class Arena(unittest.TestCase):
+
+    def setUp(self):
+        self.a = arena.Arena(private_cache=True)
+        self.a.slots = 8
+
+    def tearDown(self):
+        self.a.empty_cache()
+        if os.path.exists(dpath):
+            shutil.rmtree(dpath)
+
+    def test_write_key(self):
+        a = self.a
+        a.write_key(p, 'a', 1, 10., meta={'handle': 'a'})
+        a.write_key(p, 'b', 'b', meta={'handle': 'b'})
+        self.assertEqual(a.item(p, 'a'), [10., 1])
+        self.assertEqual(a.item(p, 'a', True), [10., {'handle': 'a', 'current': 1}])
+        self.assertTrue(a.contains(p, 'b'))
+        self.assertFalse(a.contains(p, 'c'))
+        self.assertEqual(sorted(a.list_keys(p)), ['a', 'b'])
+        self.assertRaises(KeyError, a.item, p, 'c')
+        # New values keep the metadata
+        a.write_key(p, 'a', 2, 11.)
+        self.assertEqual(a.item(p, 'a', True), [11., {'handle': 'a', 'current': 2}])
+        # Same metadata: the value is updated in place
+        a.write_key(p, 'a', 3, 12., meta={'handle': 'a'})
+        self.assertEqual(a.item(p, 'a', True), [12., {'handle': 'a', 'current': 3}])
+        self.assertEqual(a.key_time(p, 'a'), 12.)
+        # Missing keys require metadata
+        self.assertRaises(KeyError, a.write_key, p, 'c', 1)
+        w = filebuffer.notifier.watch()
+        self.assertTrue(a.remove_key(p, 'a'))
+        self.assertEqual(w.changes(), [filebuffer.locker.cache[p]])
+        self.assertFalse(a.contains(p, 'a'))
+        self.assertEqual(a.list_keys(p), ['b'])
+
+    def test_relocate(self):
+        """Bigger values move to the end of the file, wasted space is compacted"""
+        a = self.a
+        a.write_key(p, 'a', 1, meta={})
+        a.write_key(p, 'b', 1, meta={})
+        for i in range(1, 100):
+            a.write_key(p, 'a', 'a' * i * 10)
+            self.assertEqual(a.item(p, 'b')[1], 1)
+        self.assertEqual(a.item(p, 'a')[1], 'a' * 990)
+        a.fopen(p)
+        slots, count, end, wasted = a.info
+        a.fclose()
+        self.assertEqual(count, 2)
+        self.assertLess(wasted * 2, end)
+
+    def test_rebuild(self):
+        """The index grows as keys are added"""
+        a = self.a
+        for i in range(50):
+            a.write_key(p, 'k{}'.format(i), i, meta={'i': i})
+        a.fopen(p)
+        slots, count, end, wasted = a.info
+        a.fclose()
+        self.assertEqual(count, 50)
+        self.assertEqual(slots, 128)
+        for i in range(50):
+            self.assertEqual(a.item(p, 'k{}'.format(i), True)[1], {'i': i, 'current': i})
+        # Deleted slots are reused
+        a.remove_key(p, 'k3')
+        a.write_key(p, 'k3', 3, meta={})
+        self.assertEqual(len(a.list_keys(p)), 50)
+
+    def test_lockfree(self):
+        a = self.a
+        a.lockfree = True
+        a.write_key(p, 'a', 1, meta={})
+        self.assertEqual(a.item(p, 'a')[1], 1)
+        self.assertEqual(a.list_keys(p), ['a'])
+
+
+class ArenaShelf(unittest.TestCase):
+
+    def setUp(self):
+        self.d = arena.ArenaShelf(dpath, 'shelf')
+
+    def tearDown(self):
+        self.d.close()
+        self.d.cache.clear()
+
+    def test_dump(self):
+        dumps(self.d)
+
+    def test_update(self):
+        d = self.d
+        d.update(props)
+        self.assertEqual(d['a'], props['a'])
+        self.assertEqual(d['h'], props['h'])
+        # Only History options get their own FileBuffer
+        self.assertFalse(os.path.exists(d.fp('a')))
+        self.assertTrue(os.path.exists(d.fp('h')))
+        self.assertEqual(sorted(d.keys()), ['a', 'h'])
+        self.assertTrue(d.has_key('a'))
+        self.assertFalse(d.has_key('b'))
+        d.set('a', [3], t=10., newmeta=False)
+        self.assertEqual(d.get('a', meta=False), [3])
+        self.assertEqual(d.h_time_at('a'), 10.)
+        self.assertEqual(d.h_get('a'), [[10., [3]]])
+        d.set('h', 2., newmeta=False)
+        self.assertEqual([e[1] for e in d.h_get('h', 0, None)], [1.5, 2.])
+        self.assertEqual(d.copy()['h']['current'], 2.)
+        self.assertEqual(d.copy(meta=False), {'a': [3], 'h': 2.})
+        del d['a']
+        self.assertEqual(d.keys(), ['h'])
+
+    def test_move(self):
+        """Options move between storages if the History attribute changes"""
+        d = self.d
+        d.update(props)
+        h = dict(props['h'], attr=[])
+        d.set('h', h)
+        self.assertFalse(os.path.exists(d.fp('h')))
+        self.assertEqual(d['h'], h)
+        a = dict(props['a'], attr=['History'])
+        d.set('a', a)
+        self.assertTrue(os.path.exists(d.fp('a')))
+        self.assertEqual(d['a'], a)
+        # Seen by other instances
+        d2 = arena.ArenaShelf(dpath, 'shelf')
+        self.assertEqual(d2.copy(), d.copy())
+        d2.set('h', 5., t=time(), newmeta=False)
+        self.assertEqual(d.get('h', meta=False), 5.)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
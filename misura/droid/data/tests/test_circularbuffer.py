@@ -170,5 +170,18 @@ class CircularBuffer(unittest.TestCase):
         self.assertEqual(sl[-1][0],	ls[-1][0])
 
 
+    def test_ordered(self):
+        cb = data.CircularBuffer(10)
+        for i in range(15):
+            cb.append([float(i), i % 3])
+        self.assertTrue(cb.ordered)
+        self.assertEqual(cb[cb.get_time(9.2)], [9., 0])
+        self.assertEqual(cb[cb.get_time(100)], [14., 2])
+        # Times going back in time
+        cb.append([1., 0])
+        self.assertFalse(cb.ordered)
+        self.assertEqual(cb[cb.get_time(1.2)], [1., 0])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -10,6 +10,7 @@ import os
 
 #from misura import utils_testing
 from misura.droid import data
+from misura.droid.data import persistent
 from misura.canon import option
 
 from . import testdir
@@ -90,6 +91,21 @@ class Conf(unittest.TestCase):
         desc = cf.read_preset('Conf')
         self.assertEqual(desc['name']['current'], 'Simulator')
 
+    def test_preset_cache(self):
+        cf = self.cf
+        path = os.path.join(self.cfd, 'Conf.csv')
+        desc = cf.read_preset('Conf')
+        self.assertIn(path, persistent.preset_cache.cache)
+        # Each call returns a new copy
+        desc['name']['current'] = 'Modified'
+        self.assertEqual(cf.read_preset('Conf')['name']['current'], 'Simulator')
+        # Refreshed when the file is written
+        cf.set_to_preset('name', 'Conf', 'Changed')
+        self.assertEqual(cf.read_preset('Conf')['name']['current'], 'Changed')
+        os.remove(path)
+        self.assertFalse(cf.read_preset('Conf'))
+        self.assertNotIn(path, persistent.preset_cache.cache)
+
     def test_describe(self):
         self.cf.update(option.ao({}, 'bin', type='Binary'))
         self.cf.update(option.ao({}, 'num', type='Float'))
@@ -45,5 +45,69 @@ class DirShelf(unittest.TestCase):
             self.assertEqual(d.info[:2], (0, i + 4))
             self.assertAlmostEqual(d.info[2], t, delta=0.001)
 
+    def test_h_get_history(self):
+        d = self.d
+        t = time()
+        for i in range(10):
+            d.set('a', i, t=t - 10 + i, newmeta=False)
+        v = d.h_get_history('a', t - 7.1, t - 3.9)
+        self.assertEqual([e[1] for e in v], [3, 4, 5])
+
+    def test_typed(self):
+        d = self.d
+        d.update({'f': {'handle': 'f', 'type': 'Float', 'current': 1.5}})
+        d.fopen(d.fp('f'))
+        self.assertEqual(d.codec, 'd')
+        d.fclose()
+        d.set_current('f', 2.5)
+        self.assertEqual(d['f']['current'], 2.5)
+        self.assertEqual(d['f']['type'], 'Float')
+
+    def test_items(self):
+        d = self.d
+        d.update(props)
+        d.update({'b': {'handle': 'b', 'type': 'Boolean', 'current': False}})
+        self.assertEqual(sorted(d.items()), [('a', props['a']),
+                                             ('b', {'handle': 'b', 'type': 'Boolean', 'current': False})])
+        self.assertEqual(d.copy(meta=False), {'a': [1, 2], 'b': False})
+        # Keys removed meanwhile are skipped
+        self.assertEqual(d.file_items(['a', 'c']), [('a', props['a'])])
+        d.lockfree = False
+        self.assertEqual(d.copy(), dict(d.items()))
+
+    def test_meta_unchanged(self):
+        """Setting an option with the same metadata only writes its value"""
+        d = self.d
+        d.update(props)
+        p = d.fp('a')
+        d.fopen(p)
+        gen = d._get_meta_generation()
+        d.fclose()
+        d.set('a', dict(props['a'], current=[3]))
+        self.assertEqual(d['a'], dict(props['a'], current=[3]))
+        d.fopen(p)
+        self.assertEqual(d._get_meta_generation(), gen)
+        d.fclose()
+        # Changed metadata is written
+        d.set('a', dict(props['a'], name='A'))
+        self.assertEqual(d['a']['name'], 'A')
+        d.fopen(p)
+        self.assertNotEqual(d._get_meta_generation(), gen)
+        d.fclose()
+        # Values edited in place are written
+        opt = d['a']
+        opt['attr'] = []
+        d.set('a', opt)
+        opt = d['a']
+        opt['attr'].append('History')
+        d.set('a', opt)
+        d.meta_cache.clear()
+        self.assertEqual(d['a']['attr'], ['History'])
+        # The option passed in is not modified
+        opt = dict(props['a'], handle='x')
+        d.set('a', opt)
+        self.assertEqual(opt['handle'], 'x')
+        self.assertEqual(d['a']['handle'], 'a')
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import shutil
+import tempfile
+
+from misura.droid.data import discovery
+
+
+class PathRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_read(self):
+        w = discovery.PathRegistry(self.dir)
+        r = discovery.PathRegistry(self.dir)
+        self.assertEqual(r.read(), [])
+        self.assertTrue(w.add('/a/self'))
+        self.assertFalse(w.add('/a/self'))
+        w.add('/b/self')
+        self.assertEqual(r.read(), ['/a/self', '/b/self'])
+        self.assertEqual(r.read(), [])
+        # Partially written line
+        with open(r.path, 'ab') as f:
+            f.write('/c/se')
+        self.assertEqual(r.read(), [])
+        with open(r.path, 'ab') as f:
+            f.write('lf\n')
+        self.assertEqual(r.read(), ['/c/self'])
+        w.forget('/a')
+        self.assertTrue(w.add('/a/self'))
+        self.assertFalse(w.add('/b/self'))
+        self.assertEqual(r.read(), ['/a/self'])
+        # Registry removed with its directory
+        os.remove(r.path)
+        self.assertEqual(r.read(), [])
+        self.assertTrue(w.add('/b/self'))
+        self.assertEqual(r.read(), ['/b/self'])
+
+
+@unittest.skipIf(discovery.libc is None, 'inotify not available')
+class DirWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_read(self):
+        old = os.path.join(self.dir, 'old')
+        os.makedirs(os.path.join(old, 'a'))
+        open(os.path.join(old, 'a', 'self'), 'w').close()
+        w = discovery.DirWatch()
+        self.assertTrue(w.add(old))
+        self.assertFalse(w.add(os.path.join(self.dir, 'missing')))
+        self.assertEqual(w.failed, 1)
+        self.assertEqual(w.read(), [])
+        # Files in new nested directories of a watched one
+        b = os.path.join(old, 'b', 'self')
+        c = os.path.join(old, 'c', 'd', 'self')
+        for path in (b, c):
+            os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        open(os.path.join(old, 'other'), 'w').close()
+        # Not watched
+        os.makedirs(os.path.join(self.dir, 'new'))
+        open(os.path.join(self.dir, 'new', 'self'), 'w').close()
+        self.assertEqual(w.read(), sorted([b, c]))
+        self.assertEqual(w.read(), [])
+        # Lost events
+        w.overflow = True
+        self.assertEqual(w.read(), sorted([os.path.join(old, 'a', 'self'), b, c]))
+        w.close()
+        self.assertEqual(w.read(), [])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
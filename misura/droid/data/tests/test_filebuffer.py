@@ -4,9 +4,13 @@
 import unittest
 import shutil
 import os
+import collections
 
 from time import time, sleep
 import multiprocessing
+import threading
+import mmap
+import numpy as np
 
 #from misura import utils_testing as ut
 from misura.canon import csutil
@@ -21,11 +25,18 @@ dr = '/dev/shm/misura_test/fb/'
 p = dr + 'test'
 
 
+class Opt(object):
+    """Minimal option object, keeping its entry as an attribute"""
+
+    def __init__(self, **entry):
+        self.entry = entry
+
+
 class FileBuffer(unittest.TestCase):
 
     def setUp(self):
         self.fb = filebuffer.FileBuffer()
-        self.fb.cache = {}
+        self.fb.cache = collections.OrderedDict()
 
     def tearDown(self):
         self.fb.close()
@@ -44,9 +55,10 @@ class FileBuffer(unittest.TestCase):
         self.assertEqual(mm, fb.mm)
         self.assertEqual(fd, fb.fd)
         self.assertTrue(os.path.exists(p))
-        self.assertEqual(mm[:2], '-1')
+        self.assertEqual(mm[:4], fb.magic)
+        self.assertEqual(fb.info[:2], (-1, 0))
         self.assertTrue(fb.cache.has_key(p))
-        self.assertEqual(fb.cache[p], fd)
+        self.assertEqual(fb.cache[p][:2], (fd, mm))
         # Check thread safety
         self.assertFalse(fb._lock.acquire(False))
         fb.fclose()
@@ -55,14 +67,11 @@ class FileBuffer(unittest.TestCase):
         fb._lock.release()
 
     def check_invalid(self, valid=True):
-        """Check if the latest entry has invalidated oldest entry."""
-        # Oldest entry should not be invalidated,
-        # as all values have the same dimension
+        """Check if the latest entries have overwritten the oldest entry."""
         fb = self.fb
         fb.fopen(p)
         t, s, e = fb._get_idx(0)
         t1, s1, e1 = fb._get_idx(-1)
-        info = fb.info
         fb.fclose()
         # If the oldest entry must be invalid
         if not valid:
@@ -72,11 +81,6 @@ class FileBuffer(unittest.TestCase):
         self.assertGreater(s, 0)
         # The latest entry comes after in time than the oldest
         self.assertGreater(t1, t)
-        # But comes first in position, if it's not the first one!
-        if info[0] < fb.idx_entries - 1:
-            self.assertGreater(s, s1)
-        else:
-            self.assertGreater(s1, s)
         return True
 
     def test_write(self):
@@ -94,16 +98,28 @@ class FileBuffer(unittest.TestCase):
         for i in range(fb.idx_entries * 2):
             fb.write(p, 0)
             self.check_invalid(valid=True)
-        # Check if the writing of a bigger object invalidates subsequent
-        # entries
-        for i in range(fb.idx_entries - 2):  # avoid re-starting from zero!
-            fb.write(p, 'LongPickledObject')
-            self.check_invalid(valid=False)
-        # But, after that, if the length does not increase or diminish,
+        fb.fopen(p)
+        capacity, head = fb._get_ring()
+        fb.fclose()
+        # A bigger object fitting the data ring invalidates nothing
+        big = 'x' * (capacity // 4)
+        fb.write(p, big)
+        self.check_invalid(valid=True)
+        # Bigger objects overwrite the oldest entries
+        for i in range(4):
+            fb.write(p, big)
+        self.check_invalid(valid=False)
+        # After that, once the index is refilled,
         # no indices are invalidated anymore
+        for i in range(fb.idx_entries):
+            fb.write(p, 0)
         for i in range(fb.idx_entries * 2):
             fb.write(p, 0)
             self.check_invalid(valid=True)
+        # The file never grows after the data ring was allocated
+        fb.fopen(p)
+        self.assertEqual(len(fb.mm), fb.start_position + capacity)
+        fb.fclose()
         print('done write')
 
     def test_sequence(self):
@@ -202,6 +218,376 @@ class FileBuffer(unittest.TestCase):
         self.assertEqual(fb.get_time_idx(p, 0), 0)
         self.assertEqual(fb.get_time_idx(p, time()), -1)
 
+    def test_full_idx(self):
+        fb = self.fb
+        [fb.write(p, i, i + 1.) for i in range(10)]
+        r = fb.full_idx(p)
+        self.assertEqual(r.shape, (10, 3))
+        self.assertEqual(list(r[:, 0]), range(1, 11))
+        # Wrap around the end
+        [fb.write(p, i, i + 11.) for i in range(fb.idx_entries)]
+        r = fb.full_idx(p)
+        self.assertEqual(len(r), fb.idx_entries)
+        self.assertEqual(r[0][0], 11.)
+        self.assertEqual(r[-1][0], fb.idx_entries + 10.)
+        self.assertTrue((np.diff(r[:, 0]) > 0).all())
+
+    def test_get_time_range(self):
+        fb = self.fb
+        [fb.write(p, i, i + 1.) for i in range(fb.idx_entries + 10)]
+        # Oldest point is now at t=11
+        self.assertEqual(fb.get_time_range(p, 0, 15.2), [0, 4])
+        self.assertEqual(fb.get_time_range(p, 20.5, 1000), [9, -1])
+        self.assertEqual(fb.get_time_range(p, 20.6, 20.4), [10, 9])
+        fb.fopen(p)
+        self.assertEqual(fb._get_newer_idx(15.), 5)
+        self.assertEqual(fb._get_newer_idx(15.5), 5)
+        self.assertEqual(fb._get_newer_idx(0), 0)
+        self.assertEqual(fb._get_newer_idx(fb.mtime), -1)
+        fb.fclose()
+
+    def test_sequence_range(self):
+        fb = self.fb
+        [fb.write(p, i, i + 1.) for i in range(fb.idx_entries + 10)]
+        seq = fb.sequence_range(p, 5, 8)
+        self.assertEqual(seq, [[16., 15], [17., 16], [18., 17]])
+        # Across the wrapping point
+        self.assertEqual(fb.sequence_range(p, -12), fb.sequence(p, -12))
+        self.assertEqual([e[1] for e in fb.sequence_range(p, 85, 95)], range(95, 105))
+        t, v = fb.sequence_range(p, -3, columns=True)
+        self.assertEqual(list(t), [108., 109., 110.])
+        self.assertEqual(v, [107, 108, 109])
+        # Only the requested entries are read across the end of the data ring
+        i = 110
+        while fb.get_idx(p, -1)[1] > fb.get_idx(p, -2)[1]:
+            fb.write(p, i)
+            i += 1
+        fb.fopen(p)
+        slices = []
+
+        class SpyMap(mmap.mmap):
+            def __getslice__(self, i, j):
+                slices.append(j - i)
+                return mmap.mmap.__getslice__(self, i, j)
+        fb.mm = SpyMap(fb.fd, length=0)
+        seq = fb._sequence_range(-2)
+        fb.fclose()
+        self.assertEqual([e[1] for e in seq], [i - 2, i - 1])
+        self.assertEqual(len(slices), 2)
+        self.assertLess(max(slices), 50)
+        self.assertLess(max(slices), 50)
+
+    def test_typed(self):
+        fb = self.fb
+        [fb.write(p, i * 1.5, i + 1., codec='d') for i in range(fb.idx_entries + 10)]
+        fb.fopen(p)
+        self.assertEqual(fb.codec, 'd')
+        # Fixed-size records, no separator
+        self.assertEqual(len(fb.mm), fb.start_position + fb.idx_entries * 8)
+        fb.fclose()
+        self.assertEqual(fb.get_item(p, -1), [110., 163.5])
+        t, v = fb.sequence_range(p, -3, columns=True)
+        self.assertIsInstance(v, np.ndarray)
+        self.assertEqual(list(v), [160.5, 162., 163.5])
+        self.assertEqual(fb.sequence(p, -12), fb.sequence_range(p, -12))
+        self.assertEqual(fb.sequence(p, 0, 2), [[11., 15.], [12., 16.5]])
+        # Integers are accepted by the float codec
+        fb.write(p, 1)
+        self.assertEqual(fb.get_item(p, -1)[1], 1.)
+        # Values not fitting the codec fall back to pickle
+        fb.write(p, 'a')
+        fb.fopen(p)
+        self.assertEqual(fb.codec, 'p')
+        fb.fclose()
+        seq = fb.sequence(p, -3)
+        self.assertEqual([e[1] for e in seq], [163.5, 1., 'a'])
+        self.assertEqual(fb.get_time_range(p, 0, 20.2), [0, 7])
+
+    def test_typed_history(self):
+        """Switching codec never drops history"""
+        fb = self.fb
+        [fb.write(p, float(i), codec='d') for i in range(5)]
+        fb.write(p, None)
+        fb.write(p, 7., codec='d')
+        self.assertEqual([e[1] for e in fb.sequence(p, 0)], [0., 1., 2., 3., 4., None, 7.])
+        fb.fopen(p)
+        self.assertEqual(fb.codec, 'p')
+        fb.fclose()
+        # The switch is retried only after the non-fitting entry rotated out
+        repacks = []
+        _repack = fb._repack
+        fb._repack = lambda *a: repacks.append(a) or _repack(*a)
+        [fb.write(p, 8., codec='d') for i in range(fb.idx_entries - 1)]
+        self.assertEqual(repacks, [])
+        fb.write(p, 9., codec='d')
+        self.assertEqual(repacks, [('d',)])
+        fb.fopen(p)
+        self.assertEqual(fb.codec, 'd')
+        fb.fclose()
+        del fb._repack
+        # Numpy scalars fit typed codecs
+        p2 = p + '2'
+        fb.write(p2, np.bool_(True), codec='q')
+        fb.write(p2, np.int32(3))
+        fb.write(p2, np.float32(0.5), codec='d')
+        self.assertEqual([e[1] for e in fb.sequence(p2, 0)], [1., 3., 0.5])
+        fb.fopen(p2)
+        self.assertEqual(fb.codec, 'd')
+        fb.fclose()
+
+    def test_typed_bool(self):
+        fb = self.fb
+        [fb.write(p, i % 2, codec='?') for i in range(10)]
+        self.assertEqual([e[1] for e in fb.sequence(p, -3)], [True, False, True])
+        fb.write(p, 2)
+        self.assertEqual([e[1] for e in fb.sequence(p, -3)], [False, True, 2])
+
+    def test_lockfree(self):
+        fb = self.fb
+        [fb.write(p, i) for i in range(10)]
+        fb.fopen(p)
+        # Each write starts and ends a generation
+        self.assertEqual(fb._get_generation(), 21)
+        fb.fclose()
+        fb.lockfree = True
+        # Readers do not wait for an exclusive lock
+        filebuffer.locker.lock(p, filebuffer.LOCK_EX)
+        t0 = time()
+        self.assertEqual(fb.get_item(p, -1)[1], 9)
+        self.assertEqual([e[1] for e in fb.sequence(p, -3)], [7, 8, 9])
+        self.assertLess(time() - t0, 1)
+        filebuffer.locker.unlock(p)
+        # Write in progress: readers wait for it to end, without locking
+        fb.fopen(p)
+        self.assertEqual(fb._get_generation() % 2, 1)
+        fb2 = filebuffer.FileBuffer(private_cache=True)
+        fb2.lockfree = True
+        fb2.timeout = 0.1
+        self.assertRaises(MemoryError, fb2.get_item, p, -1)
+        threading.Timer(0.05, fb.fclose).start()
+        fb2.timeout = 5
+        self.assertEqual(fb2.get_item(p, -1)[1], 9)
+        self.assertEqual(fb2.newer(p, fb2.get_idx(p, -3)[0])[1], [fb2.get_item(p, -2), 
+                                                                 fb2.get_item(p, -1)])
+
+    def test_lockfree_grown(self):
+        """Lock-free readers remap a file grown after it was mapped"""
+        fb = self.fb
+        [fb.write(p, 'v%i' % i) for i in range(5)]
+        fb2 = filebuffer.FileBuffer(private_cache=True)
+        fb2.lockfree = True
+        writes = ['x' * 10**5, 'y' * 10**5]
+        _map = fb2._map
+
+        def grow(path):
+            r = _map(path)
+            # Write between the reader mapping and its generation check
+            if writes:
+                fb.write(p, writes.pop())
+            return r
+        fb2._map = grow
+        seq = fb2.sequence(p, 0)
+        self.assertEqual(len(seq), 7)
+        self.assertEqual(seq[-1][1], 'x' * 10**5)
+        fb2.empty_cache()
+
+    def test_locked_timeout(self):
+        """Locking errors release the FileBuffer"""
+        fb = self.fb
+        fb.write(p, 1)
+        timeout = filebuffer.locker.timeout
+        filebuffer.locker.timeout = 0.1
+        filebuffer.locker.lock(p, filebuffer.LOCK_EX)
+        try:
+            self.assertRaises(MemoryError, fb.get_item, p, -1)
+        finally:
+            filebuffer.locker.timeout = timeout
+            filebuffer.locker.unlock(p)
+        self.assertEqual(fb.get_item(p, -1)[1], 1)
+
+    def test_reclaim(self):
+        """Locks held by dead processes are reclaimed"""
+        fb = self.fb
+        fb.write(p, 1)
+        dead = multiprocessing.Process(target=time)
+        dead.start()
+        dead.join()
+        lk = filebuffer.locker
+        idx = lk._idx(p)
+        lk.locks[idx] = filebuffer.LOCK_EX
+        lk.owners[idx] = dead.pid
+        self.assertEqual(fb.get_item(p, -1)[1], 1)
+        self.assertEqual(lk.locks[idx], filebuffer.LOCK_UN)
+        # Addresses are reserved atomically
+        self.assertFalse(lk.cas(idx, filebuffer.LOCK_FR, filebuffer.LOCK_UN))
+        self.assertTrue(lk.lock(p, filebuffer.LOCK_SH))
+        self.assertEqual(lk.owners[idx], os.getpid())
+        self.assertFalse(lk.lock(p, filebuffer.LOCK_NBEX))
+        lk.unlock(p)
+
+    def write_legacy(self, vals, meta='metainfo'):
+        """Write a text-indexed (version 1) buffer"""
+        fb = self.fb
+        if not os.path.exists(dr):
+            os.makedirs(dr)
+        fo = open(p, 'wb')
+        # Wrap around the ring like FileBuffer.write did
+        N = len(vals)
+        high = (N - 1) % fb.idx_entries
+        if N > fb.idx_entries:
+            vals = vals[-high - 1:] + vals[-fb.idx_entries:-high - 1]
+        fo.write(fb.legacy_info_fmt.format(high, N, vals[high][0]))
+        data = ''
+        pos = fb.legacy_start_position
+        idx = ''
+        for t, v in vals:
+            d = fb.separator + dumps(v, fb.protocol)
+            idx += fb.legacy_idx_fmt.format(t, pos + fb.sep_len, pos + len(d))
+            pos += len(d)
+            data += d
+        fo.write(idx)
+        empty = fb.legacy_invalid + ' ' * (fb.legacy_idx_len - 2) + '\n'
+        fo.write(empty * (fb.idx_entries - min(N, fb.idx_entries)))
+        fo.write(dumps(meta, fb.protocol).ljust(fb.meta_len))
+        fo.write(data)
+        fo.close()
+        filebuffer.locker.new(p)
+
+    def test_legacy(self):
+        """Text-indexed buffers are read in legacy mode and migrated on write"""
+        fb = self.fb
+        vals = [(i + 1., i * 10) for i in range(5)]
+        self.write_legacy(vals)
+        self.assertEqual(fb.get_info(p), (4, 5, 5.))
+        self.assertTrue(fb.legacy)
+        self.assertEqual(fb.get_item(p, 2), [3., 20])
+        self.assertEqual(fb.get_meta(p), 'metainfo')
+        self.assertEqual(fb.get_time_idx(p, 3.), 2)
+        # Shared opening did not touch the file
+        self.assertNotEqual(open(p, 'rb').read(4), fb.magic)
+        # Writing migrates to the binary layout
+        fb.write(p, 50, 6.)
+        self.assertFalse(fb.legacy)
+        self.assertEqual(open(p, 'rb').read(4), fb.magic)
+        self.assertEqual([e[1] for e in fb.sequence(p, 0)], [0, 10, 20, 30, 40, 50])
+        self.assertEqual(fb.get_meta(p), 'metainfo')
+        self.assertEqual(list(fb.full_idx(p)[:, 0]), range(1, 7))
+
+    def test_legacy_wrapped(self):
+        fb = self.fb
+        vals = [(i + 6., i + 6) for i in range(fb.idx_entries)]
+        vals += [(t + fb.idx_entries, v + fb.idx_entries) for t, v in vals[:5]]
+        self.write_legacy(vals[5:])
+        self.assertEqual(fb.get_info(p)[:2], (99, 100))
+        self.write_legacy(vals)
+        self.assertEqual(fb.get_info(p)[:2], (4, 105))
+        self.assertEqual(fb.get_idx(p, fb.get_time_idx(p, 50.))[0], 50.)
+        self.assertEqual(fb.get_idx(p, fb.get_time_idx(p, 103.))[0], 103.)
+        self.assertEqual([e[1] for e in fb.sequence(p, -3)], [108, 109, 110])
+        self.assertEqual(list(fb.full_idx(p)[:, 0]), range(11, 111))
+        # Migrated buffer keeps the same order
+        fb.write(p, 111, 111.)
+        self.assertEqual([e[1] for e in fb.sequence(p, -3)], [109, 110, 111])
+
+    def test_version(self):
+        """Unknown layout versions are refused"""
+        fb = self.fb
+        fb.write(p, 1)
+        fb.fopen(p)
+        fb.mm[4:8] = fb.info_struct.pack(fb.magic, fb.version + 1, 0, 0, 0)[4:8]
+        fb.fclose()
+        self.assertRaises(IOError, fb.get_item, p, -1)
+        # Locks were released
+        self.assertTrue(fb._lock.acquire(False))
+        fb._lock.release()
+        self.assertRaises(IOError, fb.write, p, 2)
+
+    def test_mmap_cache(self):
+        """Mappings are reused until the file is replaced or resized"""
+        fb = self.fb
+        fb.write(p, 1, newmeta={'handle': 'test'})
+        mm, fd = fb.fopen(p, filebuffer.LOCK_SH)
+        fb.fclose()
+        self.assertIs(fb.fopen(p, filebuffer.LOCK_SH)[0], mm)
+        fb.fclose()
+        self.assertEqual(fb.get_item(p, -1)[1], 1)
+        # Resized by another process
+        other = filebuffer.FileBuffer(private_cache=True)
+        other.write(p, 'x' * 10000)
+        self.assertEqual(fb.get_item(p, -1)[1], 'x' * 10000)
+        mm1 = fb.cache[p][1]
+        self.assertIsNot(mm1, mm)
+        self.assertEqual(len(mm1), os.stat(p).st_size)
+        # Replaced by another process
+        other.clear(p)
+        other.write(p, 2)
+        self.assertEqual([e[1] for e in fb.sequence(p, 0)], ['x' * 10000, 2])
+        self.assertEqual(fb.get_item(p, -1)[1], 2)
+        self.assertIsNot(fb.cache[p][1], mm1)
+        # Least recently used mappings are closed first
+        fb.cache_len = 2
+        fb.write(p + '1', 1)
+        fb.get_item(p, -1)
+        fb.write(p + '2', 2)
+        self.assertEqual(fb.cache.keys(), [p, p + '2'])
+        other.empty_cache()
+        self.assertEqual(len(other.cache), 0)
+
+    def test_meta_cache(self):
+        """Metadata is decoded again only after set_meta"""
+        fb = self.fb
+        fb.write(p, 1, newmeta={'handle': 'test', 'attr': []})
+        m = fb.get_meta(p)
+        self.assertEqual(m, {'handle': 'test', 'attr': []})
+        gen, cached = fb.meta_cache[p]
+        self.assertEqual(cached, m)
+        # Returned copies can be modified
+        m['current'] = 1
+        m['attr'].append('History')
+        self.assertEqual(fb.read(p), {'handle': 'test', 'attr': [], 'current': 1})
+        self.assertEqual(fb.get_meta(p), {'handle': 'test', 'attr': []})
+        self.assertIs(fb.meta_cache[p][1], cached)
+        # Invalidated by another buffer
+        other = filebuffer.FileBuffer(private_cache=True)
+        other.set_meta(p, {'handle': 'test', 'attr': ['History']})
+        self.assertEqual(fb.get_meta(p)['attr'], ['History'])
+        self.assertEqual(fb.meta_cache[p][0], gen + 1)
+        # Re-created files do not match the cached generation
+        other.clear(p)
+        self.assertNotEqual(fb.meta_cache[p][0], other.meta_gen_struct.unpack(open(p).read()[36:40])[0])
+        self.assertEqual(fb.read(p), {'handle': 'test', 'attr': ['History'], 'current': 1})
+        fb.close(dr, hard=True)
+        self.assertNotIn(p, fb.meta_cache)
+
+    def test_copy_meta(self):
+        """Option objects are copied together with their entry"""
+        opt = Opt(handle='a', attr=[])
+        c = filebuffer.copy_meta(opt)
+        c.entry['attr'].append('History')
+        c.entry['current'] = 1
+        self.assertEqual(opt.entry, {'handle': 'a', 'attr': []})
+        self.assertIsInstance(c, Opt)
+
+    def test_durability(self):
+        """Syncing depends on durability level"""
+        self.assertTrue(filebuffer.on_tmpfs(dr))
+        self.assertEqual(self.fb.get_durability(p), filebuffer.DURABILITY_NONE)
+        self.assertEqual(self.fb.open_flags(p), filebuffer.flags)
+        self.assertRaises(ValueError, filebuffer.FileBuffer, durability='always')
+        fb = filebuffer.FileBuffer(durability=filebuffer.DURABILITY_STRICT)
+        self.assertEqual(fb.open_flags(p), filebuffer.sync_flags)
+        # Written paths are synced in background
+        fb = filebuffer.FileBuffer(durability=filebuffer.DURABILITY_PERIODIC)
+        fb.cache = {}
+        fb.write(p, 1)
+        filebuffer.periodic_sync.sync()
+        fb.write(p, 2)
+        fb.write(p, 3)
+        self.assertEqual(fb.get_item(p, -1)[1], 3)
+        self.assertEqual(filebuffer.periodic_sync.paths, set([p]))
+        self.assertEqual(filebuffer.periodic_sync.sync(), 1)
+        self.assertEqual(filebuffer.periodic_sync.sync(), 0)
+
     def test_clear(self):
         fb = self.fb
         meta = 'metainfo'
@@ -230,7 +616,7 @@ class FileBuffer(unittest.TestCase):
     def stress_write(self, pid, dat='a', dt=10, spr=False):
         if spr:
             spr()
-        assert filebuffer.locker.locks[1000].value==9, filebuffer.locker.locks[1000].value
+        assert filebuffer.locker.locks[1000]==9, filebuffer.locker.locks[1000]
         i = 0
         t0=time()
         while time()-t0<dt:
@@ -245,7 +631,7 @@ class FileBuffer(unittest.TestCase):
     def stress_read(self, pid, dt=10, spr=False):
         if spr:
             spr()
-        assert filebuffer.locker.locks[1000].value==9, filebuffer.locker.locks[1000].value
+        assert filebuffer.locker.locks[1000]==9, filebuffer.locker.locks[1000]
         i = 0
         t0 = time()
         while time()-t0<dt:
@@ -267,7 +653,7 @@ class FileBuffer(unittest.TestCase):
         r_concurrency = 2
         w = []
         r = []
-        filebuffer.locker.locks[1000].value=9
+        filebuffer.locker.locks[1000]=9
         for i in range(w_concurrency):
             w.append(multiprocessing.Process(target=self.stress_write, 
                                              name='Write{}'.format(i),
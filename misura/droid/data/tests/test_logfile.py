@@ -0,0 +1,63 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import shutil
+import tempfile
+
+from misura.droid.data import logfile
+
+
+class LogFile(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'log.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_read(self):
+        f = logfile.LogFile(self.path)
+        f.index_step = 100
+        f.write([[float(i), (i % 5) * 10, 'o%i' % (i % 2), u'msg\xe8%i' % i] for i in range(100)])
+        f.close()
+        r = logfile.LogReader(self.path)
+        self.assertGreater(len(r.index(self.path)), 10)
+        rows = list(r.read())
+        self.assertEqual(len(rows), 100)
+        self.assertEqual(rows[3], [3., 30, 'o1', u'msg\xe83'])
+        rows = list(r.read(fromt=50, tot=60))
+        self.assertEqual([l[0] for l in rows], range(51, 60))
+        rows = list(r.read(fromt=50, priority=40, owner='o0'))
+        self.assertEqual([l[0] for l in rows], [54., 64., 74., 84., 94.])
+        line = list(r.format(fromt=98, log_format='%(levelname)s %(message)s'))
+        self.assertEqual(line, [u'ERROR msg\xe899'])
+        # Truncated last record
+        f = open(self.path, 'ab')
+        f.write(logfile.record_struct.pack(10, 100., 10, 1) + 'o')
+        f.close()
+        self.assertEqual(len(list(r.read())), 100)
+
+    def test_rotate(self):
+        f = logfile.LogFile(self.path, max_size=1000, backups=3)
+        f.index_step = 200
+        for i in range(200):
+            f.write([[float(i), 10, 'owner', 'message %i' % i]])
+        f.close()
+        segs = logfile.segments(self.path)
+        self.assertEqual(segs, [self.path + '.3', self.path + '.2', self.path + '.1', self.path])
+        for s in segs:
+            self.assertLessEqual(os.stat(s).st_size, 1000)
+            self.assertTrue(os.path.exists(s + '.idx'))
+        r = logfile.LogReader(self.path, backups=3)
+        rows = list(r.read())
+        # Older records were discarded
+        self.assertEqual(rows[-1], [199., 10, 'owner', 'message 199'])
+        self.assertEqual([l[0] for l in rows], range(int(rows[0][0]), 200))
+        t0 = rows[0][0]
+        self.assertEqual([l[0] for l in r.read(fromt=t0 + 30, tot=t0 + 33)], [t0 + 31, t0 + 32])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import unittest
+import multiprocessing
+from cPickle import dumps, loads
+
+from misura.droid.data import logring
+
+
+def child_log(ring):
+    ring.append(5., 30, 'child', 'from child')
+
+
+class LogRing(unittest.TestCase):
+
+    def setUp(self):
+        self.r = logring.LogRing(8, 64)
+
+    def test_search(self):
+        r = self.r
+        self.assertEqual(r.search()[1], [])
+        for i in range(6):
+            r.append(float(i), i * 10, 'o%i' % (i % 2), 'msg%i' % i)
+        t, rows = r.search()
+        self.assertEqual(t, 5.)
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[0], [0., 0, 'o0', 'msg0'])
+        self.assertEqual(r.search(fromt=2)[1], [[3., 30, 'o1', 'msg3'],
+                                                [4., 40, 'o0', 'msg4'],
+                                                [5., 50, 'o1', 'msg5']])
+        self.assertEqual([l[0] for l in r.search(fromt=0.5, tot=4)[1]], [1., 2., 3.])
+        self.assertEqual([l[0] for l in r.search(priority=30)[1]], [3., 4., 5.])
+        self.assertEqual([l[0] for l in r.search(owner='o1', maxn=2)[1]], [1., 3.])
+        self.assertEqual(r.search(owner=u'o\xe8')[1], [])
+
+    def test_wrap(self):
+        """Older lines and texts are overwritten"""
+        r = self.r
+        for i in range(20):
+            r.append(float(i), 10, 'o', 'msg%i' % i)
+        rows = r.search(fromt=-1)[1]
+        self.assertEqual([l[0] for l in rows], range(12, 20))
+        # 64 bytes of text fit all the retained lines
+        self.assertEqual([l[3] for l in rows], ['msg%i' % i for i in range(12, 20)])
+        # Long lines are truncated to a quarter of the text
+        r.append(20., 10, 'o', 'a' * 100)
+        r.append(21., 10, 'o', 'a' * 100)
+        rows = r.search(fromt=-1)[1]
+        self.assertEqual(rows[-1][3], 'a' * 15)
+        self.assertEqual(rows[0][3], '')
+        self.assertEqual(rows[1][3], 'msg15')
+
+    def test_tail(self):
+        r = self.r
+        r.append(1., 10, u'\xe8', u'\xe0')
+        cursor, rows = r.tail()
+        self.assertEqual(cursor, 1)
+        self.assertEqual(rows, [[1., 10, u'\xe8', u'\xe0']])
+        self.assertEqual(r.tail(cursor), (1, []))
+        for i in range(10):
+            r.append(float(i + 2), i, 'o', 'msg')
+        # Only the latest lines are retained
+        cursor, rows = r.tail(cursor)
+        self.assertEqual(cursor, 11)
+        self.assertEqual(len(rows), 8)
+        # Continue after maxn lines
+        cursor, rows = r.tail(3, maxn=3)
+        self.assertEqual(cursor, 6)
+        self.assertEqual([l[0] for l in rows], [4., 5., 6.])
+        cursor, rows = r.tail(cursor, maxn=3)
+        self.assertEqual(cursor, 9)
+        self.assertEqual([l[0] for l in rows], [7., 8., 9.])
+        self.assertEqual(r.tail(cursor, maxn=3), (11, [[10., 8, 'o', 'msg'], [11., 9, 'o', 'msg']]))
+
+    def test_indexes(self):
+        r = logring.LogRing(16, 1000)
+        r.chunk = 4
+        for i in range(40):
+            r.append(float(i // 2), (i % 6) * 10 + 5, 'o%i' % (i % 3), 'msg%i' % i)
+        # Lines keep their time, while search keys do not decrease
+        r.append(1., 10, 'o0', 'late')
+        self.assertEqual(r.tail(40)[1], [[1., 10, 'o0', 'late']])
+        self.assertEqual(r.search(fromt=18.5), (19., [[19., 25, 'o2', 'msg38'], [19., 35, 'o0', 'msg39'],
+                                                   [1., 10, 'o0', 'late']]))
+        self.assertEqual(r.owner_count.value, 3)
+        self.assertEqual(r.search(fromt=12.5, tot=15)[1][0][3], 'msg26')
+        self.assertEqual([l[3] for l in r.search(fromt=13, tot=16)[1]],
+                         ['msg28', 'msg29', 'msg30', 'msg31'])
+        # Overwritten positions leave the older priority bitmaps
+        rows = r.tail(priority=50)[1]
+        self.assertEqual([l[3] for l in rows], ['msg29', 'msg35'])
+        rows = r.tail(priority=40, owner='o2')[1]
+        self.assertEqual([l[3] for l in rows], ['msg29', 'msg35'])
+        rows = r.search(fromt=1, priority=30, owner='o0', maxn=2)[1]
+        self.assertEqual([l[3] for l in rows], ['msg27', 'msg33'])
+        self.assertEqual(r.search(fromt=1, owner='o3')[1], [])
+
+    def test_owners(self):
+        """Long owners and owners overflowing the intern table"""
+        r = self.r
+        r.owners = 2
+        r.owner_size = 4
+        r.__init__(8, 1000)
+        for o in ('a', 'bbbbb', 'bbbbc', 'c', 'd'):
+            r.append(1., 10, o, 'msg' + o)
+        self.assertEqual(r.owner_count.value, 2)
+        for o in ('a', 'bbbbb', 'bbbbc', 'c', 'd'):
+            self.assertEqual(r.search(fromt=0.5, owner=o)[1], [[1., 10, o, 'msg' + o]])
+
+    def test_shared(self):
+        """Lines appended by other processes are seen directly"""
+        p = multiprocessing.Process(target=child_log, args=(self.r,))
+        p.start()
+        p.join()
+        self.assertEqual(self.r.search()[1], [[5., 30, 'child', 'from child']])
+
+    def test_dump(self):
+        self.assertIs(loads(dumps(self.r)), logring.log_ring)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
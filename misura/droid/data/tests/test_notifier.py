@@ -0,0 +1,99 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import shutil
+import threading
+from time import time, sleep
+
+from misura.droid.data import notifier, filebuffer
+
+dr = '/dev/shm/misura_test/notifier/'
+p = dr + 'test'
+
+
+class ChangeNotifier(unittest.TestCase):
+
+    def setUp(self):
+        self.n = notifier.ChangeNotifier(10, capacity=8)
+
+    def test_changes(self):
+        n = self.n
+        w = n.watch()
+        self.assertEqual(w.changes(), [])
+        n.publish(3, 10.)
+        n.publish(1, 11.)
+        n.publish(3, 12.)
+        self.assertEqual(w.changes(), [1, 3])
+        self.assertEqual(w.changes(), [])
+        self.assertEqual(n.latest[3], 12.)
+        # Filtered
+        w = n.watch([1])
+        n.publish(3, 13.)
+        self.assertEqual(w.changes(), [])
+        n.publish(1, 14.)
+        self.assertEqual(w.changes(), [1])
+        # Overrun ring
+        for i in range(9):
+            n.publish(2, i)
+        self.assertEqual(w.changes(), None)
+        self.assertEqual(w.changes(), [])
+
+    def test_wait(self):
+        n = self.n
+        w = n.watch([1])
+        t0 = time()
+        self.assertEqual(w.wait(0.1), [])
+        self.assertGreaterEqual(time() - t0, 0.1)
+
+        def publish():
+            sleep(0.05)
+            n.publish(2, 1.)
+            sleep(0.05)
+            n.publish(1, 2.)
+        th = threading.Thread(target=publish)
+        th.start()
+        t0 = time()
+        self.assertEqual(w.wait(5), [1])
+        self.assertLess(time() - t0, 1)
+        th.join()
+
+    def test_wake(self):
+        n = self.n
+        w = n.watch()
+        th = threading.Timer(0.05, n.wake)
+        th.start()
+        t0 = time()
+        self.assertEqual(w.wait(5), [])
+        self.assertLess(time() - t0, 1)
+        th.join()
+
+
+class LatestTime(unittest.TestCase):
+
+    def setUp(self):
+        self.fb = filebuffer.FileBuffer(private_cache=True)
+
+    def tearDown(self):
+        self.fb.empty_cache()
+        if os.path.exists(dr):
+            shutil.rmtree(dr)
+
+    def test_latest_time(self):
+        fb = self.fb
+        self.assertEqual(fb.latest_time(p), -1)
+        fb.write(p, 1, t=10., newmeta={'handle': 'test'})
+        self.assertEqual(fb.latest_time(p), 10.)
+        fb.write(p, 2, t=11.)
+        self.assertEqual(fb.latest_time(p), 11.)
+        # The path gets a new address
+        fb.clear(p)
+        self.assertEqual(fb.latest_time(p), 11.)
+        # Reassigned address
+        address = filebuffer.locker.cache[p]
+        filebuffer.notifier.forget(address, 0)
+        self.assertEqual(fb.latest_time(p), -1)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -2,7 +2,8 @@
 # -*- coding: utf-8 -*-
 import unittest
 import os
-from misura.droid.data import refupdater, dirshelf
+import numpy as np
+from misura.droid.data import refupdater, dirshelf, filebuffer, discovery
 from misura.canon.option import Option
 from misura.canon.indexer import SharedFile
 from time import time, sleep
@@ -17,6 +18,16 @@ dspath = '/dev/shm/misura_test/test'
 if os.name=='nt':
     dspath='C:\\dev\\shm\\misura_test\\test'
 
+def take(ru):
+    """Pull all queued paths"""
+    ru.fill_queue()
+    r = []
+    while ru.queue:
+        r.append(ru.next_path())
+        ru.done(r[-1], 0)
+    return r
+
+
 class TestRefUpdater(unittest.TestCase):
 
     def setUp(self):
@@ -38,6 +49,132 @@ class TestRefUpdater(unittest.TestCase):
     def test_dump(self):
         dumps(self.ru)
 
+    def test_commit(self):
+        """Numeric points are appended at once"""
+        class Ref(object):
+            folder = '/ref'
+
+            def __init__(self):
+                self.appended = []
+                self.interpolated = 0
+
+            def append(self, data):
+                self.appended.append(data)
+
+            def interpolate(self):
+                self.interpolated += 1
+
+        ref = Ref()
+        self.assertEqual(self.ru.commit(ref, [(1., 10), (2., 20), (3., 30)]), 3)
+        self.assertEqual(len(ref.appended), 1)
+        self.assertEqual(ref.appended[0].shape, (3, 2))
+        self.assertEqual(ref.interpolated, 1)
+        # Object points are appended one by one
+        ref = Ref()
+        self.assertEqual(self.ru.commit(ref, [(1., 'a'), (2., 'bb')]), 2)
+        self.assertEqual(len(ref.appended), 2)
+        stats = self.ru.commit_stats()
+        self.assertEqual(stats['commits'], 2)
+        self.assertEqual(stats['points_per_commit'], 2.5)
+        self.assertEqual(stats['max_points'], 3)
+        self.assertGreaterEqual(stats['max_latency'], stats['latency'])
+
+    def test_dirty(self):
+        """Only changed paths are scanned"""
+        ru = self.ru
+        ru.nthreads = 1
+        fb = filebuffer.FileBuffer(private_cache=True)
+        p, q, z = [os.path.join(dspath, 'dirty', n, 'self') for n in 'pqz']
+        for path in (p, q, z):
+            fb.write(path, 1, t=1., newmeta={'handle': 'x'})
+        ru.monitor(p, '/p')
+        ru.monitor(q, '/q')
+        self.assertEqual(sorted(take(ru)), [p, q])
+        self.assertEqual(take(ru), [])
+        # Non-monitored paths are ignored
+        fb.write(p, 2, t=2.)
+        fb.write(z, 2, t=2.)
+        self.assertEqual(take(ru), [p])
+        # Address reassigned to a new file
+        fb.clear(q)
+        fb.write(q, 3, t=3., newmeta={'handle': 'x'})
+        self.assertEqual(take(ru), [q])
+        # Periodic full scan
+        ru.full_scan_time = 0
+        self.assertEqual(sorted(take(ru)), [p, q])
+        fb.empty_cache()
+
+    def test_discover(self):
+        """New options are recorded without walking the whole tree"""
+        ru = self.ru
+        self.assertEqual(ru.discover(), 1)
+        self.assertEqual(ru.paths.keys(), [self.k])
+        # Option registered by DirShelf
+        self.ds.set('g', Option(handle='g', type='Integer', attr=['History'], kid='/g'))
+        self.ds.set('n', Option(handle='n', type='Integer', kid='/n'))
+        g = self.ds.fp('g')
+        self.assertEqual(ru.discover(), 1)
+        self.assertEqual(ru.paths[g], '/g')
+        # Gaining History later
+        self.ds.set('n', Option(handle='n', type='Integer', attr=['History'], kid='/n'))
+        self.assertEqual(ru.discover(), 1)
+        self.assertIn(self.ds.fp('n'), ru.paths)
+        if discovery.libc is None:
+            return
+        # File created by a plain FileBuffer
+        fb = filebuffer.FileBuffer(private_cache=True)
+        p = os.path.join(dspath, 'refup', 'new', 'sub', 'self')
+        fb.write(p, 1, t=1., newmeta={'handle': 'sub', 'type': 'Integer',
+                                      'attr': ['History'], 'kid': '/new/sub'})
+        self.assertEqual(ru.discover(), 1)
+        self.assertEqual(ru.paths[p], '/new/sub')
+        fb.close()
+
+    def test_workers(self):
+        """Points are collected by worker processes"""
+        ru = refupdater.ReferenceUpdater(dspath, self.sh, self.zerotime, nthreads=1, processes=1)
+        self.assertTrue(ru.workers)
+        ru.sync()
+        ref = ru.cache[self.k]
+        for i in range(5):
+            self.ds.set_current('h', i, time())
+        mtime = ref.mtime
+        remote = ru.collect(self.k, ru.buffers[0])
+        # Numeric points are received as a block
+        self.assertTrue(isinstance(remote, np.ndarray))
+        self.assertEqual(len(remote), 5)
+        newest = ref.mtime
+        ref.mtime = mtime
+        ru.local_paths.add(self.k)
+        local = ru.collect(self.k, ru.buffers[0])
+        self.assertEqual(remote.tolist(), np.array(local).tolist())
+        self.assertEqual(ref.mtime, newest)
+        ru.close()
+        self.assertFalse(ru.workers)
+
+    def test_queue(self):
+        """Faster paths are collected first, paths being collected are not queued again"""
+        ru = self.ru
+        for p in 'abc':
+            ru.monitor(p, '/' + p)
+        ru.fill_queue()
+        self.assertEqual(ru.fill_queue(), 0)
+        for n in (1, 10, 5):
+            ru.done(ru.next_path(), n)
+        fast = [p for p, r in sorted(ru.rates.items(), key=lambda i: -i[1])]
+        ru.dirty.update('abc')
+        ru.fill_queue()
+        self.assertEqual(list(ru.queue), fast)
+        # Active path stays dirty
+        p = ru.next_path()
+        ru.queue.clear()
+        ru.dirty.update('abc')
+        self.assertEqual(ru.fill_queue(), 2)
+        self.assertEqual(ru.dirty, set([p]))
+        ru.done(p, 0)
+        ru.queue.clear()
+        self.assertEqual(ru.fill_queue(), 1)
+
     def changeval(self, nval):
         print 'CHANGEVAL', nval
         t0 = time()
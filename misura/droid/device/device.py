@@ -72,13 +72,11 @@ class Device(option.Aggregative, milang.Scriptable, Node):
 
     def __init__(self, parent=None, node='', conf_def=False):
         """Role-aware"""
-        # Assure that each instance gets its own, unique, configuration
-        # definition
         self.roledev = {}
         """Role->Dev mapping dictionary"""
+        # Instances share the configuration definition: options are copied by Node.conf_template
         if conf_def is not False:
             self.conf_def = conf_def
-        self.conf_def = deepcopy(self.conf_def)
         milang.Scriptable.__init__(self)
         Node.__init__(self, parent=parent, node=node)
         if self['name'] == 'device':
@@ -17,6 +17,15 @@ from configuration import ConfigurationInterface,  NoProperty
 forbidden_node_names = ['system', 'parent', 'child', 'desc', 'idesc']
 
 
+def same_definition(a, b):
+    """Check if option definition lists `a` and `b` are equal"""
+    try:
+        return bool(a == b)
+    except ValueError:
+        # Ambiguous comparison of array values
+        return False
+
+
 class Node(ConfigurationInterface):
 
     """Tree-aware and implicit desc class"""
@@ -32,6 +41,31 @@ class Node(ConfigurationInterface):
     _Method__name = None  # Client-side compatibility for testing purposes
     _parent = None
     _root = None
+    shelf_arena = None
+    """Store options in a single arena file. None follows params.shelf_arena."""
+    conf_templates = {}
+    """Options compiled from the conf_def of each class, shared by its instances {class: (conf_def copy, options)}"""
+
+    @classmethod
+    def conf_template(cls, conf_def):
+        """Return options compiled from `conf_def`, copied from a shared template.
+        Only a conf_def defined by a class is cached, and compiled again if it was changed.
+        Other definitions, eg. passed to the constructor, are compiled each time."""
+        owner = None
+        for c in cls.__mro__:
+            if c.__dict__.get('conf_def', None) is conf_def:
+                owner = c
+                break
+        if owner is None:
+            return option.ListStore.read(conf_def)
+        cached = Node.conf_templates.get(owner, None)
+        if cached is None or not same_definition(cached[0], conf_def):
+            options = option.ListStore.read(conf_def)
+            # Copied after compiling, which might fill defaults in
+            cached = (deepcopy(conf_def), options)
+            Node.conf_templates[owner] = cached
+        template = cached[1]
+        return template.__class__((k, data.copy_meta(v)) for k, v in template.iteritems())
 
     @classmethod
     def query_udev(cls, node=None):
@@ -82,14 +116,11 @@ class Node(ConfigurationInterface):
 
     def __init__(self, parent=None, node='node'):
         """Tree-aware"""
-        # Assure that each instance gets its own, unique, configuration
-        # definition
         self.roledev = {}
         """Role->Dev mapping dictionary"""
         if node in forbidden_node_names:
             print('Forbidden node name', node)
             return
-        self.conf_def = deepcopy(self.conf_def)
         self._parent = parent
         # import here so we get fresh database definition
         from misura.droid import share
@@ -102,8 +133,8 @@ class Node(ConfigurationInterface):
         self.manager = manager
         # Create Conf object
         conf_dir = self.main_confdir + self.__class__.__name__
-        ddesc = option.ListStore.read(self.conf_def)
-        desc = data.Conf(desc=ddesc, conf_dir=conf_dir)
+        ddesc = self.conf_template(self.conf_def)
+        desc = data.Conf(desc=ddesc, conf_dir=conf_dir, shelf_arena=self.shelf_arena)
         desc.set_current('dev', node)
         desc.set_current('devpath', node)
         ConfigurationInterface.__init__(self, desc)
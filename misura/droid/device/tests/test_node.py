@@ -109,6 +109,28 @@ class Node(unittest.TestCase):
         self.assertEqual(len(t), 2)
         self.assertEqual(t.keys(), ['self', 'sub2'])
 
+    def test_conf_template(self):
+        """Instances get their own copy of options compiled once from conf_def"""
+        conf_def = device.Node.conf_def
+        a = device.Node.conf_template(conf_def)
+        b = device.Node.conf_template(conf_def)
+        self.assertEqual(sorted(a.keys()), sorted(b.keys()))
+        self.assertIsNot(a['fullpath'], b['fullpath'])
+        a['fullpath']['attr'].append('ReadOnly')
+        self.assertEqual(b['fullpath']['attr'], ['Hidden'])
+        self.assertIn(device.Node, device.Node.conf_templates)
+        # Edited class definitions are compiled again
+        conf_def[-1]['current'] = 'edited'
+        try:
+            self.assertEqual(device.Node.conf_template(conf_def)['dev']['current'], 'edited')
+        finally:
+            conf_def[-1]['current'] = 'none'
+        # Other definitions are not cached
+        n = len(device.Node.conf_templates)
+        extended = conf_def + [{"handle": 'extra', "name": 'Extra', "type": 'String', "current": ''}]
+        self.assertIn('extra', device.Node.conf_template(extended))
+        self.assertEqual(len(device.Node.conf_templates), n)
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)
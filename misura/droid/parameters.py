@@ -72,6 +72,9 @@ log_basename = 'misura.log'
 log_format = '%(levelname)s:%(asctime)s %(message)s'
 log_disk_space = 1000 * (10 ** 6)  # Bytes (1GB)
 log_file_dimension = 10 * (10 ** 6)  # Bytes (10MB)
+log_ring_length = 4096  # Latest log lines kept in shared memory
+log_ring_text = 10 ** 6  # Bytes of shared memory for their messages
+log_binary = False  # Also write a binary structured log file, with .bin extension
 
 # PORTS (only for standalone test instances)
 main_port = 3880
@@ -82,6 +85,16 @@ conf_ext = '.csv'
 curve_ext = '.crv'
 characterization_ext = '.csv'
 
+# Shared memory FileBuffer durability: 'none', 'periodic', 'strict',
+# or False to disable syncing only on RAM filesystems (tmpfs)
+shelf_durability = False
+# Keep all options of each configuration in a single arena file,
+# instead of one FileBuffer per option (History options excluded)
+shelf_arena = False
+# Output file collection: scan threads, and worker processes reading
+# FileBuffers for them (0 to read in the scan threads)
+refupdater_threads = 3
+refupdater_processes = 0
 fileTransferChunkLimit = 2  # MB
 min_free_space_on_disk = 500  # MB
 # lines. Max buffer length in per-device acquisition cycles
@@ -240,6 +240,7 @@ class BaseServer(device.Device):
                 rep.append(obj.get(n))
                 idx.append(i)
                 continue
+            # Notified by the writer, without reading the option buffer
             nt = obj.h_time_at(n)
             if nt > t0:
                 # Retrieve the memory value,
@@ -21,6 +21,7 @@ from .. import parameters as params
 from .. import utils
 from .. import share
 from .. import device
+from ..data import logring
 
 from .base import BaseServer
 import stream
@@ -239,9 +240,14 @@ class MainServer(BaseServer):
         return BaseServer.describe(self, *a, **kw)
 
     def search_log(self, fromt=False, tot=False, maxn=None, priority=0, owner=False):
-        return share.database.get_log(fromt, priority, owner, tot=tot, maxn=maxn)
+        return logring.log_ring.search(fromt, priority, owner, tot=tot, maxn=maxn)
     xmlrpc_search_log = search_log
 
+    def tail_log(self, cursor=0, maxn=None, priority=0, owner=False):
+        """Incremental log reading: pass the returned cursor to the next call"""
+        return logring.log_ring.tail(cursor, priority, owner, maxn=maxn)
+    xmlrpc_tail_log = tail_log
+
     def xmlrpc_send_log(self, msg, p=10):
         """Clients can send a message to the server"""
         # easter egg
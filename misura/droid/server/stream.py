@@ -5,12 +5,16 @@ import os
 from twisted.web import resource, static,  server
 from twisted.internet import interfaces
 from zope.interface import implements
+from ..data import filebuffer
 
 
 class OptionProducer(object):
 
     """A dummy producer which continously sends the current option value."""
     implements(interfaces.IPullProducer)
+    idle_timeout = 0.05
+    """Maximum time waiting for the option to change.
+    Waits happen in the reactor thread, blocking all other requests."""
 
     def __init__(self, request, obj, opt, interval=0):
         self.request = request
@@ -19,6 +23,7 @@ class OptionProducer(object):
         self.do = True
         self.interval = interval
         self.last = -1
+        self.watch = None
 
     def header(self):
         """Send header"""
@@ -43,12 +48,27 @@ class OptionProducer(object):
         dt = (t - self.last) - self.interval
         if self.do and self.last > 0 and dt <= 0:
             # Avoid 100% CPU
-            sleep(max(-dt, self.interval, 0.05))
+            if t > self.last:
+                sleep(max(-dt, 0.05))
+            else:
+                self.wait_change(self.idle_timeout)
             return None, None
         val = self.obj[self.opt]
         self.last = t
         return t, val
 
+    def wait_change(self, timeout):
+        """Sleep until the option is written, at most `timeout` seconds"""
+        if self.watch is None:
+            address = filebuffer.locker.address(self.obj.desc.fp(self.opt))
+            self.watch = False
+            if address >= 0:
+                self.watch = filebuffer.notifier.watch([address])
+        if self.watch:
+            self.watch.wait(timeout)
+        else:
+            sleep(timeout)
+
     def resumeProducing(self):
         """Called each time the reactor has time to send new value"""
         t, val = self.produce_value()
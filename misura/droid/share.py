@@ -9,6 +9,7 @@ import multiprocessing
 
 from misura.canon import indexer, logger, csutil
 import data
+from data import logring
 import parameters as params
 import process_proxy
 
@@ -40,9 +41,9 @@ class FileBufferLogger(logger.BaseLogger):
         """Post log message to shared logging and append to log_path buffer"""
         if self.owner:
             po['o'] = self.owner
-            # Ensure message is a string, to avoid passing unpicklable to database ProcessProxy
+        # Ensure message is a string, before writing it to the shared log ring
         msg = logger.concatenate_message_objects(*msg)
-        p, msg = database.put_log(*msg, **po)
+        p, msg = logring.log_ring.put_log(*msg, **po)
         if self.log_path:
             msg = u' '.join(tuple(msg))
             msg = msg.decode('utf-8', errors='replace')